@@ -9,31 +9,57 @@ Your task in this exercise has two steps:
     The function takes a string with street name as an argument and should return the fixed name
     We have provided a simple test so that you see what exactly is expected
 """
-import xml.etree.cElementTree as ET
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from timeit import default_timer as timer
 import re
 import operator
+import os
+import osmio
+import housenumbers
+from housenumbers import expand as expand_housenumbers
+import streetrules
 
 OSMFILE = "sample.osm"
 
 # General auditing of street names to find oddities
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 street_type_re_as_part = re.compile(r'\S+\.?$', re.IGNORECASE)
-part_of = re.compile(r'(stra\xdfe|br\xfccke|weg|allee|ring|steig|platz|stieg|steg|aue|acker|heide|feld|lauf|kamp|blick|burg|schlag|wald|tal|tor|eck|sprung|reihe|plantage|graben|hain|heck|horst|mark|rain|schanze|gang|wall|hof|grund|anger|plan|ufer|passage|zeile|hang|winkel|garten|park|wiese|berg|damm|pfad|gasse|promenade)$', re.IGNORECASE)
-prefix = re.compile(r'^(Am|Zum|Zur|An der|Im|Zu den|Unter den|An den|Zwischen den|Hinter den|In den|Auf dem|Weg am|Allee der|Rue|Avenue|Alt-|Via|Stra\xdfe)', re.IGNORECASE)
+# Known street name endings, prefixes, types and misspellings, from
+# street_rules.json
+street_rules = streetrules.load()
+expected = street_rules.expected
 
-expected = ["Weg", u'Stra\xdfe', "Damm", "Platz", "Allee", "Gang", "Garten", "Anger",
-            "Ring", "Steg", "Steig", "Pfad", "Promenade", "See", "Siedlung", "Zeile", "Winkel", "Weinberg", "Ufer",
-            "Aue", "Bahn", "Berg", "Chaussee", "Feld", "Bogen", "Aue", "Esplanade", "G\xe4rten", "Heide", "Karree", "Kehre"]
+
+# part_of, prefix and wrong_spelling were regexes before the rules moved to
+# street_rules.json. They still answer search() and match() with None or an
+# object whose group() is the part of the name that was found.
+class RuleMatch(object):
+    def __init__(self, text):
+        self.text = text
+
+    def group(self, *groups):
+        return self.text
+
+
+class RulePattern(object):
+    def __init__(self, find):
+        self.find = find
+
+    def search(self, name):
+        found = self.find(name)
+        return RuleMatch(found) if found is not None else None
+
+    match = search
+
+
+part_of = RulePattern(street_rules.suffix)
+prefix = RulePattern(street_rules.prefix)
+wrong_spelling = RulePattern(street_rules.misspelling)
 
 # Performs a general auditing of the street names to find oddities
 # This was my starting point
 def audit_street_type(street_types, street_name):
-    m = part_of.search(street_name)
-    if m:
-        return
-    m = prefix.match(street_name)
-    if m:
+    if street_rules.suffix(street_name) or street_rules.prefix(street_name):
         return
     m = street_type_re.search(street_name)
     if m:
@@ -44,45 +70,86 @@ def audit_street_type(street_types, street_name):
 def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
+####################################################################
+# Single pass audit engine
+#
+# Every audit registers callbacks for the tag keys it is interested in (or for
+# whole elements) with an AuditPass. The pass then streams the OSM file once,
+# dispatching each tag only to the callbacks registered for its key, so
+# running all audits costs one parse instead of one parse per audit.
+
+class AuditPass(object):
+    def __init__(self):
+        self.tag_callbacks = defaultdict(list)
+        self.element_callbacks = []
+
+    def on_tag(self, key, callback):
+        self.tag_callbacks[key].append(callback)
+
+    def on_element(self, callback):
+        self.element_callbacks.append(callback)
+
+    def run(self, osmfile, workers=1):
+        tag_callbacks = self.tag_callbacks
+        element_callbacks = self.element_callbacks
+        for elem in osmio.iter_elements(osmfile, workers=workers):
+            for callback in element_callbacks:
+                callback(elem)
+            if not tag_callbacks:
+                continue
+            for tag in elem.iter("tag"):
+                callbacks = tag_callbacks.get(tag.attrib['k'])
+                if callbacks:
+                    for callback in callbacks:
+                        callback(elem, tag.attrib['v'])
+
+# Runs all given audits in a single pass over the file and returns their
+# results. workers is the number of processes decoding a PBF file.
+def run_audits(osmfile, auditors, workers=1):
+    audit_pass = AuditPass()
+    for auditor in auditors:
+        auditor.register(audit_pass)
+    audit_pass.run(osmfile, workers)
+    return [auditor.result() for auditor in auditors]
+
 # Finds the most commonly used keys for ways and nodes to see which ones might
 # be interesting for further analysis
-def getKeys(osmfile):
-    osm_file = open(osmfile, "r")
-    node_keys = {}
-    way_keys = {}
-    suburb = defaultdict(int)
-
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-         in_de = False
-         if elem.tag == "way" or elem.tag == "node":
+class KeysAudit(object):
+    def __init__(self):
+        self.node_keys = {}
+        self.way_keys = {}
+
+    def register(self, audit_pass):
+        audit_pass.on_element(self.element)
+
+    def element(self, elem):
+        in_de = False
+        for tag in elem.iter("tag"):
+            if (tag.attrib['k'] == 'addr:country' and tag.attrib['v'] == 'DE'):
+                in_de = True
+        if in_de:
             for tag in elem.iter("tag"):
-                if (tag.attrib['k'] == 'addr:country' and tag.attrib['v'] == 'DE'):
+                if tag.attrib['k'] != 'addr:postcode':
                     in_de = True
-            if in_de:
-                for tag in elem.iter("tag"):
-                    if ((tag.attrib['k'] == 'addr:postcode') and int(tag.attrib['v']) in range(10115, 15000)) or (tag.attrib['k'] != 'addr:postcode'):
-                        in_de = True
-                    else:
+                else:
+                    try:
+                        in_de = 10115 <= int(tag.attrib['v']) < 15000
+                    except ValueError:
                         in_de = False
 
-            if in_de:
-                if elem.tag == "node":
-                    for tag in elem.iter("tag"):
-                        if tag.attrib['k'] in node_keys:
-                            node_keys[tag.attrib['k']] += 1
-                        else:
-                            node_keys[tag.attrib['k']] = 1
-                        if tag.attrib['k'] == 'phone':
-                            suburb[tag.attrib['v']] += 1
+        if in_de:
+            keys = self.node_keys if elem.tag == "node" else self.way_keys
+            for tag in elem.iter("tag"):
+                if tag.attrib['k'] in keys:
+                    keys[tag.attrib['k']] += 1
+                else:
+                    keys[tag.attrib['k']] = 1
 
-                if elem.tag == "way":
-                    for tag in elem.iter("tag"):
-                        if tag.attrib['k'] in way_keys:
-                            way_keys[tag.attrib['k']] += 1
-                        else:
-                            way_keys[tag.attrib['k']] = 1
+    def result(self):
+        return (self.node_keys, self.way_keys)
 
-    return (node_keys, way_keys)
+def getKeys(osmfile):
+    return run_audits(osmfile, [KeysAudit()])[0]
 
 
 ####################################################################
@@ -91,103 +158,134 @@ def getKeys(osmfile):
 # 2) inconsistent phone numbers
 # 3) inconsistent house numbers
 
-wrong_spelling = re.compile(r'(Chausee|Chausse($|\b))')
-
 # Phone number regexes
-v_plus_49 = re.compile(r'\+49([0-9]+)')
-v_00490 = re.compile(r'00490([0-9]+)')
-v_plus_490 = re.compile(r'\+490([0-9]+)')
-v_0049 = re.compile(r'0049([0-9]+)')
-v_49 = re.compile(r'49([1-9][0-9]+)')
-v_0 = re.compile(r'0([0-9]+)')
 v_ex_phone = re.compile(r'\s*Telefon[^0-9+]*(\+*[0-9]+)')
 
+# The phone number prefixes in one alternation, tried in the order
+# update_phonenumber needs them. lastgroup names the one that matched, "international" numbers
+# are kept as they are, the others become +49 and the digits after the prefix.
+phone_prefix = re.compile(r'00490(?P<p00490>[0-9]+)|0049(?P<p0049>[0-9]+)|\+490(?P<plus490>[0-9]+)'
+                          r'|49(?P<p49>[1-9][0-9]+)|0(?P<p0>[0-9]+)|(?P<international>\+49[0-9]+)')
+
+# Separators deleted from phone numbers, for str.translate and
+# unicode.translate
+PHONE_SEPARATORS = '()-/'
+PHONE_SEPARATORS_UNICODE = dict.fromkeys(map(ord, PHONE_SEPARATORS))
+
+# Number types of the audit and of the check, each regex in one alternation.
+# The group names map to the keys of the counts.
+phone_audit_types = re.compile(
+    r'(?P<p4930>\+49(30|33|34|35|800|180)[0-9]+)|(?P<p004930>0049(30|33|34|35|800|180)[0-9]+)'
+    r'|(?P<p4930_no_plus>49(30|33|34|35|800|180)[0-9]+)|(?P<p030>0(30|33|34|35|800|180)[0-9]+)'
+    r'|(?P<p49030>\+490(30|33|34|35|800|180)[0-9]+)|(?P<mobile_p49>\+49(17|15|16)[0-9]+)'
+    r'|(?P<mobile0049>0049(15|17|16)[0-9]+)|(?P<mobile>0(17|15|16)[0-9]+)')
+PHONE_AUDIT_TYPES = {
+    'p4930': '+4930', 'p004930': '004930', 'p4930_no_plus': '4930', 'p030': '030', 'p49030': '+49030',
+    'mobile_p49': 'mobile_+49', 'mobile0049': 'mobile0049', 'mobile': 'mobile'
+}
+phone_check_types = re.compile(
+    r'(?P<plus49>\+49[^0][0-9]+)|(?P<p0049>0049(30|33|34|35|800|180|17|15|16)[0-9]+)'
+    r'|(?P<error49>49(30|33|34|35|800|180|17|15|16)[0-9]+)|(?P<no_country>0(30|33|34|35|800|180|17|15|16)[0-9]+)'
+    r'|(?P<error490>\+490(30|33|34|35|800|180|17|15|16)[0-9]+)')
+PHONE_CHECK_TYPES = {
+    'plus49': '+49_PATTERN', 'p0049': '0049_PATTERN', 'error49': 'ERROR', 'no_country': 'no_country',
+    'error490': 'ERROR'
+}
+
 
 # Correct misspelled street names
+class MisspelledAudit(object):
+    def __init__(self):
+        self.misspelled = defaultdict(set)
+
+    def register(self, audit_pass):
+        audit_pass.on_tag('addr:street', self.tag)
+
+    def tag(self, elem, street_name):
+        misspelling = street_rules.misspelling(street_name)
+        if misspelling:
+            self.misspelled[misspelling].add(street_name)
+
+    def result(self):
+        return self.misspelled
+
 def find_misspelled(osmfile):
-    osm_file = open(osmfile, "r")
-    misspelled = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-         if elem.tag == "way" or elem.tag == "node":
-             for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    m = wrong_spelling.search(tag.attrib['v'])
-                    if m:
-                        misspelled[m.group()].add(tag.attrib['v'])
-    return misspelled
+    return run_audits(osmfile, [MisspelledAudit()])[0]
 
 # Update Misspelled street names
 def update_name(name):
-    m = wrong_spelling.search(name)
-    if m:
-        name = wrong_spelling.sub('Chaussee', name)
-    return name
+    return street_rules.fix(name)
 
 # Audit the different ways of specifying phone numbers
-def audit_phone(osmfile):
-    osm_file = open(osmfile, "r")
-    number_type = defaultdict(int)
-    phonenumbers = []
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-         if elem.tag == "way" or elem.tag == "node":
-             for tag in elem.iter("tag"):
-                if tag.attrib['k'] == 'phone':
-                    phonenumber = tag.attrib['v']
-                    phonenumbers.append(phonenumber)
-                    phonenumber = phonenumber.replace(' ','')
-                    phonenumber = phonenumber.replace('(0)','')
-                    phonenumber = phonenumber.replace('(','')
-                    phonenumber = phonenumber.replace(')','')
-                    phonenumber = phonenumber.replace('-','')
-                    phonenumber = phonenumber.replace('/','')
-                    phonenumber = phonenumber.replace('+49+49','+49')
-                    if re.match('\+49(30|33|34|35|800|180)[0-9]+', phonenumber):
-                        number_type['+4930'] += 1
-                    elif re.match('0049(30|33|34|35|800|180)[0-9]+', phonenumber):
-                        number_type['004930'] += 1
-                    elif re.match('49(30|33|34|35|800|180)[0-9]+', phonenumber):
-                        number_type['4930'] += 1
-                    elif re.match('0(30|33|34|35|800|180)[0-9]+', phonenumber):
-                        number_type['030'] += 1
-                    elif re.match('\+490(30|33|34|35|800|180)[0-9]+', phonenumber):
-                        number_type['+49030'] += 1
-                    elif re.match('\+49(17|15|16)[0-9]+', phonenumber):
-                        number_type['mobile_+49'] += 1
-                    elif re.match('0049(15|17|16)[0-9]+', phonenumber):
-                        number_type['mobile0049'] += 1
-                    elif re.match('0(17|15|16)[0-9]+', phonenumber):
-                        number_type['mobile'] += 1
-                    else:
-                        number_type[phonenumber] += 1
-                        #print elem.tag
-                        #for t in elem.iter('tag'):
-                        #    print (t.attrib['k'], t.attrib['v'])
+class PhoneAudit(object):
+    def __init__(self):
+        self.number_type = defaultdict(int)
+        self.phonenumbers = []
 
-    print sorted(number_type.items(), key=operator.itemgetter(1), reverse=True)
-    return phonenumbers
+    def register(self, audit_pass):
+        audit_pass.on_tag('phone', self.tag)
 
-# Transform/Correct phone numbers to conform to the following pattern: +49[actual number without leading zero of the prefix]
-def update_phonenumber(phonenumber):
-    # strip all blanks
-    phonenumber = phonenumber.replace(' ', '')
-    phonenumber = phonenumber.replace('(0)', '')
-    phonenumber = phonenumber.replace('(', '')
-    phonenumber = phonenumber.replace(')', '')
-    phonenumber = phonenumber.replace('-', '')
-    phonenumber = phonenumber.replace('/', '')
-    phonenumber = phonenumber.replace('+49+49', '+49')
-    m = v_ex_phone.match(phonenumber)
-    if m:
-        phonenumber = m.group(1)
+    def tag(self, elem, phonenumber):
+        self.phonenumbers.append(phonenumber)
+        phonenumber = clean_phonenumber(phonenumber)
+        m = phone_audit_types.match(phonenumber)
+        self.number_type[PHONE_AUDIT_TYPES[m.lastgroup] if m else phonenumber] += 1
 
-    regexes = [v_00490, v_0049, v_plus_490, v_49, v_0]
-    result = ['+49' + regex.match(phonenumber).group(1) for regex in regexes if regex.match(phonenumber)]
-    if result:
-        return result[0]
-    elif v_plus_49.match(phonenumber):
-        return phonenumber
+    def report(self):
+        print sorted(self.number_type.items(), key=operator.itemgetter(1), reverse=True)
+
+    def result(self):
+        return self.phonenumbers
+
+def audit_phone(osmfile):
+    auditor = PhoneAudit()
+    run_audits(osmfile, [auditor])
+    auditor.report()
+    return auditor.result()
+
+# Strips blanks, a "(0)" trunk prefix and the separators ()-/ from a phone
+# number and fixes a doubled country code
+def clean_phonenumber(phonenumber):
+    # blanks go first, so "( 0 )" counts as "(0)"
+    phonenumber = phonenumber.replace(' ', '')
+    if '(0)' in phonenumber:
+        phonenumber = phonenumber.replace('(0)', '')
+    if isinstance(phonenumber, unicode):
+        phonenumber = phonenumber.translate(PHONE_SEPARATORS_UNICODE)
     else:
+        phonenumber = phonenumber.translate(None, PHONE_SEPARATORS)
+    if '+49+49' in phonenumber:
+        phonenumber = phonenumber.replace('+49+49', '+49')
+    return phonenumber
+
+# Transform/Correct phone numbers to conform to the following pattern: +49[actual number without leading zero of the prefix]
+def update_phonenumber(phonenumber):
+    phonenumber = clean_phonenumber(phonenumber)
+    if 'Telefon' in phonenumber:
+        m = v_ex_phone.match(phonenumber)
+        if m:
+            phonenumber = m.group(1)
+    m = phone_prefix.match(phonenumber)
+    if m is None:
         return []
+    if m.lastgroup == 'international':
+        return phonenumber
+    return '+49' + m.group(m.lastgroup)
+
+# update_phonenumber for a whole column of values, returns the list of
+# results. Numbers that repeat within the batch are only normalized once.
+def normalize_phones(phonenumbers):
+    results = []
+    append = results.append
+    done = {}
+    for phonenumber in phonenumbers:
+        try:
+            result = done[phonenumber]
+        except KeyError:
+            result = done[phonenumber] = update_phonenumber(phonenumber)
+        # a fresh list for every number that could not be normalized
+        append(result or [])
+    return results
 
 # Check the tranformed phone numbers
 def check_phone(phonenumbers):
@@ -195,65 +293,73 @@ def check_phone(phonenumbers):
     for phonenumber in phonenumbers:
         if not phonenumber:
             continue
-        if re.match('\+49[^0][0-9]+', phonenumber):
-            number_type['+49_PATTERN'] += 1
-        elif re.match('0049(30|33|34|35|800|180|17|15|16)[0-9]+', phonenumber):
-            number_type['0049_PATTERN'] += 1
-        elif re.match('49(30|33|34|35|800|180|17|15|16)[0-9]+', phonenumber):
-            number_type['ERROR'] += 1
-            print ("ERROR", phonenumber)
-        elif re.match('0(30|33|34|35|800|180|17|15|16)[0-9]+', phonenumber):
-            number_type['no_country'] += 1
-        elif re.match('\+490(30|33|34|35|800|180|17|15|16)[0-9]+', phonenumber):
-            number_type['ERROR'] += 1
-            print ("ERROR", phonenumber)
-        else:
+        m = phone_check_types.match(phonenumber)
+        if m is None:
             number_type[phonenumber] += 1
-            #print elem.tag
-            # for t in elem.iter('tag'):
-            #    print (t.attrib['k'], t.attrib['v'])
+            continue
+        kind = PHONE_CHECK_TYPES[m.lastgroup]
+        number_type[kind] += 1
+        if kind == 'ERROR':
+            print ("ERROR", phonenumber)
     print sorted(number_type.items(), key=operator.itemgetter(1), reverse=True)
 
 # Audit the different ways of specifying house numbers
-def audit_housenumber(osmfile):
-    osm_file = open(osmfile, "r")
-    number_type = defaultdict(int)
-    housenumbers = []
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-         if elem.tag == "way" or elem.tag == "node":
-             for tag in elem.iter("tag"):
-                if tag.attrib['k'] == 'addr:housenumber':
-                    housenumber = tag.attrib['v']
-                    housenumbers.append(housenumber)
-                    housenumber = housenumber.replace(' ','')
-                    if re.match('[0-9]+$', housenumber):
-                        number_type['no_letter'] += 1
-                    elif re.match('[0-9]+[a-z]+', housenumber):
-                        number_type['small_letter'] += 1
-                    elif re.match('[0-9]+[A-Z]+', housenumber):
-                        number_type['big_letter'] += 1
-                    elif re.match('[0-9]+\-[0-9]+', housenumber):
-                        number_type['hyphen'] += 1
-                    elif re.match('[0-9]+\/[0-9]+', housenumber):
-                         number_type['slash'] += 1
-                        #print elem.tag
-                        #for t in elem.iter('tag'):
-                        #    print (t.attrib['k'], t.attrib['v'])
-
-                    elif re.match('[0-9]+\,[0-9]+', housenumber):
-                        number_type['comma'] += 1
-                    elif re.match('[0-9]+\;[0-9]+', housenumber):
-                        number_type['semicolon'] += 1
-
-                    else:
-                        number_type[housenumber] += 1
-                        #print elem.tag
-                        #for t in elem.iter('tag'):
-                        #    print (t.attrib['k'], t.attrib['v'])
+class HousenumberAudit(object):
+    def __init__(self):
+        self.number_type = defaultdict(int)
+        self.housenumbers = []
+
+    def register(self, audit_pass):
+        audit_pass.on_tag('addr:housenumber', self.tag)
+
+    def tag(self, elem, housenumber):
+        number_type = self.number_type
+        self.housenumbers.append(housenumber)
+        housenumber = housenumber.replace(' ','')
+        if re.match('[0-9]+$', housenumber):
+            number_type['no_letter'] += 1
+        elif re.match('[0-9]+[a-z]+', housenumber):
+            number_type['small_letter'] += 1
+        elif re.match('[0-9]+[A-Z]+', housenumber):
+            number_type['big_letter'] += 1
+        elif re.match('[0-9]+\-[0-9]+', housenumber):
+            number_type['hyphen'] += 1
+        elif re.match('[0-9]+\/[0-9]+', housenumber):
+            number_type['slash'] += 1
+        elif re.match('[0-9]+\,[0-9]+', housenumber):
+            number_type['comma'] += 1
+        elif re.match('[0-9]+\;[0-9]+', housenumber):
+            number_type['semicolon'] += 1
+        else:
+            number_type[housenumber] += 1
 
-    print sorted(number_type.items(), key=operator.itemgetter(1), reverse=True)
-    return housenumbers
+    def report(self):
+        print sorted(self.number_type.items(), key=operator.itemgetter(1), reverse=True)
+
+    def result(self):
+        return self.housenumbers
 
+def audit_housenumber(osmfile):
+    auditor = HousenumberAudit()
+    run_audits(osmfile, [auditor])
+    auditor.report()
+    return auditor.result()
+
+# Runs all of the above audits in one pass over the file
+def audit_all(osmfile, workers=1):
+    housenumbers = HousenumberAudit()
+    phones = PhoneAudit()
+    misspelled = MisspelledAudit()
+    keys = KeysAudit()
+    run_audits(osmfile, [housenumbers, phones, misspelled, keys], workers)
+    housenumbers.report()
+    phones.report()
+    return {
+        'housenumbers': housenumbers.result(),
+        'phonenumbers': phones.result(),
+        'misspelled': misspelled.result(),
+        'keys': keys.result()
+    }
 
 # Transform the house numbers to a common pattern:
 def update_housenumber(housenumber):
@@ -263,12 +369,13 @@ def update_housenumber(housenumber):
     # transform string lists to actual lists in python
     housenumber = housenumber.replace(';',',')
     housenumber = housenumber.replace('+',',')
-    # hyphens: transform e.g. 4-6 into [4,5,6]
+    # hyphens: transform e.g. 4-6 into [{'from': 4, 'to': 6}], see housenumbers.py
     m = re.match(r'([0-9]+)\-([0-9]+)', housenumber)
     if m:
-        housenumber = range(int(m.group(1)),int(m.group(2))+1)
-        housenumber = [str(i) for i in housenumber]
-        return housenumber
+        first, last = int(m.group(1)), int(m.group(2))
+        if first > last:
+            return []
+        return [housenumbers.number_range(first, last)]
     if not re.match(r'([A-Z][0-9]+|[0-9]+($|[A-Z]|[-/,][0-9]+\s*))', housenumber):
         #print housenumber
         return []
@@ -282,7 +389,7 @@ def update_housenumber(housenumber):
 def check_housenumber(housenumbers):
     number_type = defaultdict(int)
     for number in housenumbers:
-        for n in number:
+        for n in expand_housenumbers(number):
             if re.match('[0-9]+$', n):
                 number_type['no_letter'] += 1
             elif re.match('[0-9]+[a-z]+', n):
@@ -303,6 +410,129 @@ def check_housenumber(housenumbers):
     print sorted(number_type.items(), key=operator.itemgetter(1), reverse=True)
 
 
+####################################################################
+# Memoizing cache for the update_* normalizers
+#
+# Street names, phone numbers and house numbers repeat a lot in real data, so
+# the normalizers can be put behind a bounded LRU cache. Cached lists are kept
+# as tuples and handed out as fresh lists, so callers can't modify the cache
+# through a result. The same goes for the house number range dicts in them,
+# which are kept as frozensets of their items.
+
+def freeze(result):
+    if isinstance(result, list):
+        return tuple(frozenset(item.items()) if isinstance(item, dict) else item for item in result)
+    return result
+
+def thaw(result):
+    if isinstance(result, tuple):
+        return [dict(item) if isinstance(item, frozenset) else item for item in result]
+    return result
+
+class CachedNormalizer(object):
+    def __init__(self, normalizer, maxsize):
+        self.normalizer = normalizer
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.miss_time = 0.0
+
+    def __call__(self, value):
+        cache = self.cache
+        try:
+            result = cache.pop(value)
+            self.hits += 1
+        except KeyError:
+            start = timer()
+            result = self.normalizer(value)
+            self.miss_time += timer() - start
+            self.misses += 1
+            result = freeze(result)
+            if len(cache) >= self.maxsize:
+                cache.popitem(last=False)
+                self.evictions += 1
+        # re-inserting moves the entry to the most recently used end
+        cache[value] = result
+        return thaw(result)
+
+    # Estimated time saved: every hit would have cost an average miss
+    def time_saved(self):
+        if not self.misses:
+            return 0.0
+        return self.hits * self.miss_time / self.misses
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / calls if calls else 0.0,
+            'time_saved': self.time_saved()
+        }
+
+    # Adds the counters of another cache for the same normalizer, e.g. one
+    # used by a worker process
+    def merge_stats(self, stats):
+        self.hits += stats['hits']
+        self.misses += stats['misses']
+        self.evictions += stats['evictions']
+        self.miss_time += stats['miss_time']
+
+    # Entries and counters, to pick up where a checkpointed run left off
+    def state(self):
+        return {'entries': self.cache.items(), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'miss_time': self.miss_time}
+
+    def restore(self, state):
+        self.cache = OrderedDict(state['entries'])
+        self.hits = state['hits']
+        self.misses = state['misses']
+        self.evictions = state['evictions']
+        self.miss_time = state['miss_time']
+
+
+# Drop-in replacement for this module in data.shape_element, with each of the
+# normalizers wrapped in its own cache
+class CachedNormalizers(object):
+    names = ('update_name', 'update_phonenumber', 'update_housenumber')
+
+    def __init__(self, maxsize=100000):
+        for name in self.names:
+            setattr(self, name, CachedNormalizer(globals()[name], maxsize))
+
+    def stats(self):
+        return dict((name, getattr(self, name).stats()) for name in self.names)
+
+    # Raw counters, as needed by merge_stats
+    def counters(self):
+        counters = {}
+        for name in self.names:
+            normalizer = getattr(self, name)
+            counters[name] = {'hits': normalizer.hits, 'misses': normalizer.misses,
+                              'evictions': normalizer.evictions, 'miss_time': normalizer.miss_time}
+        return counters
+
+    def merge_stats(self, counters):
+        for name in self.names:
+            getattr(self, name).merge_stats(counters[name])
+
+    # State of all caches, see checkpoint.py
+    def state(self):
+        return dict((name, getattr(self, name).state()) for name in self.names)
+
+    def restore(self, state):
+        for name in self.names:
+            getattr(self, name).restore(state[name])
+
+    def report(self):
+        for name, stats in sorted(self.stats().items()):
+            print "{0}: {1[hits]} hits, {1[misses]} misses, {1[evictions]} evictions, " \
+                  "hit rate {1[hit_rate]:.1%}, {1[time_saved]:.3f}s saved".format(name, stats)
+
+
 def test():
 
     # Testing just some regular expressions
@@ -321,29 +551,80 @@ def test():
     assert wrong_spelling.search(street_name).group() == 'Chausee'
     street_name = 'Xyz Chaussee'
     assert wrong_spelling.search(street_name) is None
+    assert update_name('Potsdamer Chausee') == 'Potsdamer Chaussee'
+    streetrules.test()
+
+    # ranges stay ranges, however long they are
+    assert update_housenumber('1 - 99999') == [{'from': 1, 'to': 99999}]
+    assert update_housenumber('20-18') == []
+    housenumbers.test()
 
     housenumber = '248'
     assert re.match('[0-9]+', housenumber) != None
     housenumber = '248g'
     assert re.match(r'[0-9]+[a-z]+', housenumber) != None
 
-    # Run audit, transformation and transformation validation for housenumbers
-    numbers = audit_housenumber(OSMFILE)
+    # Phone numbers, one by one and as a batch
+    phones = [
+        ('+49 30 1234567', '+49301234567'),
+        ('030/123456', '+4930123456'),
+        ('0049 (0)30 12345', '+493012345'),
+        ('(030) 123-456', '+4930123456'),
+        ('Telefon: 030 9999', '+49309999'),
+        ('+49+49 30 111', '+4930111'),
+        ('49301234', '+49301234'),
+        ('0171 5555', '+491715555'),
+        ('+49 (0) 171-555 55', '+4917155555'),
+        ('00490301234', '+49301234'),
+        ('( 0 )30 1', []),
+        ('+4930 1 2', '+493012'),
+        ('n/a', []),
+        ('+49 30 12 ext. 5', '+493012ext.5'),
+        (u'030 12 34 \xe4', u'+49301234')
+    ]
+    for phonenumber, expected_number in phones:
+        assert update_phonenumber(phonenumber) == expected_number
+    normalized = normalize_phones([phonenumber for phonenumber, _ in phones] * 2)
+    assert normalized == [expected_number for _, expected_number in phones] * 2
+    normalized[-3].append('changed')
+    assert normalized[10] == []
+
+    # The cached normalizers have to return the same results as the plain ones
+    cached = CachedNormalizers(maxsize=2)
+    for n in ['4-6', '4-6', '12a', '4-6', '12;14', '12a']:
+        numbers = cached.update_housenumber(n)
+        assert numbers == update_housenumber(n)
+        numbers.append('changed')
+    assert cached.update_housenumber('4-6') == [{'from': 4, 'to': 6}]
+    assert cached.update_phonenumber('030 123456') == update_phonenumber('030 123456')
+    assert cached.update_name('Xyz Chausee') == 'Xyz Chaussee'
+    assert cached.update_housenumber.hits == 2
+    assert cached.update_housenumber.evictions == 3
+    cached.update_housenumber('4-6')[0]['to'] = 999
+    assert cached.update_housenumber('4-6') == [{'from': 4, 'to': 6}]
+
+
+    if not os.path.exists(OSMFILE):
+        print "{0} is not there, skipping the audits of it".format(OSMFILE)
+        return
+
+    # Run all audits in a single pass over the file
+    results = audit_all(OSMFILE)
+
+    # Transformation and transformation validation for housenumbers
     numbers_updated = []
-    for n in numbers:
+    for n in results['housenumbers']:
         numbers_updated.append(update_housenumber(n))
     check_housenumber(numbers_updated)
 
-    # Run audit, transformation and transformation validation for phonenumbers
-    numbers = audit_phone(OSMFILE)
+    # Transformation and transformation validation for phonenumbers
     numbers_updated = []
-    for n in numbers:
+    for n in results['phonenumbers']:
         numbers_updated.append(update_phonenumber(n))
     check_phone(numbers_updated)
 
-    # Run audit and transformation for misspelled street names
-    misspelled = find_misspelled(OSMFILE)
-    for st_type, ways in misspelled.iteritems():
+    # Transformation for misspelled street names
+    for st_type, ways in results['misspelled'].iteritems():
         for name in ways:
             better_name = update_name(name)
             print name, "=>", better_name
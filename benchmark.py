@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the wrangling pipeline on synthetic OSM data.
+
+generate() writes a reproducible OSM XML file: the same size, tag mix and
+seed always give the same bytes. The tags come with the problems the audits
+look for, messy phone numbers, house number ranges and lists and misspelled
+"Chausee" street names.
+
+Every benchmark runs in a fresh interpreter, so the peak RSS recorded with it
+belongs to that benchmark alone. The results go to a JSON file, compare()
+shows the changes between two of them:
+
+    python benchmark.py --nodes 100000 --output before.json
+    ... change something ...
+    python benchmark.py --nodes 100000 --output after.json --compare before.json
+"""
+from collections import OrderedDict
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import math
+import time
+import xml.etree.cElementTree as ET
+from timeit import default_timer as timer
+from xml.sax.saxutils import quoteattr
+import audit
+import data
+import geofence
+import osmio
+
+# Share of nodes carrying each group of tags, and ways per node
+MIX = {
+    'address': 0.4,
+    'phone': 0.2,
+    'amenity': 0.2,
+    'country': 0.04,
+    'ways': 0.2
+}
+
+STREETS = [u'Hauptstraße', u'Karl-Marx-Allee', u'Heerstr.', u'Potsdamer Chausee', u'Alt-Moabit',
+           u'Am Park', u'Seeweg', u'Berliner Chausse', u'Chauseestraße', u'Unter den Linden']
+PHONES = ['+49 30 1234567', '030/123456', '0049 (0)30 12345', '(030) 123-456', 'Telefon: 030 9999',
+          '+49+49 30 111', '49301234', '0171 5555', '+49 (0) 171-555 55', '00490301234', 'n/a', '+4930 1 2']
+HOUSENUMBERS = ['12', '4-6', '12a', '3B', '1;3', '7+9', '1/2', '20-18', '5 c', '2-40', '10,12', 'x']
+POSTCODES = ['10115', '12345', '14999', '16000', 'abc']
+AMENITIES = ['cafe', 'bar', 'school', 'restaurant', 'pharmacy']
+
+
+# Writes a synthetic OSM file with the given number of nodes, nodes * ways
+# ways and one relation. mix overrides entries of MIX.
+def generate(file_out, nodes, seed=1, mix=None):
+    rand = random.Random(seed)
+    shares = dict(MIX, **(mix or {}))
+    with open(file_out, 'w') as fo:
+        fo.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark.py">\n')
+        fo.write(' <bounds minlat="52.3" minlon="13.0" maxlat="52.7" maxlon="13.8"/>\n')
+        for i in xrange(1, nodes + 1):
+            tags = []
+            if rand.random() < shares['address']:
+                tags.append(('addr:street', rand.choice(STREETS)))
+                tags.append(('addr:housenumber', rand.choice(HOUSENUMBERS)))
+                tags.append(('addr:postcode', rand.choice(POSTCODES)))
+                if rand.random() < shares['country'] / shares['address']:
+                    tags.append(('addr:country', rand.choice(['DE', 'DE', 'PL'])))
+            if rand.random() < shares['phone']:
+                tags.append(('phone', rand.choice(PHONES)))
+            if rand.random() < shares['amenity']:
+                tags.append(('amenity', rand.choice(AMENITIES)))
+                tags.append(('name:en', u'Café "Zur Post" & Co'))
+                tags.append(('opening hours', 'Mo-Fr'))
+            fo.write('  <node id="{0}" visible="true" version="{1}" changeset="{2}" timestamp="2014-01-0{3}T10:00:00Z" '
+                     'user="u{4}" uid="{4}" lat="{5:.7f}" lon="{6:.7f}"'.format(
+                         i, rand.randint(1, 5), 1000 + i, 1 + i % 9, i % 50,
+                         52.3 + rand.random() * 0.4, 13.0 + rand.random() * 0.8))
+            write_tags(fo, 'node', tags)
+        for i in xrange(1, int(nodes * shares['ways']) + 1):
+            fo.write('  <way id="{0}" version="1" changeset="9" timestamp="2014-01-01T10:00:00Z" user="w" uid="3">\n'
+                     .format(i))
+            for _ in xrange(rand.randint(2, 8)):
+                fo.write('   <nd ref="{0}"/>\n'.format(rand.randint(1, nodes)))
+            tags = [('highway', 'residential')]
+            if i % 2:
+                tags.append(('addr:street', rand.choice(STREETS)))
+            for k, v in tags:
+                fo.write('   <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v).encode('utf-8')))
+            fo.write('  </way>\n')
+        fo.write('  <relation id="1" version="1">\n   <member type="way" ref="1" role=""/>\n'
+                 '   <tag k="type" v="multipolygon"/>\n  </relation>\n</osm>\n')
+
+# A jagged ring of (lon, lat) pairs around the middle of the generated area,
+# standing in for a city boundary with the given number of vertices
+def boundary(vertices=2000, seed=1):
+    rand = random.Random(seed)
+    ring = []
+    for i in xrange(vertices):
+        angle = 2 * math.pi * i / vertices
+        radius = 0.15 * (1 + 0.2 * rand.random())
+        ring.append((13.4 + 1.6 * radius * math.cos(angle), 52.5 + radius * math.sin(angle)))
+    return ring
+
+def write_tags(fo, tag, tags):
+    if not tags:
+        fo.write('/>\n')
+        return
+    fo.write('>\n')
+    for k, v in tags:
+        fo.write('   <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v).encode('utf-8')))
+    fo.write('  </{0}>\n'.format(tag))
+
+
+####################################################################
+# Benchmarks. Each one takes the input file and returns the number of
+# items it handled and the seconds that took, setup not included.
+
+def count_elements(osm_file):
+    return sum(1 for _ in osmio.iter_elements(osm_file))
+
+def tag_values(osm_file, key):
+    return [tag.attrib['v'] for elem in osmio.iter_elements(osm_file)
+            for tag in elem.iter('tag') if tag.attrib['k'] == key]
+
+# The elements are parsed up front, so the peak RSS of this one is mostly the
+# parsed tree
+def bench_shape_element(osm_file):
+    elements = [elem for elem in ET.parse(osm_file).getroot() if elem.tag in ('node', 'way')]
+    start = timer()
+    for elem in elements:
+        data.shape_element(elem)
+    return len(elements), timer() - start
+
+def bench_process_map(osm_file, **options):
+    count = count_elements(osm_file)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        start = timer()
+        data.process_map(osm_file, file_out=os.path.join(tmpdir, 'out.json'), **options)
+        return count, timer() - start
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_normalizer(normalizer, key):
+    def bench(osm_file):
+        values = tag_values(osm_file, key)
+        start = timer()
+        for value in values:
+            normalizer(value)
+        return len(values), timer() - start
+    return bench
+
+def bench_batch(normalizer, key):
+    def bench(osm_file):
+        values = tag_values(osm_file, key)
+        start = timer()
+        normalizer(values)
+        return len(values), timer() - start
+    return bench
+
+# Points tested by the geofence, all node positions of the file a number of
+# times over
+def bench_geofence(osm_file, repeat=20):
+    fence = geofence.Geofence([boundary()])
+    positions = [(float(elem.attrib['lat']), float(elem.attrib['lon']))
+                 for elem in osmio.iter_elements(osm_file) if elem.tag == 'node']
+    lats = [lat for lat, _ in positions]
+    lons = [lon for _, lon in positions]
+    start = timer()
+    for _ in xrange(repeat):
+        fence.contains_many(lats, lons)
+    return len(positions) * repeat, timer() - start
+
+def bench_audit(*auditors):
+    def bench(osm_file):
+        count = count_elements(osm_file)
+        start = timer()
+        audit.run_audits(osm_file, [auditor() for auditor in auditors])
+        return count, timer() - start
+    return bench
+
+# name -> (benchmark, what it counts)
+BENCHMARKS = OrderedDict([
+    ('shape_element', (bench_shape_element, 'elements')),
+    ('process_map', (bench_process_map, 'elements')),
+    ('process_map_expat', (lambda osm_file: bench_process_map(osm_file, engine='expat'), 'elements')),
+    ('process_map_geofence', (lambda osm_file: bench_process_map(osm_file, geometry=True, tag_filter=False,
+                                                                 geofence=geofence.Geofence([boundary()])),
+                              'elements')),
+    ('geofence', (bench_geofence, 'points')),
+    ('process_map_dedup', (lambda osm_file: bench_process_map(osm_file, dedup=True), 'elements')),
+    ('update_name', (bench_normalizer(audit.update_name, 'addr:street'), 'values')),
+    ('update_phonenumber', (bench_normalizer(audit.update_phonenumber, 'phone'), 'values')),
+    ('update_housenumber', (bench_normalizer(audit.update_housenumber, 'addr:housenumber'), 'values')),
+    ('normalize_phones', (bench_batch(audit.normalize_phones, 'phone'), 'values')),
+    ('audit_keys', (bench_audit(audit.KeysAudit), 'elements')),
+    ('audit_misspelled', (bench_audit(audit.MisspelledAudit), 'elements')),
+    ('audit_phone', (bench_audit(audit.PhoneAudit), 'elements')),
+    ('audit_housenumber', (bench_audit(audit.HousenumberAudit), 'elements')),
+    ('audit_all', (bench_audit(audit.KeysAudit, audit.MisspelledAudit, audit.PhoneAudit, audit.HousenumberAudit),
+                   'elements')),
+])
+
+
+# Peak RSS of this process in kB on Linux (bytes on macOS), as reported by
+# getrusage. None where there is no resource module, e.g. on Windows.
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Runs one benchmark in this process and returns its result
+def run_one(name, osm_file):
+    bench, unit = BENCHMARKS[name]
+    count, seconds = bench(osm_file)
+    return {
+        'count': count,
+        'unit': unit,
+        'seconds': seconds,
+        'per_second': count / seconds if seconds else None,
+        'peak_rss': peak_rss()
+    }
+
+# Runs the benchmarks, each in a fresh interpreter
+def run(osm_file, names=None):
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', name, osm_file],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        results[name] = json.loads(output.splitlines()[-1])
+        print "{0:20} {1[count]:8} {1[unit]:8} {1[seconds]:7.2f}s {1[per_second]:10.0f}/s {2:>8} kB".format(
+            name, results[name], results[name]['peak_rss'] or 'n/a')
+    return results
+
+def save(file_out, results, **meta):
+    meta.update(python=platform.python_version(), platform=platform.platform(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(file_out, 'w') as fo:
+        json.dump({'meta': meta, 'results': results}, fo, indent=2)
+
+# Prints the change of every benchmark between two results files and returns
+# the names of those that got slower by more than tolerance
+def compare(old_file, new_file, tolerance=0.1):
+    with open(old_file) as fi:
+        old = json.load(fi)['results']
+    with open(new_file) as fi:
+        new = json.load(fi, object_pairs_hook=OrderedDict)['results']
+    regressions = []
+    for name in new:
+        if name not in old or not old[name]['per_second'] or not new[name]['per_second']:
+            continue
+        speed = new[name]['per_second'] / old[name]['per_second'] - 1
+        if old[name]['peak_rss'] and new[name]['peak_rss']:
+            memory = "{0:+7.1%}".format(float(new[name]['peak_rss']) / old[name]['peak_rss'] - 1)
+        else:
+            memory = "    n/a"
+        flag = ''
+        if speed < -tolerance:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print "{0:20} speed {1:+7.1%} peak RSS {2}{3}".format(name, speed, memory, flag)
+    return regressions
+
+
+def test():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        first = os.path.join(tmpdir, 'first.osm')
+        second = os.path.join(tmpdir, 'second.osm')
+        generate(first, 500, seed=7)
+        generate(second, 500, seed=7)
+        with open(first) as fi, open(second) as fi2:
+            assert fi.read() == fi2.read()
+        generate(second, 500, seed=8, mix={'ways': 0})
+        assert count_elements(first) == 600 and count_elements(second) == 500
+
+        misspelled = audit.find_misspelled(first)
+        assert set(misspelled) == set(['Chausee', 'Chausse'])
+        assert any('-' in number for number in tag_values(first, 'addr:housenumber'))
+
+        results = run(first, ['shape_element', 'update_phonenumber', 'audit_all'])
+        assert results['shape_element']['count'] == 600
+        assert results['audit_all']['peak_rss'] > 0
+        save(os.path.join(tmpdir, 'results.json'), results, nodes=500, seed=7)
+        assert compare(os.path.join(tmpdir, 'results.json'), os.path.join(tmpdir, 'results.json')) == []
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the wrangling pipeline')
+    parser.add_argument('--nodes', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--input', help='OSM file to use instead of a generated one')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--only', nargs='*', choices=BENCHMARKS.keys())
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--test', action='store_true')
+    args, rest = parser.parse_known_args()
+    if args.run:
+        print json.dumps(run_one(args.run, rest[0]))
+    elif args.test:
+        test()
+    else:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            osm_file = args.input
+            if osm_file is None:
+                osm_file = os.path.join(tmpdir, 'synthetic.osm')
+                generate(osm_file, args.nodes, args.seed)
+            results = run(osm_file, args.only)
+            save(args.output, results, input=args.input, nodes=args.nodes, seed=args.seed, mix=MIX)
+            if args.compare:
+                compare(args.compare, args.output)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,232 @@
+"""
+Checkpoints for long process_map runs.
+
+With checkpoint set, process_map parses an uncompressed XML input in segments
+of about that many bytes, each of them starting at a top level element and
+read through osmio.ShardReader. After every segment the output is synced to
+disk and "<file_out>.checkpoint" records the input offset of the next
+segment, the number of lines and bytes written so far, the state of an
+audit.CachedNormalizers cache and the metrics counters. It is written to a
+temporary file first and renamed, so a crash leaves either the old or the new
+checkpoint behind, never half of one.
+
+process_map(resume=True) cuts the output back to the size in the checkpoint,
+dropping whatever was written after it, and goes on with the next segment.
+Elements are shaped independently of each other, so the output is the same
+as that of a run that was never interrupted. The checkpoint is removed when
+the run is done, resuming without one starts from the beginning.
+"""
+import cPickle as pickle
+import os
+import osmio
+
+# Input bytes between two checkpoints
+CHECKPOINT_BYTES = 64 << 20
+
+
+def path_for(file_out):
+    return file_out + ".checkpoint"
+
+# Identifies the input, a checkpoint is only used for the file it was made for
+def input_stamp(file_in):
+    stat = os.stat(file_in)
+    return {'input': os.path.abspath(file_in), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def save(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as fo:
+        pickle.dump(state, fo, pickle.HIGHEST_PROTOCOL)
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.rename(tmp, path)
+
+def load(path):
+    with open(path, 'rb') as fi:
+        return pickle.load(fi)
+
+# Byte ranges of about size bytes from offset, or from the first element, to
+# the end of the document, each of them starting at an element
+def segments(file_in, size, offset=None):
+    with open(file_in, 'rb') as osm_file:
+        end = osmio.document_end(osm_file)
+        start = osmio.next_element_start(osm_file, 0, end) if offset is None else offset
+        while start < end:
+            stop = osmio.next_element_start(osm_file, min(start + size, end), end)
+            yield start, stop
+            start = stop
+
+
+class LineCounter(object):
+    """
+    Passes the documents on to sink and counts them.
+    """
+    def __init__(self, sink, lines=0):
+        self.sink = sink
+        self.lines = lines
+
+    def add(self, key, doc):
+        self.sink.add(key, doc)
+        self.lines += 1
+
+
+class Checkpointer(object):
+    """
+    Checkpoints of a run shaping file_in into file_out, one every size bytes
+    of input. With resume set the run goes on from the last checkpoint, if
+    there is one.
+    """
+    def __init__(self, file_in, file_out, size=CHECKPOINT_BYTES, resume=False):
+        self.file_in = file_in
+        self.file_out = file_out
+        self.size = size
+        self.path = path_for(file_out)
+        self.stamp = input_stamp(file_in)
+        self.state = None
+        if resume and os.path.exists(self.path):
+            self.state = load(self.path)
+            if self.state['stamp'] != self.stamp:
+                raise ValueError("{0}: checkpoint of another input than {1}".format(self.path, file_in))
+            if not os.path.exists(file_out) or os.path.getsize(file_out) < self.state['bytes']:
+                raise ValueError("{0}: output is shorter than its checkpoint".format(file_out))
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def offset(self):
+        return self.state['offset'] if self.state else None
+
+    @property
+    def lines(self):
+        return self.state['lines'] if self.state else 0
+
+    @property
+    def bytes(self):
+        return self.state['bytes'] if self.state else 0
+
+    # Puts the cache and the metrics back into the state they had at the
+    # checkpoint
+    def restore(self, normalizers, metrics=None):
+        if not self.state:
+            return
+        if self.state['cache'] is not None and hasattr(normalizers, 'restore'):
+            normalizers.restore(self.state['cache'])
+        if metrics is not None:
+            # the run that wrote the checkpoint may not have had metrics
+            if self.state['metrics'] is not None:
+                metrics.merge(self.state['metrics'])
+            metrics.advance(self.state['offset'])
+
+    def open_output(self):
+        if self.state:
+            return osmio.reopen_output(self.file_out, self.state['bytes'])
+        return osmio.open_output(self.file_out)
+
+    def segments(self):
+        return segments(self.file_in, self.size, self.offset)
+
+    # Records that the input up to offset is in the output fo, which has
+    # lines lines by now. offsets is the osmio.OffsetIndex of the run, if any.
+    def save(self, fo, offset, lines, normalizers, metrics=None, offsets=None):
+        if offsets is not None:
+            offsets.sync()
+        self.state = {
+            'stamp': self.stamp,
+            'offset': offset,
+            'lines': lines,
+            'bytes': fo.sync(),
+            'cache': normalizers.state() if hasattr(normalizers, 'state') else None,
+            'metrics': metrics.counters() if metrics is not None else None
+        }
+        save(self.path, self.state)
+
+    def done(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def test():
+    import json
+    import shutil
+    import signal
+    import subprocess
+    import sys
+    import tempfile
+    import time
+    import audit
+    import data
+    import metrics
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        data.write_synthetic_osm(file_in, 20000)
+        expected_out = os.path.join(tmpdir, "expected.json")
+        expected_cache = audit.CachedNormalizers()
+        data.process_map(file_in, file_out=expected_out, cache=expected_cache)
+        with open(expected_out, 'rb') as fi:
+            expected = fi.read()
+        size = os.path.getsize(file_in)
+        bounds = list(segments(file_in, size // 10))
+        assert 10 <= len(bounds) <= 11 and bounds[-1][1] < size
+        assert all(a[1] == b[0] for a, b in zip(bounds, bounds[1:]))
+
+        # checkpoints alone don't change the output
+        file_out = os.path.join(tmpdir, "checkpointed.json")
+        data.process_map(file_in, file_out=file_out, checkpoint=size // 10)
+        with open(file_out, 'rb') as fi:
+            assert fi.read() == expected
+        assert not os.path.exists(path_for(file_out))
+
+        # a run killed partway through and resumed
+        file_out = os.path.join(tmpdir, "resumed.json")
+        script = ("import sys; sys.path.insert(0, {0!r}); import audit, data; "
+                  "data.process_map({1!r}, file_out={2!r}, checkpoint={3}, index=True, "
+                  "cache=audit.CachedNormalizers())").format(
+            os.path.dirname(os.path.abspath(__file__)), file_in, file_out, size // 20)
+        process = subprocess.Popen([sys.executable, '-c', script])
+        while not os.path.exists(path_for(file_out)):
+            assert process.poll() is None, "the run ended before its first checkpoint"
+            time.sleep(0.005)
+        assert process.poll() is None, "the run ended before it could be killed"
+        os.kill(process.pid, signal.SIGKILL)
+        process.wait()
+        state = load(path_for(file_out))
+        assert 0 < state['lines'] < expected.count("\n")
+        assert expected[:state['bytes']].count("\n") == state['lines']
+        # a line torn in the middle of a write
+        with open(file_out, 'ab') as fo:
+            fo.write('{"id": "12')
+        # the killed run had no metrics, the resumed one counts what it wrote
+        cache = audit.CachedNormalizers()
+        run_metrics = metrics.Metrics(report_interval=None)
+        data.process_map(file_in, file_out=file_out, checkpoint=size // 20, index=True, cache=cache, resume=True,
+                         metrics=run_metrics)
+        with open(file_out, 'rb') as fi:
+            assert fi.read() == expected
+        assert run_metrics.elements_out == expected.count("\n") - state['lines']
+        with open(file_out + ".metrics.json") as fi:
+            summary = json.load(fi)
+        assert summary['bytes'] == bounds[-1][1]
+        assert not os.path.exists(path_for(file_out))
+        assert cache.counters()['update_name']['misses'] == expected_cache.counters()['update_name']['misses']
+        assert cache.counters()['update_name']['hits'] == expected_cache.counters()['update_name']['hits']
+        offsets = osmio.OffsetIndex(file_out + ".idx", 'r')
+        try:
+            offset = 0
+            for line in expected.splitlines(True):
+                doc = json.loads(line)
+                assert offsets["{0}/{1}".format(doc['type'], doc['id'])] == (offset, len(line))
+                offset += len(line)
+        finally:
+            offsets.close()
+
+        # resuming without a checkpoint starts over
+        data.process_map(file_in, file_out=file_out, checkpoint=size // 20, resume=True)
+        with open(file_out, 'rb') as fi:
+            assert fi.read() == expected
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar copy of the shaped documents for analytics.
+
+ColumnarSink writes one NumPy .npy file per column into a directory:
+
+    id, version, changeset, uid   64 bit integers, -1 if missing
+    type                          8 bit code, index into TYPES
+    lat, lon                      doubles, NaN for ways (their pos is a
+                                  [0.0, 0.0] placeholder)
+    user, amenity, street,        32 bit codes into the value lists kept in
+    postcode                      meta.json, -1 if missing
+
+The rows are in the order of the JSON output. The files are written with the
+array module, so numpy is only needed to read them: Dataset memory-maps every
+column, and counts over the whole file run as numpy operations instead of
+parsing every JSON line again.
+"""
+from array import array
+import json
+import numbers
+import os
+import struct
+import sys
+import osmio
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TYPES = ('node', 'way')
+
+# name, array typecode. 'q' columns are 64 bit integers, kept in an
+# osmio.INT64 array until they are written.
+NUMBERS = [('id', 'q'), ('type', 'B'), ('lat', 'd'), ('lon', 'd'),
+           ('version', 'q'), ('changeset', 'q'), ('uid', 'q')]
+
+# name, path of the value in a shaped document
+STRINGS = [('user', ('created', 'user')), ('amenity', ('amenity',)),
+           ('street', ('address', 'street')), ('postcode', ('address', 'postcode'))]
+
+# Number of rows collected before they are appended to the column files
+FLUSH_ROWS = 1 << 16
+
+# Size of the .npy header. It is written again with the final row count when
+# the sink is closed, so it has to have room for the largest one.
+HEADER_SIZE = 128
+
+MAGIC = '\x93NUMPY\x01\x00'
+
+
+# numpy type description of an array typecode, e.g. 'q' -> '<i8'
+def descr(typecode):
+    size = 8 if typecode == 'q' else array(typecode).itemsize
+    if size == 1:
+        return '|u1' if typecode == 'B' else '|i1'
+    kind = 'f' if typecode in 'fd' else 'u' if typecode in 'BHIL' else 'i'
+    return '{0}{1}{2}'.format('<' if sys.byteorder == 'little' else '>', kind, size)
+
+def npy_header(typecode, rows):
+    header = "{{'descr': '{0}', 'fortran_order': False, 'shape': ({1},), }}".format(descr(typecode), rows)
+    size = HEADER_SIZE - len(MAGIC) - 2
+    return MAGIC + struct.pack('<H', size) + header.ljust(size - 1) + '\n'
+
+def new_buffer(typecode):
+    return array(osmio.INT64 if typecode == 'q' else typecode)
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+def lookup(doc, path):
+    for key in path:
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+class ColumnarSink(object):
+    """
+    Sink for process_map writing the columns described above into the
+    directory path.
+    """
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.rows = 0
+        self.typecodes = dict(NUMBERS)
+        self.typecodes.update((name, 'i') for name, _ in STRINGS)
+        self.buffers = {}
+        self.files = {}
+        for name, typecode in self.typecodes.items():
+            self.buffers[name] = new_buffer(typecode)
+            self.files[name] = open(os.path.join(path, name + '.npy'), 'wb')
+            self.files[name].write(npy_header(typecode, 0))
+        self.codes = dict((name, {}) for name, _ in STRINGS)
+        self.values = dict((name, []) for name, _ in STRINGS)
+
+    def add(self, key, doc):
+        buffers = self.buffers
+        created = doc.get('created') or {}
+        element_type, element_id = osmio.split_key(key)
+        buffers['id'].append(to_int(element_id))
+        element_type = TYPES.index(element_type)
+        buffers['type'].append(element_type)
+        pos = doc.get('pos')
+        if element_type == 0 and pos and len(pos) == 2 and all(isinstance(x, numbers.Real) for x in pos):
+            buffers['lat'].append(pos[0])
+            buffers['lon'].append(pos[1])
+        else:
+            buffers['lat'].append(float('nan'))
+            buffers['lon'].append(float('nan'))
+        buffers['version'].append(to_int(created.get('version')))
+        buffers['changeset'].append(to_int(created.get('changeset')))
+        buffers['uid'].append(to_int(created.get('uid')))
+        for name, path in STRINGS:
+            value = lookup(doc, path)
+            if value is None:
+                buffers[name].append(-1)
+                continue
+            codes = self.codes[name]
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(codes)
+                self.values[name].append(value)
+            buffers[name].append(code)
+        self.rows += 1
+        if self.rows % FLUSH_ROWS == 0:
+            self.flush()
+
+    def flush(self):
+        for name, buf in self.buffers.items():
+            if self.typecodes[name] == 'q':
+                osmio.write_int64(self.files[name], buf)
+            else:
+                buf.tofile(self.files[name])
+            self.buffers[name] = new_buffer(self.typecodes[name])
+
+    def close(self):
+        if self.files is None:
+            return
+        self.flush()
+        for name, fo in self.files.items():
+            fo.seek(0)
+            fo.write(npy_header(self.typecodes[name], self.rows))
+            fo.close()
+        self.files = None
+        meta = {'rows': self.rows, 'types': TYPES, 'dictionaries': self.values}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as fo:
+            json.dump(meta, fo)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Writes the columns of a JSON lines output of process_map, keys is the file
+# with the element keys of its lines, see sinks.iter_keyed
+def from_json(file_json, path, keys=None):
+    import sinks
+    with ColumnarSink(path) as sink:
+        for key, doc in sinks.iter_keyed(file_json, keys):
+            sink.add(key, doc)
+
+
+class Dataset(object):
+    """
+    The columns written by ColumnarSink, memory-mapped read only.
+    dataset['lat'] is a numpy array, decode() turns the codes of a string
+    column back into values.
+    """
+    def __init__(self, path):
+        if numpy is None:
+            raise ImportError("{0}: reading columns needs the numpy package".format(path))
+        with open(os.path.join(path, 'meta.json')) as fi:
+            meta = json.load(fi)
+        self.rows = meta['rows']
+        self.types = meta['types']
+        self.dictionaries = meta['dictionaries']
+        # an empty file region can't be mapped
+        mode = 'r' if self.rows else None
+        self.columns = {}
+        for name in [name for name, _ in NUMBERS] + [name for name, _ in STRINGS]:
+            self.columns[name] = numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def is_type(self, element_type):
+        return self['type'] == self.types.index(element_type)
+
+    def decode(self, name, codes=None):
+        values = self.dictionaries[name]
+        codes = self[name] if codes is None else codes
+        return [values[code] if code >= 0 else None for code in codes.tolist()]
+
+    # Number of rows per value of a string column, of the rows in mask if
+    # given
+    def value_counts(self, name, mask=None):
+        codes = self[name] if mask is None else self[name][mask]
+        codes = codes[codes >= 0]
+        values = self.dictionaries[name]
+        counts = numpy.bincount(codes, minlength=len(values))
+        return dict((values[code], int(counts[code])) for code in numpy.flatnonzero(counts).tolist())
+
+    # Like audit.getKeys for the columns we have: the number of nodes and of
+    # ways that have a value in each string column
+    def key_counts(self):
+        counts = []
+        for element_type in TYPES:
+            mask = self.is_type(element_type)
+            counts.append(dict((name, int(numpy.count_nonzero(self[name][mask] >= 0)))
+                               for name, _ in STRINGS))
+        return tuple(counts)
+
+
+# Prints how long counting amenities takes on the JSON lines and on the columns
+def benchmark(file_json, path):
+    from collections import Counter
+    from timeit import default_timer as timer
+    start = timer()
+    counts = Counter()
+    with open(file_json) as fi:
+        for line in fi:
+            amenity = json.loads(line).get('amenity')
+            if amenity is not None:
+                counts[amenity] += 1
+    json_time = timer() - start
+    start = timer()
+    dataset = Dataset(path)
+    assert dataset.value_counts('amenity') == counts
+    column_time = timer() - start
+    print "amenity counts: JSON lines {0:.1f}ms, columns {1:.1f}ms".format(json_time * 1000, column_time * 1000)
+
+
+XML = u"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" version="2" changeset="11" timestamp="2014-01-01T10:00:00Z" user="u" uid="7" lat="52.5200066" lon="13.404954">
+    <tag k="amenity" v="cafe"/>
+    <tag k="addr:street" v="Potsdamer Straße"/>
+    <tag k="addr:postcode" v="10785"/>
+  </node>
+  <node id="2" version="1" changeset="12" timestamp="2014-01-02T10:00:00Z" user="Müller" uid="8" lat="52.51" lon="13.38">
+    <tag k="amenity" v="cafe"/>
+  </node>
+  <node id="3" version="1" changeset="12" timestamp="2014-01-02T10:00:00Z" user="Müller" uid="8" lat="52.6" lon="13.5">
+    <tag k="amenity" v="bank"/>
+    <tag k="addr:street" v="Potsdamer Straße"/>
+  </node>
+  <node id="4" version="3" changeset="9" timestamp="2013-12-31T23:59:59Z" user="u" uid="7" lat="52.4" lon="13.3">
+    <tag k="type" v="multipolygon"/>
+  </node>
+  <way id="10" version="1" changeset="13" timestamp="2014-01-03T10:00:00Z" user="u" uid="7">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <tag k="id" v="abc"/>
+    <tag k="addr:street" v="Heerstr."/>
+    <tag k="highway" v="residential"/>
+  </way>
+</osm>
+"""
+
+
+def test():
+    import shutil
+    import tempfile
+    import data
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        xml = os.path.join(tmpdir, "test.osm")
+        with open(xml, "w") as fo:
+            fo.write(XML.encode('utf-8'))
+        for workers in (1, 2):
+            path = os.path.join(tmpdir, "columns{0}".format(workers))
+            data.process_map(xml, workers=workers, columns=path)
+            with open(xml + ".json") as fi:
+                docs = [json.loads(line) for line in fi]
+            if numpy is None:
+                print "numpy is not installed, skipping the Dataset tests"
+                return
+            dataset = Dataset(path)
+            assert len(dataset) == len(docs) == 5
+            # the type and id come from the element, not from its type and id tags
+            assert docs[3]['type'] == 'multipolygon' and docs[4]['id'] == 'abc'
+            assert dataset['id'].tolist() == [1, 2, 3, 4, 10]
+            assert dataset['type'].tolist() == [0, 0, 0, 0, 1]
+            assert dataset['lat'][:4].tolist() == [doc['pos'][0] for doc in docs[:4]]
+            assert numpy.isnan(dataset['lat'][4]) and numpy.isnan(dataset['lon'][4])
+            assert dataset['version'].tolist() == [2, 1, 1, 3, 1]
+            assert dataset.decode('user') == [doc['created']['user'] for doc in docs]
+            assert dataset.decode('street') == [u'Potsdamer Straße', None, u'Potsdamer Straße', None, u'Heerstr.']
+            assert dataset.value_counts('amenity') == {'cafe': 2, 'bank': 1}
+            assert dataset.value_counts('user', dataset.is_type('node')) == {'u': 2, u'Müller': 2}
+            assert dataset.key_counts() == ({'user': 4, 'amenity': 3, 'street': 2, 'postcode': 1},
+                                            {'user': 1, 'amenity': 0, 'street': 1, 'postcode': 0})
+
+        # ids beyond 32 bits are int64 columns, also where the sink keeps
+        # them as doubles
+        typecode = osmio.INT64
+        try:
+            for osmio.INT64 in (typecode, 'd'):
+                path = os.path.join(tmpdir, "wide_{0}".format(osmio.INT64))
+                with ColumnarSink(path) as sink:
+                    sink.add("node/12345678901", {'pos': [52.5, 13.4], 'created': {'uid': '4294967297'}})
+                    sink.add("way/2", {'created': {}})
+                dataset = Dataset(path)
+                assert dataset['id'].dtype == numpy.int64 and dataset['uid'].dtype == numpy.int64
+                assert dataset['id'].tolist() == [12345678901, 2]
+                assert dataset['uid'].tolist() == [4294967297, -1]
+        finally:
+            osmio.INT64 = typecode
+
+        # more rows than FLUSH_ROWS
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        data.write_synthetic_osm(file_in, FLUSH_ROWS + 10)
+        path = os.path.join(tmpdir, "synthetic")
+        data.process_map(file_in, columns=path)
+        dataset = Dataset(path)
+        assert dataset['id'].tolist() == range(1, FLUSH_ROWS + 11)
+        assert dataset.value_counts('postcode') == {'10115': FLUSH_ROWS + 10}
+        benchmark(file_in + ".json", path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
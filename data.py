@@ -1,11 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import xml.etree.cElementTree as ET
+import xml.parsers.expat as expat
 import pprint
 import re
-import codecs
+import functools
 import json
+import multiprocessing
+import os
+import cPickle as pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
 import audit
+import checkpoint as checkpoints
+import columnar
+import dedup as duplicates
+import geocoder
+import geofence as fences
+import metrics
+import nodestore
+import osmio
+import pbf
+import sinks
+import tiles as tile_output
 """
 Your task is to wrangle the data and transform the shape of the data
 into the model we mentioned earlier. The output should be a list of dictionaries
@@ -96,65 +116,179 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
 
+# In parallel mode the input is split into this many shards per worker, so a
+# worker that got a cheap shard can pick up another one
+SHARDS_PER_WORKER = 4
 
-def shape_element(element):
+# Number of bytes handed to the expat engine at a time
+CHUNK_SIZE = 1 << 16
+
+
+# Splits the attributes of a node or way into the top level fields, the
+# "created" dict and the position
+def shape_attributes(tag, attrib):
     node = {}
     created = {}
-    address = {}
     lat = 0.0
     lon = 0.0
+    node['type'] = tag
+    for key in attrib.keys():
+        if key in CREATED:
+            created[key] = attrib[key]
+        elif key == 'lat':
+            lat = float(attrib['lat'])
+        elif key == 'lon':
+            lon = float(attrib['lon'])
+        else:
+            node[key] = attrib[key]
+
+    node['created'] = created
+    node['pos'] = [lat, lon]
+    return node
+
+# Filter out any nodes or ways situated in Poland or with a postcode that does not belong to Berlin
+# or its near surroundings
+def is_excluded(k, v):
+    if k == 'addr:country' and v == 'PL':
+        return True
+    try:
+        if k == 'addr:postcode' and not 10115 <= int(v) < 15000:
+            return True
+    except ValueError:
+        return True
+    return False
+
+# Reasons for dropping an element, as counted by metrics.Metrics
+NOT_NODE_OR_WAY = 'not_node_or_way'
+COUNTRY_PL = 'country_pl'
+POSTCODE_OUT_OF_RANGE = 'postcode_out_of_range'
+POSTCODE_INVALID = 'postcode_invalid'
+
+# Why is_excluded(k, v) is true. Only called for excluded tags, so the check
+# itself stays as cheap as it was.
+def exclusion_reason(k, v):
+    if k == 'addr:country':
+        return COUNTRY_PL
+    try:
+        int(v)
+    except ValueError:
+        return POSTCODE_INVALID
+    return POSTCODE_OUT_OF_RANGE
+
+# Why shape_element returned None for element
+def drop_reason(element, exclude=is_excluded):
+    if element.tag != "node" and element.tag != "way":
+        return NOT_NODE_OR_WAY
+    for kv in element.findall('tag'):
+        if exclude(kv.attrib['k'], kv.attrib['v']):
+            return exclusion_reason(kv.attrib['k'], kv.attrib['v'])
+
+####################################################################
+# Tag key classification
+#
+# What happens to a tag only depends on its key, and an extract only has a few
+# thousand distinct keys next to millions of tags. KeyClassifier works out the
+# action for a key the first time it is seen and serves it from a dict after
+# that.
+
+# Actions
+DROP = 0        # problematic characters or a second colon after addr:street
+ADDRESS = 1     # goes into the "address" dict, unless empty
+FIELD = 2       # key with one colon, stored as is
+NONEMPTY = 3    # anything else, stored unless empty
+
+# Normalizers applied to the values of some of the keys
+KEY_NORMALIZERS = {
+    'addr:housenumber': 'update_housenumber',
+    'addr:street': 'update_name',
+    'phone': 'update_phonenumber'
+}
+
+class KeyClassifier(object):
+    def __init__(self):
+        self.actions = {}
+        self.lookups = 0
+
+    # Returns (action, field name, name of the normalizer or None)
+    def classify(self, k):
+        if re.search(problemchars, k):
+            return (DROP, None, None)
+        if 'addr:street:' in k:
+            return (DROP, None, None)
+        normalizer = KEY_NORMALIZERS.get(k)
+        if re.search(lower_colon, k):
+            if 'addr:' in k:
+                return (ADDRESS, k.replace('addr:', ''), normalizer)
+            return (FIELD, k, None)
+        return (NONEMPTY, k, normalizer)
+
+    def action(self, k):
+        self.lookups += 1
+        try:
+            return self.actions[k]
+        except KeyError:
+            action = self.actions[k] = self.classify(k)
+            return action
+
+    def stats(self):
+        return {
+            'distinct_keys': len(self.actions),
+            'lookups': self.lookups,
+            'cached_lookups': self.lookups - len(self.actions)
+        }
+
+    # Raw counters, as needed by merge_stats
+    def counters(self):
+        return {'keys': list(self.actions), 'lookups': self.lookups}
+
+    # Counters added since the classifier had the counters before, e.g. by
+    # a worker process with a copy of it
+    def counters_since(self, before):
+        return {'keys': list(set(self.actions) - set(before['keys'])),
+                'lookups': self.lookups - before['lookups']}
+
+    def merge_stats(self, counters):
+        for k in counters['keys']:
+            if k not in self.actions:
+                self.actions[k] = self.classify(k)
+        self.lookups += counters['lookups']
+
+    def report(self):
+        print "{0[distinct_keys]} distinct keys, {0[cached_lookups]} of {0[lookups]} lookups served from the cache".format(self.stats())
+
+# Classifier used unless another one is passed. In parallel mode process_map
+# adds what the workers counted to it, or to the one it was given.
+KEYS = KeyClassifier()
+
+
+# Adds a single tag to the shaped node or its address
+def shape_tag(node, address, k, v, normalizers=audit, classifier=KEYS):
+    action, field, normalizer = classifier.action(k)
+    if action == DROP:
+        return
+    if normalizer:
+        v = getattr(normalizers, normalizer)(v)
+    if action == ADDRESS:
+        if v:
+            address[field] = v
+    elif action == FIELD or v:
+        node[field] = v
+
+# normalizers can be audit.CachedNormalizers() to memoize the update_* functions
+# exclude decides on the tags that drop the whole element, None keeps all
+# classifier is the KeyClassifier that looks up what to do with a tag key
+def shape_element(element, normalizers=audit, exclude=is_excluded, classifier=KEYS):
+    address = {}
     if element.tag == "node" or element.tag == "way":
-        node['type'] = element.tag
-        for key in element.attrib.keys():
-            if key in CREATED:
-                created[key] = element.attrib[key]
-            elif key == 'lat':
-                lat = float(element.attrib['lat'])
-            elif key == 'lon':
-                lon = float(element.attrib['lon'])
-            else:
-                node[key] = element.attrib[key]
-            
-        node['created'] = created
-        node['pos'] = [lat, lon]
+        node = shape_attributes(element.tag, element.attrib)
 
-        # Filter out any nodes or ways situated in Poland or with a postcode that does not belong to Berlin
-        # or its near surroundings
-        for kv in element.findall('tag'):
-            if kv.attrib['k'] == 'addr:country' and kv.attrib['v'] == 'PL':
-                return None
-            try:
-                if kv.attrib['k'] == 'addr:postcode' and int(kv.attrib['v']) not in range(10115, 15000):
+        if exclude is not None:
+            for kv in element.findall('tag'):
+                if exclude(kv.attrib['k'], kv.attrib['v']):
                     return None
-            except ValueError:
-                return None
 
         for kv in element.findall('tag'):
-            if re.search(problemchars, kv.attrib['k']):
-                continue
-            if 'addr:street:' in kv.attrib['k']:
-                continue
-            if re.search(lower_colon, kv.attrib['k']):
-                if 'addr:' in kv.attrib['k']:
-                    key = re.sub(r'addr:', '', kv.attrib['k'])
-                    if kv.attrib['k'] == 'addr:housenumber':
-                        kv.attrib['v'] = audit.update_housenumber(kv.attrib['v'])
-                    if kv.attrib['k'] == 'addr:street':
-                        kv.attrib['v'] = audit.update_name(kv.attrib['v'])
-                    if kv.attrib['v']:
-                        address[key] = kv.attrib['v']
-                    else:
-                        continue
-                else:
-                    node[kv.attrib['k']] = kv.attrib['v']
-            else:
-                 #
-                 if kv.attrib['k'] == 'phone':
-                    kv.attrib['v'] = audit.update_phonenumber(kv.attrib['v'])
-                 if kv.attrib['v']:
-                    node[kv.attrib['k']] = kv.attrib['v']
-                 else:
-                     continue
+            shape_tag(node, address, kv.attrib['k'], kv.attrib['v'], normalizers, classifier)
         if address:
             node['address'] = address
         refs = []
@@ -168,20 +302,894 @@ def shape_element(element):
         return None
 
 
-def process_map(file_in, pretty = False):
-    # You do not need to change this file
-    file_out = "{0}.json".format(file_in)
-    with codecs.open(file_out, "w") as fo:
-        try:
-            for _,element in ET.iterparse(file_in):
-                el = shape_element(element)
-                if el:
-                    fo.write(json.dumps(el) + "\n")
-            element.clear()
-        except ET.ParseError:
-            pass
+####################################################################
+# Event driven engine
+#
+# Instead of building an ElementTree Element for every node and way and
+# walking its tags twice afterwards, ElementShaper builds the shaped dict
+# directly from the start/end callbacks of an expat parser. The country and
+# postcode filter is applied as soon as the tag is seen, after which the rest
+# of the element is skipped.
+#
+# It is not faster than the ElementTree engine: a Python callback per tag
+# costs about as much as cElementTree building the tree in C, and in
+# benchmark_engines expat comes out 10-15% behind. ElementShaper is what the
+# PBF reader shapes with, though.
+
+class ElementShaper(object):
+    def __init__(self, normalizers=audit, metrics=None, exclude=is_excluded, classifier=KEYS):
+        self.normalizers = normalizers
+        self.metrics = metrics
+        self.exclude = exclude
+        self.classifier = classifier
+        self.tag_name = None
+        self.attrib = None
+        self.tags = None
+        self.refs = None
+        self.excluded = False
+
+    def start(self, tag, attrib):
+        self.tag_name = tag
+        self.attrib = attrib
+        self.tags = []
+        self.refs = []
+        self.excluded = False
+
+    def tag(self, k, v):
+        if self.tag_name is None or self.excluded:
+            return
+        if self.exclude is not None and self.exclude(k, v):
+            # nothing of this element will be used any more
+            self.excluded = True
+            self.tags = self.refs = None
+            if self.metrics is not None:
+                self.metrics.drop(exclusion_reason(k, v))
+        else:
+            self.tags.append((k, v))
+
+    def nd(self, ref):
+        if self.tag_name is not None and not self.excluded:
+            self.refs.append(ref)
+
+    def end(self):
+        if self.metrics is None:
+            return self.shape()
+        start = timer()
+        node = self.shape()
+        self.metrics.add_time('shape', timer() - start)
+        return node
+
+    def shape(self):
+        tag_name = self.tag_name
+        self.tag_name = None
+        if self.excluded:
+            return None
+        node = shape_attributes(tag_name, self.attrib)
+        address = {}
+        for k, v in self.tags:
+            shape_tag(node, address, k, v, self.normalizers, self.classifier)
+        if address:
+            node['address'] = address
+        if self.refs:
+            node['node_refs'] = self.refs
+        return node
+
+
+# Identifies an element independent of what its tags did to the shaped dict
+# (a "type" or "id" tag overwrites the attribute of the same name)
+def element_key(tag, element_id):
+    return "{0}/{1}".format(tag, element_id)
+
+decode_text = osmio.decode_text
+
+# Turns an ordered expat attribute list into a dict, in document order
+def attribute_dict(attrs):
+    if osmio.non_ascii.search(''.join(attrs)):
+        attrs = [decode_text(value) for value in attrs]
+    return dict(zip(attrs[::2], attrs[1::2]))
+
+# Yields (key, shaped dict) for all nodes and ways, parsed with expat
+# With a metrics.Metrics the time spent parsing and shaping and the dropped
+# elements are recorded in it, the same goes for the other engines.
+def iter_shaped_expat(osm_file, normalizers=audit, metrics=None, exclude=is_excluded, classifier=KEYS):
+    reader = osmio.open_input(osm_file) if metrics is None else metrics.wrap_input(osm_file)
+    shaper = ElementShaper(normalizers, metrics, exclude, classifier)
+    shaped = []
+
+    def start(name, attrs):
+        if name == 'tag':
+            if len(attrs) == 4 and attrs[0] == 'k':
+                shaper.tag(decode_text(attrs[1]), decode_text(attrs[3]))
+            else:
+                attrib = attribute_dict(attrs)
+                shaper.tag(attrib['k'], attrib['v'])
+        elif name == 'nd':
+            if attrs[0] == 'ref':
+                shaper.nd(attrs[1])
+            else:
+                shaper.nd(attribute_dict(attrs)['ref'])
+        elif name == 'node' or name == 'way':
+            shaper.start(name, attribute_dict(attrs))
+
+    def end(name):
+        if name == 'node' or name == 'way':
+            el = shaper.end()
+            if el:
+                shaped.append((element_key(name, shaper.attrib.get('id')), el))
+        elif name == 'relation' and metrics is not None:
+            metrics.drop(NOT_NODE_OR_WAY)
+
+    parser = expat.ParserCreate()
+    parser.returns_unicode = False
+    parser.ordered_attributes = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    try:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            try:
+                if metrics is None:
+                    parser.Parse(chunk, not chunk)
+                else:
+                    # the callbacks shape the elements, that time is not parsing
+                    start = timer()
+                    shaping = metrics.times['shape']
+                    parser.Parse(chunk, not chunk)
+                    metrics.add_time('parse', timer() - start - (metrics.times['shape'] - shaping))
+            except expat.ExpatError as e:
+                # report it the same way as the ElementTree engine does
+                error = ET.ParseError(expat.ErrorString(e.code))
+                error.code = e.code
+                error.position = (e.lineno, e.offset)
+                raise error
+            for keyed in shaped:
+                yield keyed
+            del shaped[:]
+            if not chunk:
+                break
+    finally:
+        # a file object passed in is left to the caller
+        if reader is not osm_file:
+            reader.close()
+
+
+# Yields (key, shaped dict) for all nodes and ways, parsed with ElementTree
+def iter_shaped_etree(osm_file, normalizers=audit, metrics=None, exclude=is_excluded, classifier=KEYS):
+    if metrics is not None:
+        for keyed in iter_shaped_etree_metrics(osm_file, normalizers, metrics, exclude, classifier):
+            yield keyed
+        return
+    for element in osmio.iter_elements(osm_file):
+        el = shape_element(element, normalizers, exclude, classifier)
+        if el:
+            yield element_key(element.tag, element.attrib.get('id')), el
+
+def iter_shaped_etree_metrics(osm_file, normalizers, metrics, exclude=is_excluded, classifier=KEYS):
+    osm_file = metrics.wrap_input(osm_file)
+    try:
+        for element in metrics.timed('parse', osmio.iter_elements(osm_file, osmio.TOP_LEVEL)):
+            start = timer()
+            el = shape_element(element, normalizers, exclude, classifier)
+            metrics.add_time('shape', timer() - start)
+            if el:
+                yield element_key(element.tag, element.attrib.get('id')), el
+            else:
+                metrics.drop(drop_reason(element, exclude))
+    finally:
+        osm_file.close()
+
+# Yields (key, shaped dict) for the (tag, attrib, tags, refs) primitives of
+# a PBF file. Relations are only counted as dropped, like in iter_shaped_expat.
+def shape_primitives(primitives, shaper):
+    for tag, attrib, tags, refs in primitives:
+        if tag != 'node' and tag != 'way':
+            if shaper.metrics is not None:
+                shaper.metrics.drop(NOT_NODE_OR_WAY)
+            continue
+        shaper.start(tag, attrib)
+        for k, v in tags:
+            shaper.tag(k, v)
+        for ref in refs:
+            shaper.nd(ref)
+        el = shaper.end()
+        if el:
+            yield element_key(tag, attrib.get('id')), el
+
+# Yields (key, shaped dict) for all nodes and ways of a PBF file. With
+# workers > 1 the blocks are decoded and shaped on a pool of worker processes.
+def iter_shaped_pbf(osm_file, normalizers=audit, metrics=None, workers=1, exclude=is_excluded, classifier=KEYS):
+    if workers > 1:
+        for keyed in iter_shaped_pbf_parallel(osm_file, normalizers, metrics, workers, exclude, classifier):
+            yield keyed
+        return
+    primitives = pbf.iter_primitives(osm_file)
+    if metrics is not None:
+        primitives = metrics.timed('parse', primitives)
+    for keyed in shape_primitives(primitives, ElementShaper(normalizers, metrics, exclude, classifier)):
+        yield keyed
+
+# Normalizers, exclude and classifier of a worker shaping PBF blocks, handed
+# over once when the pool starts
+worker_shaping = None
+
+def init_pbf_worker(normalizers, exclude, classifier):
+    global worker_shaping
+    worker_shaping = (normalizers or audit, exclude, classifier)
+
+# Worker for iter_shaped_pbf_parallel: decodes and shapes one block. Returns
+# the (key, shaped dict) pairs, what the block added to the counters of the
+# cache, if the normalizers are an audit.CachedNormalizers, the metrics
+# counters of the block if measure is set and what it added to the counters
+# of the classifier.
+def shape_pbf_block(args):
+    path, offset, size, measure = args
+    normalizers, exclude, classifier = worker_shaping
+    cache = normalizers if isinstance(normalizers, audit.CachedNormalizers) else None
+    before = cache.counters() if cache else None
+    classified = classifier.counters()
+    block_metrics = None
+    if measure:
+        block_metrics = metrics.Metrics(report_interval=None)
+        normalizers = block_metrics.timed_normalizers(normalizers, KEY_NORMALIZERS.values())
+    start = timer()
+    primitives = pbf.decode_blob((path, offset, size))
+    if measure:
+        block_metrics.add_time('parse', timer() - start)
+    shaped = list(shape_primitives(primitives, ElementShaper(normalizers, block_metrics, exclude, classifier)))
+    counters = None
+    if cache:
+        counters = dict((name, dict((counter, value - before[name][counter]) for counter, value in values.items()))
+                        for name, values in cache.counters().items())
+    return shaped, counters, block_metrics.counters() if measure else None, classifier.counters_since(classified)
+
+def iter_shaped_pbf_parallel(osm_file, normalizers, run_metrics, workers, exclude, classifier=KEYS):
+    # the workers time the normalizers themselves
+    normalizers = getattr(normalizers, 'wrapped', normalizers)
+    cache = normalizers if isinstance(normalizers, audit.CachedNormalizers) else None
+    blocks = [(path, offset, size, run_metrics is not None) for path, offset, size in pbf.data_blobs(osm_file)]
+    pool = multiprocessing.Pool(workers, init_pbf_worker,
+                                (None if normalizers is audit else normalizers, exclude, classifier))
+    try:
+        for shaped, counters, block_counters, classified in pbf.imap_bounded(pool, shape_pbf_block, blocks,
+                                                                             workers * pbf.BLOCKS_IN_FLIGHT):
+            classifier.merge_stats(classified)
+            if counters:
+                cache.merge_stats(counters)
+            if block_counters:
+                run_metrics.merge(block_counters)
+            for keyed in shaped:
+                yield keyed
+        pool.close()
+    finally:
+        pool.terminate()
+
+ENGINES = {
+    'etree': iter_shaped_etree,
+    'expat': iter_shaped_expat
+}
+
+
+# Shapes all elements read from osm_file and hands them to sink.add, see
+# sinks.py. With a nodestore.NodeStore as nodes, ways get their geometry and
+# bounding box. exclude and classifier are passed on to the engine, with a
+# geofence.Geofence as geofence only the elements inside it are kept.
+def load_elements(osm_file, sink, normalizers=audit, engine='etree', nodes=None, metrics=None, exclude=is_excluded,
+                  geofence=None, classifier=KEYS):
+    shaped = engine if callable(engine) else ENGINES[engine]
+    if metrics is not None:
+        load_elements_metrics(osm_file, sink, normalizers, shaped, nodes, metrics, exclude, geofence, classifier)
+        return
+    keyed = shaped(osm_file, normalizers, exclude=exclude, classifier=classifier)
+    if nodes is not None:
+        keyed = with_geometry(keyed, nodes)
+    if geofence is not None:
+        keyed = geofence.filter(keyed)
+    for key, el in keyed:
+        sink.add(key, el)
+
+def load_elements_metrics(osm_file, sink, normalizers, shaped, nodes, metrics, exclude=is_excluded, geofence=None,
+                          classifier=KEYS):
+    normalizers = metrics.timed_normalizers(normalizers, KEY_NORMALIZERS.values())
+    keyed = shaped(osm_file, normalizers, metrics, exclude=exclude, classifier=classifier)
+    if nodes is not None:
+        keyed = with_geometry(keyed, nodes, metrics)
+    if geofence is not None:
+        keyed = geofence.filter(keyed, metrics)
+    for key, el in keyed:
+        start = timer()
+        sink.add(key, el)
+        metrics.add_time('serialize', timer() - start)
+        metrics.written()
+
+# Adds their geometry to the ways among the (key, shaped dict) pairs
+def with_geometry(keyed, nodes, metrics=None):
+    for key, el in keyed:
+        if key.startswith('way/'):
+            if metrics is None:
+                nodestore.add_geometry(el, nodes)
+            else:
+                start = timer()
+                nodestore.add_geometry(el, nodes)
+                metrics.add_time('geometry', timer() - start)
+        yield key, el
+
+# Shapes all elements read from osm_file and writes them as JSON lines to fo
+# index is called with the key, offset and length of every line written.
+def write_elements(osm_file, fo, normalizers=audit, engine='etree', nodes=None, index=None, metrics=None,
+                   exclude=is_excluded, geofence=None, classifier=KEYS):
+    load_elements(osm_file, sinks.JsonSink(fo, index), normalizers, engine, nodes, metrics, exclude, geofence,
+                  classifier)
+
+
+# Node store of a worker process, handed over once when the pool starts
+worker_nodes = None
+
+def init_worker(nodes):
+    global worker_nodes
+    worker_nodes = nodes
+
+
+# Worker for the parallel mode: shapes one byte range of file_in into its own
+# file. Returns the cache counters of the worker, if it used a cache, its
+# metrics counters if measure is set, what it added to the counters of the
+# classifier and its parse error, if any, as (message, code, position).
+# ET.ParseError itself can't be pickled. With index set the offsets of the
+# lines go to a "key offset length" text file next to the shard.
+def process_shard(args):
+    file_in, start, end, shard_out, cache, engine, index, measure, exclude, geofence, classifier = args
+    shard_metrics = metrics.Metrics(report_interval=None) if measure else None
+    classified = classifier.counters()
+    error = None
+    try:
+        with osmio.open_output(shard_out) as fo:
+            if index:
+                with open(shard_out + ".idx", "w") as fi:
+                    def add(key, offset, length):
+                        fi.write("{0} {1} {2}\n".format(key, offset, length))
+                    write_elements(osmio.ShardReader(file_in, start, end), fo, cache or audit, engine, worker_nodes,
+                                   add, shard_metrics, exclude, geofence, classifier)
+            else:
+                write_elements(osmio.ShardReader(file_in, start, end), fo, cache or audit, engine, worker_nodes,
+                               metrics=shard_metrics, exclude=exclude, geofence=geofence, classifier=classifier)
+    except ET.ParseError as e:
+        error = (str(e), getattr(e, 'code', None), e.position)
+    return (shard_out, cache.counters() if cache else None, shard_metrics.counters() if measure else None,
+            classifier.counters_since(classified), error)
+
+error_position = re.compile(r': line \d+, column \d+$')
+
+# The ET.ParseError for the error (message, code, position) of the shard of
+# file_in starting at start, with the position in file_in
+def shard_parse_error(file_in, start, message, code, position):
+    position = osmio.shard_position(file_in, start, position)
+    if error_position.search(message):
+        message = error_position.sub(": line {0[0]}, column {0[1]}".format(position), message)
+    error = ET.ParseError(message)
+    error.code = code
+    error.position = position
+    return error
+
+
+# Splits file_in into byte ranges on element boundaries, shapes them on a pool
+# of worker processes and concatenates the results in the original order
+def process_map_parallel(file_in, file_out, workers, cache=None, engine='etree', nodes=None, index=None,
+                         run_metrics=None, exclude=is_excluded, geofence=None, classifier=KEYS):
+    shards = osmio.shard_offsets(file_in, workers * SHARDS_PER_WORKER)
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(file_out)))
+    pool = multiprocessing.Pool(workers, init_worker, (nodes,))
+    try:
+        tasks = [(file_in, start, end, os.path.join(tmpdir, "{0}.json".format(i)), cache, engine, index is not None,
+                  run_metrics is not None, exclude, geofence, classifier)
+                 for i, (start, end) in enumerate(shards)]
+        with osmio.open_output(file_out) as fo:
+            written = 0
+            for i, (shard_out, counters, shard_counters, classified, error) in enumerate(pool.imap(process_shard,
+                                                                                                   tasks)):
+                if error is not None:
+                    raise shard_parse_error(file_in, shards[i][0], *error)
+                classifier.merge_stats(classified)
+                if index is not None:
+                    with open(shard_out + ".idx") as fi:
+                        for line in fi:
+                            key, offset, length = line.split()
+                            index(key, written + int(offset), int(length))
+                    os.remove(shard_out + ".idx")
+                written += os.path.getsize(shard_out)
+                with open(shard_out, "rb") as fi:
+                    shutil.copyfileobj(fi, fo, osmio.BLOCK_SIZE)
+                os.remove(shard_out)
+                if counters:
+                    cache.merge_stats(counters)
+                if shard_counters:
+                    run_metrics.merge(shard_counters)
+                    run_metrics.advance(shards[i][1] - shards[i][0])
+                    run_metrics.tick()
+        pool.close()
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir)
+
+
+# Index callback for process_map_parallel writing the key of every line to
+# fo, and passing it on to index if given
+def key_writer(fo, index=None):
+    def add(key, offset, length):
+        fo.write(key + "\n")
+        if index is not None:
+            index(key, offset, length)
+    return add
+
+
+# Sinks that get a copy of every document next to the output of process_map
+def copy_sinks(columns=None, addresses=None, tiles=None):
+    copies = []
+    if columns is not None:
+        copies.append(columnar.ColumnarSink(columns))
+    if addresses is not None:
+        copies.append(geocoder.AddressIndexSink(addresses))
+    if tiles is not None:
+        copies.append(tile_output.TileSink(tiles))
+    return copies
+
+
+# load_elements, through a dedup.DedupSink if dedup is set. Its sorted runs
+# go next to file_out, the duplicates it removed are counted as dropped.
+def load_deduped(osm_file, sink, normalizers, engine, nodes, metrics, exclude, geofence, dedup, file_out,
+                 classifier=KEYS):
+    if not dedup:
+        load_elements(osm_file, sink, normalizers, engine, nodes, metrics, exclude, geofence, classifier)
+        return
+    deduper = duplicates.DedupSink(sink, tmpdir=os.path.dirname(os.path.abspath(file_out)))
+    with deduper:
+        load_elements(osm_file, deduper, normalizers, engine, nodes, metrics, exclude, geofence, classifier)
+    if metrics is not None:
+        metrics.drop_written(duplicates.DUPLICATE, deduper.duplicates)
+
+
+# Shapes file_in into file_out in segments of size bytes, with a checkpoint
+# after each of them, see checkpoint.py. With resume set the run goes on from
+# the last checkpoint.
+def process_map_checkpointed(file_in, file_out, size, resume, normalizers, engine, nodes, offsets, metrics, exclude,
+                             geofence, classifier=KEYS):
+    checkpointer = checkpoints.Checkpointer(file_in, file_out, size, resume)
+    checkpointer.restore(normalizers, metrics)
+    with checkpointer.open_output() as fo:
+        sink = checkpoints.LineCounter(sinks.JsonSink(fo, offsets.add if offsets else None, checkpointer.bytes),
+                                       checkpointer.lines)
+        for start, end in checkpointer.segments():
+            try:
+                load_elements(osmio.ShardReader(file_in, start, end), sink, normalizers, engine, nodes, metrics,
+                              exclude, geofence, classifier)
+            except ET.ParseError as e:
+                raise shard_parse_error(file_in, start, str(e), getattr(e, 'code', None), e.position)
+            if metrics is not None:
+                metrics.reader = None
+                metrics.advance(end - start)
+            checkpointer.save(fo, end, sink.lines, normalizers, metrics, offsets)
+    checkpointer.done()
+
+
+# Pass cache=audit.CachedNormalizers() to memoize the normalizers, its stats()
+# and report() show how well the cache did after the run. The same goes for
+# classifier, a KeyClassifier, KEYS by default, which also counts the lookups
+# of the worker processes in parallel mode. engine selects the
+# parser, one of the keys of ENGINES. With geometry=True the node coordinates
+# are collected in a first pass and every way gets a "geometry" list of
+# [lat, lon] pairs and a "bbox". With index=True the byte offset of every line
+# is stored in "<file>.osm.json.idx", which osmchange needs to apply change
+# files to the output later on.
+#
+# Inputs ending in .gz, .bz2 or .zst are decompressed on the fly, .pbf files
+# are always read with iter_shaped_pbf. The output goes to file_out, by
+# default the input name without the compression extension plus ".json", and
+# is compressed the same way if its name ends in one of these extensions.
+#
+# With a sink (sinks.MongoSink, sinks.JsonSink) the documents go to the sink
+# instead of file_out. The sink is not closed. With columns set to a
+# directory a columnar.ColumnarSink writes the documents there as well, with
+# addresses set to a directory a geocoder.AddressIndexSink writes the address
+# index for geocoder.AddressIndex there, and with tiles set to a directory a
+# tiles.TileSink writes a copy partitioned by geohash tile there. For tiles
+# only, pass sink=tiles.TileSink(directory) instead.
+#
+# With a metrics.Metrics as metrics the run is timed by stage, dropped
+# elements are counted by reason and progress is reported on stderr. Its
+# summary goes to "<file_out>.metrics.json" unless it was given a path, with
+# the stats of the classifier under "keys".
+#
+# geofence is a geofence.Geofence or the path of a boundary polygon (.poly or
+# GeoJSON), only the elements inside it are kept. Ways are tested by their
+# geometry, so pass geometry=True with it. tag_filter=False turns off the
+# postcode and country filter of is_excluded, e.g. when the geofence takes
+# its place.
+#
+# With dedup=True only the highest version of every element is kept, for
+# history files and merged extracts, see dedup.DedupSink. The output is then
+# sorted by type and id, and XML inputs are parsed in this process.
+#
+# With checkpoint set to a number of bytes an uncompressed XML input is
+# processed in segments of that size, in this process, and a checkpoint is
+# written to "<file_out>.checkpoint" after each of them. resume=True goes on
+# from there after a crash, see checkpoint.py. Both can't be combined with a
+# sink, copies, dedup or a compressed output.
+def process_map(file_in, pretty = False, workers = 1, cache = None, engine = 'etree', geometry = False,
+                index = False, file_out = None, sink = None, columns = None, addresses = None, tiles = None,
+                metrics = None, geofence = None, tag_filter = True, dedup = False,
+                checkpoint = None, resume = False, classifier = None):
+    # Elements are handed out one at a time by osmio.iter_elements and freed
+    # right after shaping, so memory stays flat however large the input is
+    if file_out is None:
+        file_out = "{0}.json".format(osmio.strip_compression(file_in))
+    if index and sink is not None:
+        raise ValueError("offsets can only be indexed in a JSON output file")
+    if index and osmio.compression(file_out):
+        raise ValueError("{0}: offsets can't be indexed in a compressed output".format(file_out))
+    # compressed inputs can't be split into byte ranges, the blocks of a PBF
+    # file are decoded on the workers instead. A sink gets its documents from
+    # this process, so XML inputs are parsed here too, and so are they for
+    # dedup, which has to see every element.
+    if resume and not checkpoint:
+        checkpoint = checkpoints.CHECKPOINT_BYTES
+    if checkpoint:
+        if pbf.is_pbf(file_in) or osmio.compression(file_in) or osmio.compression(file_out):
+            raise ValueError("{0}: checkpoints need an uncompressed XML input and output".format(file_in))
+        if sink is not None or dedup or columns is not None or addresses is not None or tiles is not None:
+            raise ValueError("checkpoints only cover the JSON output file")
+        workers = 1
+    if pbf.is_pbf(file_in):
+        engine = functools.partial(iter_shaped_pbf, workers=workers)
+        workers = 1
+    elif osmio.compression(file_in) or sink is not None or dedup:
+        workers = 1
+    if isinstance(geofence, basestring):
+        geofence = fences.load(geofence)
+    if classifier is None:
+        classifier = KEYS
+    exclude = is_excluded if tag_filter else None
+    # a resumed run keeps the offsets of the lines before the checkpoint, the
+    # ones after it are written again
+    offsets = osmio.OffsetIndex(file_out + ".idx", 'c' if resume else 'n') if index else None
+    if metrics is not None:
+        metrics.begin(file_in)
+    try:
+        start = timer()
+        nodes = nodestore.build(file_in) if geometry else None
+        if metrics is not None and geometry:
+            metrics.add_time('node_store', timer() - start)
+        if checkpoint:
+            process_map_checkpointed(file_in, file_out, checkpoint, resume, cache or audit, engine, nodes, offsets,
+                                     metrics, exclude, geofence, classifier)
+        elif workers > 1 and columns is None and addresses is None and tiles is None:
+            process_map_parallel(file_in, file_out, workers, cache, engine, nodes, offsets.add if offsets else None,
+                                 metrics, exclude, geofence, classifier)
+        elif workers > 1:
+            # the shards come back as JSON, the copies are made from there
+            # with the element keys of the lines kept in a file next to it
+            keys = file_out + ".keys"
+            try:
+                with open(keys, 'w') as fo:
+                    process_map_parallel(file_in, file_out, workers, cache, engine, nodes,
+                                         key_writer(fo, offsets.add if offsets else None), metrics, exclude, geofence,
+                                         classifier)
+                if columns is not None:
+                    columnar.from_json(file_out, columns, keys)
+                if addresses is not None:
+                    geocoder.from_json(file_out, addresses, keys)
+                if tiles is not None:
+                    tile_output.from_json(file_out, tiles, keys=keys)
+            finally:
+                if os.path.exists(keys):
+                    os.remove(keys)
+        else:
+            copies = copy_sinks(columns, addresses, tiles)
+            try:
+                if sink is not None:
+                    load_deduped(file_in, sinks.Tee(sink, *copies) if copies else sink, cache or audit, engine,
+                                 nodes, metrics, exclude, geofence, dedup, file_out, classifier)
+                else:
+                    with osmio.open_output(file_out) as fo:
+                        json_sink = sinks.JsonSink(fo, offsets.add if offsets else None)
+                        load_deduped(file_in, sinks.Tee(json_sink, *copies) if copies else json_sink,
+                                     cache or audit, engine, nodes, metrics, exclude, geofence, dedup, file_out,
+                                     classifier)
+            finally:
+                for copy in copies:
+                    copy.close()
+    except ET.ParseError as e:
+        sys.stderr.write("{0}: parse error at line {1[0]}, column {1[1]}: {2}\n".format(file_in, e.position, e))
+        if metrics is not None:
+            metrics.parse_error(e)
+        raise
+    finally:
+        if offsets is not None:
+            offsets.close()
+        if metrics is not None:
+            metrics.keys = classifier.stats()
+            metrics.finish(file_out + ".metrics.json")
+
+
+# Prints how many input elements per second each engine shapes
+def benchmark_engines(file_in):
+    count = sum(1 for _ in osmio.iter_elements(file_in))
+    for engine in sorted(ENGINES):
+        start = timer()
+        with open(os.devnull, "w") as fo:
+            write_elements(file_in, fo, audit, engine)
+        elapsed = timer() - start
+        print "{0}: {1} elements in {2:.2f}s, {3:.0f} elements/s".format(engine, count, elapsed, count / elapsed)
+
+
+# Prints the throughput of process_map for plain and compressed inputs and
+# outputs, in MB of uncompressed input per second
+def benchmark_compression(file_in):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        size = os.path.getsize(file_in) / float(1 << 20)
+        for ext in ('', '.gz', '.bz2'):
+            compressed = os.path.join(tmpdir, "input.osm" + ext)
+            with open(file_in, "rb") as fi:
+                with osmio.open_output(compressed) as fo:
+                    shutil.copyfileobj(fi, fo, osmio.BLOCK_SIZE)
+            for out_ext in ('', '.gz', '.bz2'):
+                start = timer()
+                process_map(compressed, file_out=os.path.join(tmpdir, "output.json" + out_ext))
+                elapsed = timer() - start
+                print "input {0:5} output {1:5} {2:.2f}s, {3:.2f} MB/s".format(
+                    ext or 'plain', out_ext or 'plain', elapsed, size / elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+# Writes a synthetic OSM file with the given number of tagged nodes
+def write_synthetic_osm(file_out, count):
+    with open(file_out, "w") as fo:
+        fo.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for i in xrange(1, count + 1):
+            fo.write('  <node id="{0}" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" '
+                     'lat="52.5{0:05d}" lon="13.4{0:05d}">\n'
+                     '    <tag k="addr:street" v="Heerstra\xc3\x9fe"/>\n'
+                     '    <tag k="addr:housenumber" v="{1}-{2}"/>\n'
+                     '    <tag k="addr:postcode" v="10115"/>\n'
+                     '    <tag k="phone" v="030 {0}"/>\n'
+                     '  </node>\n'.format(i, i % 100, i % 100 + 2))
+        fo.write('</osm>\n')
+
+# Peak memory (in kB) of a process_map run in a fresh interpreter
+def _peak_memory(file_in):
+    script = "import resource, data; data.process_map({0!r}); print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss"
+    output = subprocess.check_output([sys.executable, "-c", script.format(file_in)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    return int(output.split()[-1])
+
+# process_map has to run in constant memory: growing the input 8 times may
+# not grow the peak memory of the run by more than a few MB
+def test_streaming_memory():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        peaks = []
+        for count in (25000, 200000):
+            file_in = os.path.join(tmpdir, "synthetic_{0}.osm".format(count))
+            write_synthetic_osm(file_in, count)
+            peaks.append(_peak_memory(file_in))
+        print "peak memory (kB):", peaks
+        assert peaks[1] - peaks[0] < 5 * 1024
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_key_classifier():
+    classifier = KeyClassifier()
+    assert classifier.action('addr:street') == (ADDRESS, 'street', 'update_name')
+    assert classifier.action('addr:street:name') == (DROP, None, None)
+    assert classifier.action('name:en') == (FIELD, 'name:en', None)
+    assert classifier.action('phone') == (NONEMPTY, 'phone', 'update_phonenumber')
+    assert classifier.action('bad key') == (DROP, None, None)
+    assert classifier.action('phone') == (NONEMPTY, 'phone', 'update_phonenumber')
+    assert classifier.stats() == {'distinct_keys': 5, 'lookups': 6, 'cached_lookups': 1}
+
+    # what a copy counted is added back
+    copy = pickle.loads(pickle.dumps(classifier))
+    before = copy.counters()
+    copy.action('phone')
+    copy.action('amenity')
+    classifier.merge_stats(copy.counters_since(before))
+    assert classifier.stats() == {'distinct_keys': 6, 'lookups': 8, 'cached_lookups': 2}
+    assert classifier.action('amenity') == (NONEMPTY, 'amenity', None)
+
+    # the workers of the parallel mode count the same lookups as a serial run
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        write_synthetic_osm(file_in, 2000)
+        stats = []
+        for workers in (1, 3):
+            classifier = KeyClassifier()
+            run_metrics = metrics.Metrics(report_interval=None)
+            process_map(file_in, workers=workers, classifier=classifier, metrics=run_metrics)
+            stats.append(classifier.stats())
+            with open(file_in + ".json.metrics.json") as fi:
+                assert json.load(fi)['keys'] == stats[-1]
+        assert stats[0] == stats[1] == {'distinct_keys': 4, 'lookups': 8000, 'cached_lookups': 7996}
+    finally:
+        shutil.rmtree(tmpdir)
+
+# All engines have to produce exactly the same file
+def test_engines():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        write_synthetic_osm(file_in, 5000)
+        outputs = []
+        for engine in sorted(ENGINES):
+            process_map(file_in, engine=engine)
+            with open(file_in + ".json", "rb") as fi:
+                outputs.append(fi.read())
+        assert outputs.count(outputs[0]) == len(outputs)
+        benchmark_engines(file_in)
+    finally:
+        shutil.rmtree(tmpdir)
+
+# Compressed inputs and outputs have to give the same data as plain ones
+def test_compression():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        write_synthetic_osm(file_in, 5000)
+        process_map(file_in)
+        with open(file_in + ".json", "rb") as fi:
+            plain = fi.read()
+        for ext in ('.gz', '.bz2'):
+            with open(file_in, "rb") as fi:
+                with osmio.open_output(file_in + ext) as fo:
+                    fo.write(fi.read())
+            process_map(file_in + ext, file_out=file_in + ".json" + ext, workers=2)
+            assert osmio.open_input(file_in + ".json" + ext).read() == plain
+    finally:
+        shutil.rmtree(tmpdir)
+
+# The parallel mode has to produce exactly the same file as the serial one
+def test_parallel():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        write_synthetic_osm(file_in, 20000)
+        process_map(file_in)
+        with open(file_in + ".json", "rb") as fi:
+            serial = fi.read()
+        process_map(file_in, workers=3)
+        with open(file_in + ".json", "rb") as fi:
+            assert fi.read() == serial
+    finally:
+        shutil.rmtree(tmpdir)
+
+METRICS_OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.5" lon="13.4">
+    <tag k="addr:street" v="Potsdamer Chausee"/>
+    <tag k="addr:housenumber" v="4-6"/>
+    <tag k="phone" v="030 123456"/>
+  </node>
+  <node id="2" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.5" lon="14.6">
+    <tag k="addr:country" v="PL"/>
+  </node>
+  <node id="3" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.5" lon="13.4">
+    <tag k="addr:postcode" v="16000"/>
+  </node>
+  <node id="4" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.5" lon="13.4">
+    <tag k="addr:postcode" v="D-10115"/>
+  </node>
+  <node id="5" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.5" lon="13.4"/>
+  <way id="6" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1">
+    <nd ref="1"/>
+    <nd ref="5"/>
+  </way>
+  <relation id="7" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1">
+    <member type="way" ref="6" role=""/>
+  </relation>
+</osm>
+"""
+
+# Metrics have to count every dropped element by reason, whatever the engine,
+# and must not change the output
+def test_metrics():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "metrics.osm")
+        with open(file_in, "w") as fo:
+            fo.write(METRICS_OSM)
+        process_map(file_in)
+        with open(file_in + ".json") as fi:
+            plain = fi.read()
+        dropped = {NOT_NODE_OR_WAY: 1, COUNTRY_PL: 1, POSTCODE_OUT_OF_RANGE: 1, POSTCODE_INVALID: 1}
+        for engine, workers in (('etree', 2), ('etree', 1), ('expat', 1)):
+            run_metrics = metrics.Metrics(report_interval=None)
+            process_map(file_in, engine=engine, workers=workers, metrics=run_metrics)
+            with open(file_in + ".json") as fi:
+                assert fi.read() == plain
+            with open(file_in + ".json.metrics.json") as fi:
+                summary = json.load(fi)
+            assert summary['dropped'] == dropped
+            assert summary['elements_in'] == 7 and summary['elements_out'] == 3
+            assert summary['calls']['normalize:update_phonenumber'] == 1
+            for stage in ('parse', 'shape', 'serialize', 'normalize:update_name'):
+                assert stage in summary['times']
+            assert summary['bytes'] > 0 and summary['error'] is None
+        assert summary['bytes'] == summary['total_bytes'] and summary['eta'] == 0
+
+        # the summary is written for failed runs too, with the position in
+        # the input also when the error is in a shard of it
+        with open(file_in, "w") as fo:
+            fo.write(METRICS_OSM.replace("</way>", ""))
+        for workers in (1, 2):
+            try:
+                process_map(file_in, workers=workers,
+                            metrics=metrics.Metrics(os.path.join(tmpdir, "failed.json"), report_interval=None))
+            except ET.ParseError:
+                pass
+            else:
+                assert False, "the parse error was swallowed"
+            with open(os.path.join(tmpdir, "failed.json")) as fi:
+                error = json.load(fi)['error']
+            assert error['line'] == 25 and error['message'].endswith("line 25, column 2")
+
+        # a broken element far into a larger file
+        file_in = os.path.join(tmpdir, "broken.osm")
+        write_synthetic_osm(file_in, 20000)
+        with open(file_in) as fi:
+            text = fi.read()
+        broken = text.index("<tag", len(text) // 2 + 12345)
+        with open(file_in, "w") as fo:
+            fo.write(text[:broken] + "<" + text[broken:])
+        positions = []
+        for engine, workers, checkpoint in (('etree', 1, None), ('etree', 3, None), ('etree', 1, 1 << 16),
+                                            ('expat', 1, None), ('expat', 3, None), ('expat', 1, 1 << 16)):
+            try:
+                process_map(file_in, engine=engine, workers=workers, checkpoint=checkpoint)
+            except ET.ParseError as e:
+                positions.append((e.position, str(e)))
+        assert len(positions) == 6 and positions[0] == positions[1] == positions[2]
+        assert positions[3] == positions[4] == positions[5]
+        assert positions[0][0] == positions[3][0] == (text[:broken].count("\n") + 1, 5)
+    finally:
+        shutil.rmtree(tmpdir)
+
+# The geofence keeps what is inside the boundary, with or without the tag
+# filter, whatever the engine
+def test_geofence():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "geofence.osm")
+        with open(file_in, "w") as fo:
+            fo.write(METRICS_OSM)
+        boundary = os.path.join(tmpdir, "boundary.poly")
+        with open(boundary, "w") as fo:
+            fo.write("square\n1\n 13.0 52.0\n 14.0 52.0\n 14.0 53.0\n 13.0 53.0\nEND\nEND\n")
+        for engine, workers in (('etree', 1), ('expat', 1), ('etree', 2)):
+            for tag_filter, kept in ((True, ['1', '5', '6']), (False, ['1', '3', '4', '5', '6'])):
+                run_metrics = metrics.Metrics(report_interval=None)
+                process_map(file_in, engine=engine, workers=workers, geometry=True, geofence=boundary,
+                            tag_filter=tag_filter, metrics=run_metrics)
+                with open(file_in + ".json") as fi:
+                    assert [json.loads(line)['id'] for line in fi] == kept
+                assert run_metrics.dropped[fences.OUTSIDE_GEOFENCE] == (0 if tag_filter else 1)
+        # without a geometry ways can't be tested and are kept
+        process_map(file_in, geofence=fences.load(boundary), tag_filter=False)
+        with open(file_in + ".json") as fi:
+            assert [json.loads(line)['id'] for line in fi] == ['1', '3', '4', '5', '6']
+    finally:
+        shutil.rmtree(tmpdir)
 
 def test():
+    test_streaming_memory()
+    test_parallel()
+    test_engines()
+    test_key_classifier()
+    test_compression()
+    test_metrics()
+    test_geofence()
+
+    if not os.path.exists(OSMFILE):
+        print "{0} is not there, skipping the test on it".format(OSMFILE)
+        return
     # NOTE: if you are running this code on your computer, with a larger dataset,
     # call the process_map procedure with pretty=False. The pretty=True option adds 
     # additional spaces to the output, making it significantly larger.
@@ -0,0 +1,256 @@
+"""
+Keeps one document per element of history files and merged extracts.
+
+The same element type and id can come several times with different
+created.version values. DedupSink passes on only the highest version of each,
+the one that came last if there are several of it, in the order of element
+type (nodes first) and id.
+
+Up to run_size elements are kept in a dict, which already drops the
+duplicates among them. If there are more, the dict is written to a temporary
+file sorted by type and id, and the next run_size elements go into a fresh
+dict. When the sink is closed these sorted runs are merged with heapq.merge,
+reading one line of each at a time, so the input can be much larger than
+memory. Small inputs never touch the disk.
+"""
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+# Elements kept in memory before a sorted run is written to disk
+RUN_SIZE = 200000
+
+# Reason for dropping an element, as counted by metrics.Metrics
+DUPLICATE = 'duplicate'
+
+TYPES = {'node': 0, 'way': 1}
+
+
+def version(doc):
+    try:
+        return int(doc['created']['version'])
+    except (KeyError, TypeError, ValueError):
+        return -1
+
+# Sort order of a key like "node/123"
+def sort_key(key):
+    element_type, element_id = key.split('/', 1)
+    return TYPES.get(element_type, len(TYPES)), int(element_id), element_type
+
+def read_run(path):
+    with open(path) as fi:
+        for line in fi:
+            rank, element_id, element_type, doc_version, seq, line = line.split(' ', 5)
+            yield (int(rank), int(element_id), element_type), int(doc_version), int(seq), line
+
+
+class DedupSink(object):
+    """
+    Sink for process_map handing the latest version of every element to sink
+    when it is closed. sink itself is not closed.
+    """
+    def __init__(self, sink, run_size=RUN_SIZE, tmpdir=None):
+        self.sink = sink
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.latest = {}
+        self.runs = []
+        self.run_dir = None
+        self.added = 0
+        self.written = 0
+
+    def add(self, key, doc):
+        seq = self.added
+        self.added += 1
+        doc_version = version(doc)
+        found = self.latest.get(key)
+        if found is None or doc_version >= found[0]:
+            self.latest[key] = (doc_version, seq, doc)
+        if len(self.latest) >= self.run_size:
+            self.spill()
+
+    # Writes the dict as a sorted run, one "rank id type version seq JSON"
+    # line per element
+    def spill(self):
+        if self.run_dir is None:
+            self.run_dir = tempfile.mkdtemp(dir=self.tmpdir)
+        path = os.path.join(self.run_dir, "{0}.run".format(len(self.runs)))
+        with open(path, 'w') as fo:
+            for (rank, element_id, element_type), key in sorted((sort_key(key), key) for key in self.latest):
+                doc_version, seq, doc = self.latest[key]
+                fo.write("{0} {1} {2} {3} {4} {5}\n".format(rank, element_id, element_type, doc_version, seq,
+                                                            json.dumps(doc)))
+        self.runs.append(path)
+        self.latest = {}
+
+    def close(self):
+        if self.latest is None:
+            return
+        try:
+            if not self.runs:
+                for order, key in sorted((sort_key(key), key) for key in self.latest):
+                    self.emit(key, self.latest[key][2])
+            else:
+                if self.latest:
+                    self.spill()
+                self.merge()
+        finally:
+            self.latest = None
+            if self.run_dir is not None:
+                shutil.rmtree(self.run_dir)
+
+    # k-way merge of the runs. Versions of the same element are next to each
+    # other in it, the last of them is the one to keep.
+    def merge(self):
+        best = None
+        for item in heapq.merge(*[read_run(path) for path in self.runs]):
+            if best is not None and item[0] != best[0]:
+                self.emit_line(best)
+            if best is None or item[0] != best[0] or (item[1], item[2]) >= (best[1], best[2]):
+                best = item
+        if best is not None:
+            self.emit_line(best)
+
+    def emit_line(self, item):
+        (rank, element_id, element_type), doc_version, seq, line = item
+        self.emit("{0}/{1}".format(element_type, element_id), json.loads(line))
+
+    def emit(self, key, doc):
+        self.sink.add(key, doc)
+        self.written += 1
+
+    @property
+    def duplicates(self):
+        return self.added - self.written
+
+    def report(self):
+        print "dedup: {0} elements in, {1} out, {2} duplicates removed, {3} sorted runs".format(
+            self.added, self.written, self.duplicates, len(self.runs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Shapes the OSM files files_in, e.g. overlapping extracts, into the JSON
+# lines file_out with the latest version of every element. The elements are
+# keyed by the pipeline, not by their type and id fields, which tags of the
+# same name can overwrite. Returns the DedupSink with the counts.
+def dedup_extracts(files_in, file_out, run_size=RUN_SIZE, normalizers=None, engine='etree'):
+    import audit
+    import data
+    import sinks
+    with sinks.JsonSink(file_out) as sink:
+        with DedupSink(sink, run_size, os.path.dirname(os.path.abspath(file_out))) as dedup:
+            for file_in in files_in:
+                data.load_elements(file_in, dedup, normalizers or audit, engine)
+    return dedup
+
+
+HISTORY = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="2" version="1" timestamp="2014-01-01T00:00:00Z" lat="52.5" lon="13.4"/>
+  <node id="2" version="3" timestamp="2014-03-01T00:00:00Z" lat="52.5" lon="13.4">
+    <tag k="amenity" v="cafe"/>
+  </node>
+  <node id="2" version="2" timestamp="2014-02-01T00:00:00Z" lat="52.5" lon="13.4"/>
+  <node id="10" version="1" timestamp="2014-01-01T00:00:00Z" lat="52.5" lon="13.4"/>
+  <node id="1" version="1" timestamp="2014-01-01T00:00:00Z" lat="52.5" lon="13.4"/>
+  <way id="1" version="1" timestamp="2014-01-01T00:00:00Z">
+    <nd ref="1"/>
+  </way>
+  <way id="1" version="2" timestamp="2014-01-02T00:00:00Z">
+    <nd ref="1"/>
+    <nd ref="2"/>
+  </way>
+</osm>
+"""
+
+
+EXTRACT = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+{0}
+</osm>
+"""
+
+
+def test():
+    import random
+    import data
+    import metrics
+
+    class ListSink(object):
+        def __init__(self):
+            self.docs = []
+
+        def add(self, key, doc):
+            self.docs.append((key, doc))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # a history file: the latest versions in type and id order
+        file_in = os.path.join(tmpdir, "history.osm")
+        with open(file_in, "w") as fo:
+            fo.write(HISTORY)
+        run_metrics = metrics.Metrics(report_interval=None)
+        data.process_map(file_in, dedup=True, metrics=run_metrics)
+        with open(file_in + ".json") as fi:
+            docs = [json.loads(line) for line in fi]
+        assert [(doc['type'], doc['id'], doc['created']['version']) for doc in docs] == [
+            ('node', '1', '1'), ('node', '2', '3'), ('node', '10', '1'), ('way', '1', '2')]
+        assert docs[1]['amenity'] == 'cafe'
+        assert run_metrics.dropped[DUPLICATE] == 3 and run_metrics.elements_out == 4
+
+        # runs spilled to disk give the same result as the dict alone
+        rand = random.Random(21)
+        items = []
+        for seq in xrange(5000):
+            key = "{0}/{1}".format(rand.choice(['node', 'way']), rand.randint(1, 1500))
+            items.append((key, {'id': key, 'created': {'version': str(rand.randint(1, 4))}, 'seq': seq}))
+        expected = {}
+        for key, doc in items:
+            if key not in expected or version(doc) >= version(expected[key]):
+                expected[key] = doc
+        results = []
+        for run_size in (10 ** 6, 300, 1):
+            sink = ListSink()
+            with DedupSink(sink, run_size, tmpdir) as dedup:
+                for key, doc in items:
+                    dedup.add(key, doc)
+            assert dict(sink.docs) == expected
+            assert [key for key, _ in sink.docs] == sorted(expected, key=sort_key)
+            assert dedup.duplicates == len(items) - len(expected)
+            assert (len(dedup.runs) > 1) == (run_size < len(items))
+            results.append(sink.docs)
+        assert results[0] == results[1] == results[2]
+        assert sorted(os.listdir(tmpdir)) == ["history.osm", "history.osm.json", "history.osm.json.metrics.json"]
+
+        # overlapping extracts, with elements whose type and id tags overwrite
+        # the fields of the same name
+        first, second = os.path.join(tmpdir, "first.osm"), os.path.join(tmpdir, "second.osm")
+        with open(first, "w") as fo:
+            fo.write(EXTRACT.format('<node id="1" version="1" lat="52.5" lon="13.4"><tag k="id" v="abc"/></node>'
+                                    '<node id="2" version="2" lat="52.5" lon="13.4"><tag k="type" v="way"/></node>'
+                                    '<way id="2" version="1"><nd ref="1"/></way>'))
+        with open(second, "w") as fo:
+            fo.write(EXTRACT.format('<node id="2" version="1" lat="52.5" lon="13.4"/>'
+                                    '<node id="1" version="2" lat="52.5" lon="13.4"><tag k="id" v="abc"/></node>'
+                                    '<way id="2" version="1"><nd ref="1"/></way>'))
+        merged_out = os.path.join(tmpdir, "merged.json")
+        dedup = dedup_extracts([first, second], merged_out, run_size=1)
+        with open(merged_out) as fi:
+            merged = [json.loads(line) for line in fi]
+        assert [(doc['type'], doc['id'], doc['created']['version']) for doc in merged] == [
+            ('node', 'abc', '2'), ('way', '2', '2'), ('way', '2', '1')]
+        assert dedup.duplicates == 3
+        dedup.report()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
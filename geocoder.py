@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+"""
+Local geocoder over the addresses of the shaped documents.
+
+AddressIndexSink collects every document with an address.street during a
+process_map run and writes an index into a directory when it is closed:
+
+    streets.dat    one record per normalized street name, sorted by name: the
+                   name, the street as written and its house number intervals
+    intervals.dat  (first, last, address) per interval. The intervals of a
+                   street are stored short ones first, then the ones longer
+                   than housenumbers.LONG_RANGE, each part sorted by first
+                   number, the way housenumbers.find_intervals reads them.
+    addresses.dat  (id, lat, lon, street, house number) per address, sorted
+                   by grid cell
+    cells.dat      (cell, first address, count) per non-empty grid cell
+    strings.dat    the text the records above point into
+    meta.json      counts and the grid cell size
+
+AddressIndex memory-maps these files and answers lookup(street, number) and
+reverse(lat, lon) with a few binary searches on the mapped records, without a
+database and without loading the index into memory.
+"""
+from collections import defaultdict
+from array import array
+import json
+import math
+import mmap
+import os
+import struct
+import housenumbers
+import osmio
+
+# Grid cell size for reverse lookups, in degrees
+CELL_SIZE = 0.005
+
+# Default search radius of reverse(), in meters
+MAX_DISTANCE = 500.0
+
+EARTH_RADIUS = 6371000.0
+
+# Abbreviated street types written out before names are compared
+ABBREVIATIONS = [(u'str.', u'stra\xdfe')]
+
+STREET = struct.Struct('<IIIIIII')      # key offset, key length, name offset, name length, first interval,
+                                        # short intervals, long intervals
+INTERVAL = struct.Struct('<qqi')        # first, last, address
+ADDRESS = struct.Struct('<qddiII')      # id, lat, lon, street, house number offset, house number length
+CELL = struct.Struct('<qII')            # cell, first address, count
+
+FILES = ('streets', 'intervals', 'addresses', 'cells', 'strings')
+
+# House numbers above this don't fit into an interval record. They can't be
+# real ones either, so they are left out of the intervals.
+MAX_NUMBER = (1 << 63) - 1
+
+
+# Street names are compared in lower case with single blanks and the
+# abbreviations written out, so "Heerstr." finds "Heerstraße"
+def normalize_street(name):
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = u' '.join(name.lower().split())
+    for short, full in ABBREVIATIONS:
+        if name.endswith(short):
+            name = name[:-len(short)] + full
+    return name.encode('utf-8')
+
+# Position of a shaped document of element_type: pos for nodes, the middle
+# of the bbox for ways that got a geometry, None for other ways
+def position(doc, element_type):
+    if element_type == 'node' and doc.get('pos'):
+        return doc['pos']
+    bbox = doc.get('bbox')
+    if bbox:
+        return [(bbox[0] + bbox[2]) / 2.0, (bbox[1] + bbox[3]) / 2.0]
+    return None
+
+def cell(lat, lon, size=CELL_SIZE):
+    return int(math.floor((lat + 90.0) / size)), int(math.floor((lon + 180.0) / size))
+
+def cell_key(row, column, size=CELL_SIZE):
+    return row * (int(360.0 / size) + 1) + column
+
+# Distance in meters, flat earth approximation, good for the short distances
+# of a reverse lookup
+def distance(lat1, lon1, lat2, lon2):
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2.0))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.sqrt(x * x + y * y)
+
+def housenumber_text(entries):
+    if not isinstance(entries, list):
+        entries = [entries]
+    return u','.join(u"{0}-{1}".format(entry['from'], entry['to']) if housenumbers.is_range(entry) else entry
+                     for entry in entries)
+
+
+class AddressIndexSink(object):
+    """
+    Sink for process_map writing the address index described above into the
+    directory path.
+    """
+    def __init__(self, path, cell_size=CELL_SIZE):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.cell_size = cell_size
+        self.streets = {}
+        self.names = []
+        self.intervals = defaultdict(list)
+        self.ids = array(osmio.INT64)
+        self.lats = array('d')
+        self.lons = array('d')
+        self.address_streets = array('i')
+        self.numbers = []
+
+    def add(self, key, doc):
+        address = doc.get('address')
+        if not address or not address.get('street'):
+            return
+        street = normalize_street(address['street'])
+        index = self.streets.get(street)
+        if index is None:
+            index = self.streets[street] = len(self.names)
+            self.names.append(address['street'])
+        element_type, element_id = osmio.split_key(key)
+        pos = position(doc, element_type) or (float('nan'), float('nan'))
+        number = len(self.ids)
+        self.ids.append(int(element_id))
+        self.lats.append(pos[0])
+        self.lons.append(pos[1])
+        self.address_streets.append(index)
+        entries = address.get('housenumber', [])
+        self.numbers.append(housenumber_text(entries).encode('utf-8'))
+        for entry in entries if isinstance(entries, list) else [entries]:
+            found = housenumbers.bounds(entry)
+            if found and found[0] <= found[1] <= MAX_NUMBER:
+                self.intervals[index].append((found[0], found[1], number))
+
+    def close(self):
+        if self.names is None:
+            return
+        # addresses go into the order of their grid cells, the ones without a
+        # position last
+        cells = []
+        for lat, lon in zip(self.lats, self.lons):
+            cells.append(cell_key(*cell(lat, lon, self.cell_size), size=self.cell_size) if lat == lat else None)
+        order = sorted(xrange(len(self.ids)), key=lambda i: (cells[i] is None, cells[i]))
+        new_index = array('i', [0]) * len(order)
+        for i, old in enumerate(order):
+            new_index[old] = i
+        strings = []
+        size = [0]
+
+        def text(value):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            strings.append(value)
+            size[0] += len(value)
+            return size[0] - len(value), len(value)
+
+        streets = sorted(self.streets.items())
+        street_order = array('i', [0]) * len(streets)
+        for i, (_, index) in enumerate(streets):
+            street_order[index] = i
+        with open(os.path.join(self.path, 'addresses.dat'), 'wb') as fo:
+            for old in order:
+                offset, length = text(self.numbers[old])
+                fo.write(ADDRESS.pack(int(self.ids[old]), self.lats[old], self.lons[old],
+                                      street_order[self.address_streets[old]], offset, length))
+        with open(os.path.join(self.path, 'cells.dat'), 'wb') as fo:
+            first = 0
+            while first < len(order) and cells[order[first]] is not None:
+                last = first
+                while last < len(order) and cells[order[last]] == cells[order[first]]:
+                    last += 1
+                fo.write(CELL.pack(cells[order[first]], first, last - first))
+                first = last
+        count = 0
+        with open(os.path.join(self.path, 'streets.dat'), 'wb') as streets_out:
+            with open(os.path.join(self.path, 'intervals.dat'), 'wb') as intervals_out:
+                for street, index in streets:
+                    intervals = sorted((first, last, new_index[number])
+                                       for first, last, number in self.intervals[index])
+                    short, longer = housenumbers.split_intervals(intervals)
+                    for interval in short + longer:
+                        intervals_out.write(INTERVAL.pack(*interval))
+                    key_offset, key_length = text(street)
+                    name_offset, name_length = text(self.names[index])
+                    streets_out.write(STREET.pack(key_offset, key_length, name_offset, name_length,
+                                                  count, len(short), len(longer)))
+                    count += len(intervals)
+        with open(os.path.join(self.path, 'strings.dat'), 'wb') as fo:
+            fo.write(''.join(strings))
+        meta = {'addresses': len(order), 'streets': len(self.streets), 'intervals': count,
+                'cell_size': self.cell_size}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as fo:
+            json.dump(meta, fo)
+        self.names = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Builds the index over a JSON lines output of process_map
+def from_json(file_json, path, keys=None):
+    import sinks
+    with AddressIndexSink(path) as sink:
+        for key, doc in sinks.iter_keyed(file_json, keys):
+            sink.add(key, doc)
+
+
+class Records(object):
+    """
+    The fixed size records of a mapped file, record(i) unpacks the i-th one.
+    """
+    def __init__(self, data, record):
+        self.data = data
+        self.record = record
+        self.count = len(data) // record.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.record.unpack_from(self.data, i * self.record.size)
+
+
+# First position in records[low:high] whose first field is not below value,
+# like bisect_left
+def search(records, value, low, high):
+    while low < high:
+        middle = (low + high) // 2
+        found = records[middle][0]
+        if found < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class AddressIndex(object):
+    """
+    The index written by AddressIndexSink, memory-mapped read only.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as fi:
+            meta = json.load(fi)
+        self.cell_size = meta['cell_size']
+        self.files = []
+        self.maps = {}
+        for name in FILES:
+            fi = open(os.path.join(path, name + '.dat'), 'rb')
+            self.files.append(fi)
+            # an empty file can't be mapped
+            self.maps[name] = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fi.fileno()).st_size \
+                else ''
+        self.strings = self.maps['strings']
+        self.streets = Records(self.maps['streets'], STREET)
+        self.intervals = Records(self.maps['intervals'], INTERVAL)
+        self.addresses = Records(self.maps['addresses'], ADDRESS)
+        self.cells = Records(self.maps['cells'], CELL)
+
+    def close(self):
+        for data in self.maps.values():
+            if data:
+                data.close()
+        for fi in self.files:
+            fi.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def text(self, offset, length):
+        return self.strings[offset:offset + length].decode('utf-8')
+
+    # Position of the street record with the given normalized name, or -1
+    def find_street(self, key):
+        low, high = 0, len(self.streets)
+        while low < high:
+            middle = (low + high) // 2
+            record = self.streets[middle]
+            name = self.strings[record[0]:record[0] + record[1]]
+            if name < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.streets):
+            record = self.streets[low]
+            if self.strings[record[0]:record[0] + record[1]] == key:
+                return low
+        return -1
+
+    # Lower bound of the distance from lat, lon in the cell row, column to the
+    # cells of the given ring around it, in meters
+    def ring_distance(self, lat, lon, row, column, ring):
+        if not ring:
+            return 0.0
+        size = self.cell_size
+        south = lat - ((row - ring + 1) * size - 90.0)
+        north = (row + ring) * size - 90.0 - lat
+        west = lon - ((column - ring + 1) * size - 180.0)
+        east = (column + ring) * size - 180.0 - lon
+        # meridians are closest together on the side nearer to the pole
+        scale = math.cos(math.radians(min(abs(lat) + ring * size, 90.0)))
+        return math.radians(min(south, north, min(west, east) * scale)) * EARTH_RADIUS
+
+    def address(self, i):
+        element_id, lat, lon, street, offset, length = self.addresses[i]
+        record = self.streets[street]
+        return {
+            'id': str(element_id),
+            'pos': [lat, lon] if lat == lat else None,
+            'street': self.text(record[2], record[3]),
+            'housenumber': self.text(offset, length)
+        }
+
+    # Addresses on street whose house numbers include number, an int or a
+    # house number like "12A" (looked up as 12)
+    def lookup(self, street, number):
+        if not isinstance(number, (int, long)):
+            found = housenumbers.bounds(number)
+            if not found:
+                return []
+            number = found[0]
+        i = self.find_street(normalize_street(street))
+        if i < 0:
+            return []
+        _, _, _, _, first, short, longer = self.streets[i]
+        found = housenumbers.find_intervals(self.intervals, number, first, short, longer)
+        return [self.address(address) for _, _, address in found]
+
+    # Addresses in the cells of row from column first to column last
+    def row_addresses(self, row, first, last):
+        cells = self.cells
+        last_key = cell_key(row, last, self.cell_size)
+        i = search(cells, cell_key(row, first, self.cell_size), 0, len(cells))
+        while i < len(cells):
+            key, address, count = cells[i]
+            if key > last_key:
+                break
+            for address in xrange(address, address + count):
+                yield address
+            i += 1
+
+    # Nearest address to lat, lon within max_distance meters, or None. The
+    # search goes through rings of grid cells around the cell of the position
+    # and stops once the next ring is farther away than the best address
+    # found.
+    def reverse(self, lat, lon, max_distance=MAX_DISTANCE):
+        size = self.cell_size
+        row, column = cell(lat, lon, size)
+        best, best_distance = None, max_distance
+        ring = 0
+        while self.ring_distance(lat, lon, row, column, ring) <= best_distance:
+            rows = [(row - ring, column - ring, column + ring)]
+            if ring:
+                rows.append((row + ring, column - ring, column + ring))
+                for r in xrange(row - ring + 1, row + ring):
+                    rows.append((r, column - ring, column - ring))
+                    rows.append((r, column + ring, column + ring))
+            for r, first, last in rows:
+                for i in self.row_addresses(r, first, last):
+                    _, address_lat, address_lon = self.addresses[i][:3]
+                    d = distance(lat, lon, address_lat, address_lon)
+                    if d <= best_distance:
+                        best, best_distance = i, d
+            ring += 1
+        if best is None:
+            return None
+        address = self.address(best)
+        address['distance'] = best_distance
+        return address
+
+
+def test():
+    import random
+    import shutil
+    import tempfile
+    from timeit import default_timer as timer
+    import data
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        xml = os.path.join(tmpdir, "test.osm")
+        with open(xml, "w") as fo:
+            fo.write("""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="52.5200066" lon="13.404954">
+    <tag k="addr:street" v="Heerstra\xc3\x9fe"/>
+    <tag k="addr:housenumber" v="4-6"/>
+  </node>
+  <node id="2" lat="52.5201" lon="13.4051">
+    <tag k="addr:street" v="Heerstr."/>
+    <tag k="addr:housenumber" v="5A"/>
+  </node>
+  <node id="3" lat="52.51" lon="13.38">
+    <tag k="addr:street" v="Potsdamer Chausee"/>
+    <tag k="addr:housenumber" v="1;3"/>
+  </node>
+  <node id="4" lat="52.6" lon="13.5"/>
+  <node id="6" lat="52.7" lon="13.61">
+    <tag k="addr:street" v="Am Park"/>
+    <tag k="addr:housenumber" v="030123456789"/>
+    <tag k="id" v="abc"/>
+    <tag k="type" v="multipolygon"/>
+  </node>
+  <node id="7" lat="52.7" lon="13.62">
+    <tag k="addr:street" v="Am Park"/>
+    <tag k="addr:housenumber" v="99999999999999999999"/>
+  </node>
+  <node id="5" lat="52.6" lon="13.5001"/>
+  <way id="10">
+    <nd ref="4"/>
+    <nd ref="5"/>
+    <tag k="addr:street" v="Am Park"/>
+    <tag k="addr:housenumber" v="1-99999"/>
+  </way>
+</osm>
+""")
+        for workers in (1, 2):
+            path = os.path.join(tmpdir, "addresses{0}".format(workers))
+            data.process_map(xml, workers=workers, geometry=True, addresses=path)
+            with AddressIndex(path) as index:
+                assert [a['id'] for a in index.lookup(u'Heerstraße', 5)] == ['1', '2']
+                assert [a['id'] for a in index.lookup('HEERSTR.', '6')] == ['1']
+                assert index.lookup('Heerstr.', 7) == []
+                assert index.lookup('Potsdamer Chaussee', 3) == [
+                    {'id': '3', 'pos': [52.51, 13.38], 'street': u'Potsdamer Chaussee', 'housenumber': u'1,3'}]
+                assert index.lookup('Potsdamer Chaussee', 2) == []
+                assert index.lookup('Am Park', 50000)[0]['pos'] == [52.6, 13.50005]
+                assert index.lookup('Nowhere', 1) == []
+                # the id and position come from the element, not from its id and type tags
+                assert index.lookup('Am Park', 30123456789) == [
+                    {'id': '6', 'pos': [52.7, 13.61], 'street': 'Am Park', 'housenumber': '030123456789'}]
+                assert index.lookup('Am Park', 99999999999999999999) == []
+                nearest = index.reverse(52.52002, 13.40496)
+                assert nearest['id'] == '1' and nearest['street'] == u'Heerstraße' and nearest['distance'] < 5
+                assert index.reverse(52.5102, 13.3802)['housenumber'] == u'1,3'
+                assert index.reverse(52.55, 13.45) is None
+                assert index.reverse(52.55, 13.45, max_distance=10000)['id'] in ('1', '2')
+
+        # a grid of random addresses: same answers as a scan over all of them
+        rand = random.Random(5)
+        path = os.path.join(tmpdir, "random")
+        points = []
+        with AddressIndexSink(path) as sink:
+            for i in xrange(20000):
+                lat, lon = 52.3 + rand.random() * 0.4, 13.1 + rand.random() * 0.6
+                points.append((lat, lon))
+                number = rand.randint(1, 200)
+                sink.add("node/{0}".format(i), {'id': str(i), 'type': 'node', 'pos': [lat, lon],
+                                'address': {'street': 'Street {0}'.format(i % 500),
+                                            'housenumber': [housenumbers.number_range(number, number + 4)]}})
+        with AddressIndex(path) as index:
+            for _ in xrange(200):
+                lat, lon = 52.3 + rand.random() * 0.4, 13.1 + rand.random() * 0.6
+                expected = min(xrange(len(points)), key=lambda i: distance(lat, lon, *points[i]))
+                assert index.reverse(lat, lon, max_distance=5000)['id'] == str(expected)
+            start = timer()
+            for i in xrange(10000):
+                index.lookup('Street {0}'.format(i % 500), i % 200)
+            lookup_time = (timer() - start) / 10000
+            start = timer()
+            for i in xrange(10000):
+                index.reverse(*points[i])
+            reverse_time = (timer() - start) / 10000
+            print "lookup {0:.1f}us, reverse {1:.1f}us".format(lookup_time * 1e6, reverse_time * 1e6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
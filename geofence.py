@@ -0,0 +1,319 @@
+"""
+Keeps the elements inside a boundary polygon.
+
+The boundary is read from an Osmosis .poly file or a GeoJSON Polygon or
+MultiPolygon. All rings are taken together with the even-odd rule, so holes
+and exclaves work without telling them apart.
+
+Geofence lays a grid over the bounding box of the boundary and marks every
+cell as inside, outside or on the boundary once. A point in an inside or
+outside cell is decided by looking up its cell. Only points in boundary cells
+get an exact ray casting test, against the edges that cross the row of grid
+cells they are in. contains_many() does all of this with NumPy on whole
+arrays of points. Without NumPy, contains() does the same for one point at a
+time.
+
+filter() applies the fence to the (key, shaped dict) pairs of process_map in
+batches: nodes by their pos, ways by their geometry (inside if any of their
+nodes is). Ways without a geometry are kept.
+"""
+import json
+from timeit import default_timer as timer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Cells of the grid along each axis
+GRID_SIZE = 256
+
+# Elements tested at a time by filter()
+BATCH_SIZE = 4096
+
+# Cell states
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+# Reason for dropping an element, as counted by metrics.Metrics
+OUTSIDE_GEOFENCE = 'outside_geofence'
+
+
+# Rings of (lon, lat) pairs from an Osmosis polygon file
+def read_poly(fi):
+    rings = []
+    ring = None
+    fi.readline()  # name of the polygon
+    for line in fi:
+        line = line.strip()
+        if not line:
+            continue
+        if line == 'END':
+            if ring is None:
+                break
+            rings.append(ring)
+            ring = None
+        elif ring is None:
+            ring = []  # section name, "!" marks a hole
+        else:
+            lon, lat = line.split()[:2]
+            ring.append((float(lon), float(lat)))
+    return rings
+
+# Rings of (lon, lat) pairs from a GeoJSON geometry, feature or feature
+# collection
+def read_geojson(geojson):
+    if geojson['type'] == 'FeatureCollection':
+        return [ring for feature in geojson['features'] for ring in read_geojson(feature)]
+    if geojson['type'] == 'Feature':
+        return read_geojson(geojson['geometry'])
+    if geojson['type'] == 'Polygon':
+        polygons = [geojson['coordinates']]
+    elif geojson['type'] == 'MultiPolygon':
+        polygons = geojson['coordinates']
+    else:
+        raise ValueError("{0}: not a polygon".format(geojson['type']))
+    return [[(float(lon), float(lat)) for lon, lat in ring] for polygon in polygons for ring in polygon]
+
+def load(path, grid_size=GRID_SIZE):
+    with open(path) as fi:
+        if path.lower().endswith('.poly'):
+            rings = read_poly(fi)
+        else:
+            rings = read_geojson(json.load(fi))
+    return Geofence(rings, grid_size)
+
+# Edges (x1, y1, x2, y2) of the rings, closed if they aren't already
+def ring_edges(rings):
+    edges = []
+    for ring in rings:
+        if len(ring) < 3:
+            continue
+        for i in xrange(len(ring)):
+            (x1, y1), (x2, y2) = ring[i - 1], ring[i]
+            if (x1, y1) != (x2, y2):
+                edges.append((float(x1), float(y1), float(x2), float(y2)))
+    return edges
+
+# Even-odd ray casting: is x, y inside the edges, counting the ones a ray to
+# the east crosses
+def crossings_inside(x, y, edges):
+    inside = False
+    for x1, y1, x2, y2 in edges:
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+class Geofence(object):
+    def __init__(self, rings, grid_size=GRID_SIZE):
+        self.edges = ring_edges(rings)
+        if not self.edges:
+            raise ValueError("the boundary has no polygon")
+        xs = [x for edge in self.edges for x in (edge[0], edge[2])]
+        ys = [y for edge in self.edges for y in (edge[1], edge[3])]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+        self.size = grid_size
+        self.dx = (self.bbox[2] - self.bbox[0]) / grid_size or 1.0
+        self.dy = (self.bbox[3] - self.bbox[1]) / grid_size or 1.0
+        # edges whose latitude range overlaps each row of cells
+        self.bands = [[] for _ in xrange(grid_size)]
+        for i, (x1, y1, x2, y2) in enumerate(self.edges):
+            for row in xrange(self.row(min(y1, y2)), self.row(max(y1, y2)) + 1):
+                self.bands[row].append(i)
+        self.grid = [[OUTSIDE] * grid_size for _ in xrange(grid_size)]
+        for edge in self.edges:
+            self.mark_boundary(*edge)
+        for row in xrange(grid_size):
+            band = [self.edges[i] for i in self.bands[row]]
+            y = self.bbox[1] + (row + 0.5) * self.dy
+            for column in xrange(grid_size):
+                if self.grid[row][column] != BOUNDARY:
+                    x = self.bbox[0] + (column + 0.5) * self.dx
+                    self.grid[row][column] = INSIDE if crossings_inside(x, y, band) else OUTSIDE
+        if numpy is not None:
+            self.cells = numpy.array(self.grid, dtype=numpy.uint8)
+            self.edge_array = numpy.array(self.edges, dtype=numpy.float64).T
+            self.band_arrays = [numpy.array(band, dtype=numpy.intp) for band in self.bands]
+
+    def row(self, y):
+        return min(max(int((y - self.bbox[1]) / self.dy), 0), self.size - 1)
+
+    def column(self, x):
+        return min(max(int((x - self.bbox[0]) / self.dx), 0), self.size - 1)
+
+    # Marks the cells an edge passes through, one column of cells at a time.
+    # The cells next to its ends are marked too, so a point on a cell border
+    # never ends up in an unmarked cell the edge touches.
+    def mark_boundary(self, x1, y1, x2, y2):
+        if x1 > x2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        first, last = self.column(x1 - self.dx * 1e-6), self.column(x2 + self.dx * 1e-6)
+        for column in xrange(first, last + 1):
+            left = max(x1, self.bbox[0] + column * self.dx)
+            right = min(x2, self.bbox[0] + (column + 1) * self.dx)
+            if x1 == x2:
+                low, high = min(y1, y2), max(y1, y2)
+            else:
+                y_left = y1 + (left - x1) * (y2 - y1) / (x2 - x1)
+                y_right = y1 + (right - x1) * (y2 - y1) / (x2 - x1)
+                low, high = min(y_left, y_right), max(y_left, y_right)
+            for row in xrange(self.row(low - self.dy * 1e-6), self.row(high + self.dy * 1e-6) + 1):
+                self.grid[row][column] = BOUNDARY
+
+    def in_bbox(self, lat, lon):
+        return self.bbox[0] <= lon <= self.bbox[2] and self.bbox[1] <= lat <= self.bbox[3]
+
+    def contains(self, lat, lon):
+        if not self.in_bbox(lat, lon):
+            return False
+        row = self.row(lat)
+        state = self.grid[row][self.column(lon)]
+        if state != BOUNDARY:
+            return state == INSIDE
+        return crossings_inside(lon, lat, [self.edges[i] for i in self.bands[row]])
+
+    # Boolean array telling which of the points are inside
+    def contains_many(self, lats, lons):
+        if numpy is None:
+            return [self.contains(lat, lon) for lat, lon in zip(lats, lons)]
+        x = numpy.asarray(lons, dtype=numpy.float64)
+        y = numpy.asarray(lats, dtype=numpy.float64)
+        west, south, east, north = self.bbox
+        in_bbox = (x >= west) & (x <= east) & (y >= south) & (y <= north)
+        rows = numpy.clip(((y - south) / self.dy).astype(numpy.intp), 0, self.size - 1)
+        columns = numpy.clip(((x - west) / self.dx).astype(numpy.intp), 0, self.size - 1)
+        rows[~in_bbox] = 0
+        columns[~in_bbox] = 0
+        state = numpy.where(in_bbox, self.cells[rows, columns], OUTSIDE)
+        inside = state == INSIDE
+        boundary = numpy.flatnonzero(state == BOUNDARY)
+        if boundary.size:
+            inside[boundary] = self.exact(x[boundary], y[boundary], rows[boundary])
+        return inside
+
+    # Ray casting for points in boundary cells, a row of cells at a time,
+    # against the edges crossing that row
+    def exact(self, x, y, rows):
+        inside = numpy.zeros(len(x), dtype=bool)
+        order = numpy.argsort(rows, kind='mergesort')
+        rows = rows[order]
+        starts = numpy.flatnonzero(numpy.r_[True, rows[1:] != rows[:-1]])
+        ends = numpy.r_[starts[1:], len(rows)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            band = self.band_arrays[rows[start]]
+            x1, y1, x2, y2 = self.edge_array[:, band]
+            points = order[start:end]
+            px = x[points][:, None]
+            py = y[points][:, None]
+            spans = (y1 > py) != (y2 > py)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                crossing = spans & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+            inside[points] = crossing.sum(axis=1) % 2 == 1
+        return inside
+
+    # Yields the (key, shaped dict) pairs of keyed that are inside, testing
+    # batch_size of them at a time. Dropped elements and the time taken are
+    # counted in metrics.
+    def filter(self, keyed, metrics=None, batch_size=BATCH_SIZE):
+        batch = []
+        for item in keyed:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                for kept in self.filter_batch(batch, metrics):
+                    yield kept
+                batch = []
+        for kept in self.filter_batch(batch, metrics):
+            yield kept
+
+    def filter_batch(self, batch, metrics=None):
+        start = timer()
+        owners, lats, lons = [], [], []
+        keep = [False] * len(batch)
+        for i, (key, el) in enumerate(batch):
+            if key.startswith('node/'):
+                owners.append(i)
+                lats.append(el['pos'][0])
+                lons.append(el['pos'][1])
+            elif el.get('geometry'):
+                for lat, lon in el['geometry']:
+                    owners.append(i)
+                    lats.append(lat)
+                    lons.append(lon)
+            else:
+                keep[i] = True
+        for owner, inside in zip(owners, self.contains_many(lats, lons)):
+            if inside:
+                keep[owner] = True
+        if metrics is not None:
+            metrics.add_time('geofence', timer() - start)
+        for item, kept in zip(batch, keep):
+            if kept:
+                yield item
+            elif metrics is not None:
+                metrics.drop(OUTSIDE_GEOFENCE)
+
+
+def test():
+    import random
+    import math
+    global numpy
+
+    # a square with a square hole and a triangle next to it
+    rings = [[(0, 0), (10, 0), (10, 10), (0, 10)], [(3, 3), (6, 3), (6, 6), (3, 6), (3, 3)],
+             [(12, 0), (16, 0), (14, 4)]]
+    fence = Geofence(rings, grid_size=8)
+    for lat, lon, expected in [(1, 1, True), (4, 4, False), (8, 5, True), (1, 14, True), (3.9, 14, True),
+                               (3.9, 12.1, False), (11, 5, False), (-1, 5, False), (5, 11, False)]:
+        assert fence.contains(lat, lon) == expected, (lat, lon)
+        assert list(fence.contains_many([lat], [lon])) == [expected]
+
+    # a jagged ring with many vertices: the grid answers the same as plain ray
+    # casting over all edges
+    rand = random.Random(20)
+    ring = []
+    for i in xrange(997):
+        angle = 2 * math.pi * i / 997
+        radius = 0.2 * (1 + 0.3 * rand.random())
+        ring.append((13.4 + radius * 1.6 * math.cos(angle), 52.5 + radius * math.sin(angle)))
+    fence = Geofence([ring])
+    lats = [rand.uniform(52.2, 52.8) for _ in xrange(20000)]
+    lons = [rand.uniform(12.9, 13.9) for _ in xrange(20000)]
+    expected = [crossings_inside(lon, lat, fence.edges) for lat, lon in zip(lats, lons)]
+    assert [fence.contains(lat, lon) for lat, lon in zip(lats, lons)] == expected
+    if numpy is not None:
+        assert fence.contains_many(lats, lons).tolist() == expected
+        saved, numpy = numpy, None
+        try:
+            assert fence.contains_many(lats, lons) == expected
+        finally:
+            numpy = saved
+    assert 0 < sum(expected) < len(expected)
+
+    # the file formats
+    import os
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "berlin.poly")
+        with open(path, "w") as fo:
+            fo.write("berlin\n1\n")
+            for lon, lat in ring:
+                fo.write("   {0:E}   {1:E}\n".format(lon, lat))
+            fo.write("END\n!2\n   13.4 52.5\n   13.41 52.5\n   13.41 52.51\nEND\nEND\n")
+        from_poly = load(path)
+        path = os.path.join(tmpdir, "berlin.geojson")
+        with open(path, "w") as fo:
+            json.dump({'type': 'Feature', 'geometry': {'type': 'MultiPolygon', 'coordinates': [
+                [ring + [ring[0]], [(13.4, 52.5), (13.41, 52.5), (13.41, 52.51), (13.4, 52.5)]]]}}, fo)
+        from_geojson = load(path)
+        for fence in (from_poly, from_geojson):
+            assert fence.contains(52.6, 13.4) and not fence.contains(52.501, 13.409)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,200 @@
+"""
+House number ranges.
+
+update_housenumber turns a tag like "4-6" into a range entry
+{"from": 4, "to": 6} instead of the list of all numbers in it, so a bad tag
+like "1-99999" costs one small dict instead of 100k strings. A shaped address
+keeps a list of entries: plain strings ("12", "12A") and ranges.
+
+expand() lists the numbers of such a list, with ranges longer than a limit
+left as one "from-to" string. HousenumberIndex answers "is house number N on
+this street" from the ranges as they are, without expanding any of them.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import json
+import re
+
+# Ranges longer than this are not expanded by expand()
+EXPAND_LIMIT = 1000
+
+# Intervals spanning at least this many numbers are kept apart by
+# StreetIntervals and in the intervals.dat of a geocoder index
+LONG_RANGE = 64
+
+leading_digits = re.compile(r'[0-9]+')
+
+
+def number_range(first, last):
+    return {'from': first, 'to': last}
+
+def is_range(entry):
+    return isinstance(entry, dict)
+
+# Lowest and highest number of an entry, None for entries without a number
+# like "A3". Letters after the number are ignored, "12A" counts as 12.
+def bounds(entry):
+    if is_range(entry):
+        return entry['from'], entry['to']
+    m = leading_digits.match(entry)
+    if not m:
+        return None
+    number = int(m.group())
+    return number, number
+
+# Yields the house numbers of a list of entries as strings. A range with more
+# than limit numbers is yielded as a single "from-to" string.
+def expand(entries, limit=EXPAND_LIMIT):
+    for entry in entries:
+        if not is_range(entry):
+            yield entry
+        elif entry['to'] - entry['from'] + 1 > limit:
+            yield "{0}-{1}".format(entry['from'], entry['to'])
+        else:
+            for number in xrange(entry['from'], entry['to'] + 1):
+                yield str(number)
+
+def contains(entries, number):
+    for entry in entries:
+        found = bounds(entry)
+        if found and found[0] <= number <= found[1]:
+            return True
+    return False
+
+
+# Splits (first, last, key) intervals sorted by first number into the short
+# ones and the ones spanning at least LONG_RANGE numbers
+def split_intervals(intervals):
+    short = [interval for interval in intervals if interval[1] - interval[0] < LONG_RANGE]
+    longer = [interval for interval in intervals if interval[1] - interval[0] >= LONG_RANGE]
+    return short, longer
+
+# Sorted intervals containing number, out of the short intervals of a street at
+# records[first:first + short] and its longer ones right after them, both
+# sorted by first number. records is a list, or the mapped intervals.dat of
+# a geocoder index.
+def find_intervals(records, number, first, short, longer):
+    found = []
+    end = first + short
+    for i in xrange(bisect_left(records, (number - LONG_RANGE + 1,), first, end),
+                    bisect_left(records, (number + 1,), first, end)):
+        if records[i][1] >= number:
+            found.append(records[i])
+    for i in xrange(end, end + longer):
+        interval = records[i]
+        if interval[0] > number:
+            break
+        if interval[1] >= number:
+            found.append(interval)
+    found.sort()
+    return found
+
+
+class StreetIntervals(object):
+    """
+    The house number intervals of one street. The short ones are sorted by
+    their first number, N can only be in those starting at most LONG_RANGE - 1
+    below it, found with two binary searches. The few longer ones, like a bad
+    1-99999 range, are kept apart and checked one by one, so they don't make
+    every lookup on their street walk over all intervals.
+    """
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals)
+        self.short, self.long = split_intervals(self.intervals)
+        self.records = self.short + self.long
+
+    # Keys of the intervals containing number
+    def lookup(self, number):
+        found = find_intervals(self.records, number, 0, len(self.short), len(self.long))
+        return [key for _, _, key in found]
+
+
+class HousenumberIndex(object):
+    """
+    Interval index over the house numbers of shaped addresses, by street.
+    add() collects them, lookup(street, number) returns the keys (e.g. the
+    element ids) of the addresses on street whose numbers include number.
+    """
+    def __init__(self):
+        self.pending = defaultdict(list)
+        self.streets = {}
+
+    def add(self, street, entries, key):
+        for entry in entries:
+            found = bounds(entry)
+            if found and found[0] <= found[1]:
+                self.pending[street].append((found[0], found[1], key))
+
+    # Adds the address of a shaped document, keyed by its id
+    def add_doc(self, doc):
+        address = doc.get('address') or {}
+        if 'street' in address and 'housenumber' in address:
+            self.add(address['street'], address['housenumber'], doc['id'])
+
+    def build(self):
+        for street, intervals in self.pending.items():
+            if street in self.streets:
+                intervals = intervals + self.streets[street].intervals
+            self.streets[street] = StreetIntervals(intervals)
+        self.pending.clear()
+
+    def lookup(self, street, number):
+        if self.pending:
+            self.build()
+        intervals = self.streets.get(street)
+        return intervals.lookup(number) if intervals else []
+
+    def has(self, street, number):
+        return bool(self.lookup(street, number))
+
+
+# Builds the index over a JSON lines output of process_map
+def from_json(file_json):
+    import osmio
+    index = HousenumberIndex()
+    for line in osmio.open_input(file_json):
+        # lines blanked out by osmchange.apply_changes
+        if not line.isspace():
+            index.add_doc(json.loads(line))
+    index.build()
+    return index
+
+
+def test():
+    import random
+
+    assert list(expand(['1', number_range(4, 6), '12A'])) == ['1', '4', '5', '6', '12A']
+    assert list(expand([number_range(1, 99999)])) == ['1-99999']
+    assert len(list(expand([number_range(1, 99999)], limit=100000))) == 99999
+    assert bounds('12A') == (12, 12) and bounds('A3') is None
+    assert contains(['2', number_range(10, 20)], 15) and not contains(['2'], 3)
+
+    index = HousenumberIndex()
+    index.add('Heerstr.', [number_range(1, 99999)], 1)
+    index.add('Heerstr.', ['5', '7B'], 2)
+    index.add('Heerstr.', [number_range(4, 6)], 3)
+    index.add('Seeweg', [number_range(20, 18), 'x'], 4)
+    assert index.lookup('Heerstr.', 5) == [1, 3, 2]
+    assert index.lookup('Heerstr.', 7) == [1, 2]
+    assert index.lookup('Heerstr.', 100000) == []
+    assert index.lookup('Heerstr.', 0) == []
+    assert not index.has('Seeweg', 19) and not index.has('Am Park', 1)
+    index.add('Heerstr.', [number_range(100000, 100002)], 5)
+    assert index.lookup('Heerstr.', 100001) == [5]
+
+    # a wide interval at the start of a street stays out of the search over
+    # the short ones
+    intervals = StreetIntervals([(1, 99999, 'wide')] + [(i * 10, i * 10 + 1, i) for i in xrange(100000)])
+    assert len(intervals.long) == 1 and len(intervals.short) == 100000
+    assert intervals.lookup(500001) == [50000] and intervals.lookup(500005) == []
+    assert intervals.lookup(50001) == ['wide', 5000]
+    rand = random.Random(17)
+    entries = [(first, first + rand.choice([0, 1, 5, 63, 64, 500]), key)
+               for key, first in enumerate(rand.randint(1, 2000) for _ in xrange(2000))]
+    intervals = StreetIntervals(entries)
+    for number in xrange(0, 2600, 7):
+        assert intervals.lookup(number) == [key for first, last, key in sorted(entries) if first <= number <= last]
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,234 @@
+"""
+Opt-in instrumentation for process_map.
+
+Pass metrics=Metrics() to process_map to get
+- the time spent parsing, shaping (normalizers included), in each normalizer,
+  adding geometry and serializing (the sink),
+- the number of elements written and of elements dropped, by reason,
+- a progress line on stderr every report_interval seconds with the bytes per
+  second and, for uncompressed XML inputs, the ETA from the input offset,
+- a JSON summary written when the run ends, also when it fails.
+
+Without it none of this is measured and the pipeline runs as before.
+"""
+from collections import defaultdict
+import json
+import os
+import sys
+from timeit import default_timer as timer
+import osmio
+
+# Seconds between two progress lines
+REPORT_INTERVAL = 10.0
+
+# Elements between two looks at the clock
+TICK_ELEMENTS = 1000
+
+
+class CountingReader(object):
+    """
+    Reads from an input opened with osmio.open_input and counts the bytes
+    handed to the parser.
+    """
+    def __init__(self, osmfile):
+        self.owned = isinstance(osmfile, basestring)
+        self.fi = osmio.open_input(osmfile)
+        self.offset = 0
+
+    def read(self, size=-1):
+        data = self.fi.read(size)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        if self.owned:
+            self.fi.close()
+
+
+class TimedNormalizers(object):
+    """
+    Wraps the normalizers used by data.shape_tag (audit or an
+    audit.CachedNormalizers) and adds the time spent in each of them to
+    metrics. The wrapped normalizers stay at hand as wrapped.
+    """
+    def __init__(self, normalizers, names, metrics):
+        self.wrapped = normalizers
+        for name in names:
+            setattr(self, name, self.timed(name, getattr(normalizers, name), metrics))
+
+    @staticmethod
+    def timed(name, normalizer, metrics):
+        stage = 'normalize:' + name
+        times = metrics.times
+        calls = metrics.calls
+
+        def call(value):
+            start = timer()
+            result = normalizer(value)
+            times[stage] += timer() - start
+            calls[stage] += 1
+            return result
+        return call
+
+
+class Metrics(object):
+    def __init__(self, path=None, report_interval=REPORT_INTERVAL, out=sys.stderr):
+        self.path = path
+        self.report_interval = report_interval
+        self.out = out
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.dropped = defaultdict(int)
+        self.elements_out = 0
+        self.bytes_done = 0
+        self.total_bytes = None
+        self.reader = None
+        self.input = None
+        self.error = None
+        # stats of the data.KeyClassifier of the run, set by process_map
+        self.keys = None
+        self.start = timer()
+        self.elapsed = None
+        self.last_report = self.start
+
+    # Called by process_map before the run. The ETA needs the size of what
+    # the parser reads, which is only known for uncompressed XML.
+    def begin(self, file_in):
+        self.input = file_in
+        self.start = self.last_report = timer()
+        if not osmio.compression(file_in) and not file_in.lower().endswith('.pbf'):
+            self.total_bytes = os.path.getsize(file_in)
+
+    def wrap_input(self, osmfile):
+        self.reader = CountingReader(osmfile)
+        return self.reader
+
+    def timed_normalizers(self, normalizers, names):
+        return TimedNormalizers(normalizers, names, self)
+
+    def add_time(self, stage, seconds):
+        self.times[stage] += seconds
+
+    # Yields the items of iterable, adding the time spent getting each of
+    # them to stage
+    def timed(self, stage, iterable):
+        iterator = iter(iterable)
+        times = self.times
+        while True:
+            start = timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                times[stage] += timer() - start
+                return
+            times[stage] += timer() - start
+            yield item
+
+    def drop(self, reason):
+        self.dropped[reason] += 1
+
+    # Takes back count written elements that a later stage dropped, like the
+    # duplicates removed by dedup.DedupSink
+    def drop_written(self, reason, count):
+        self.dropped[reason] += count
+        self.elements_out -= count
+
+    def written(self):
+        self.elements_out += 1
+        if self.elements_out % TICK_ELEMENTS == 0:
+            self.tick()
+
+    # Adds the bytes of a finished part of the input, e.g. a shard
+    def advance(self, size):
+        self.bytes_done += size
+
+    def tick(self):
+        if self.report_interval is not None and timer() - self.last_report >= self.report_interval:
+            self.report_progress()
+
+    def offset(self):
+        return self.bytes_done + (self.reader.offset if self.reader is not None else 0)
+
+    def progress(self):
+        elapsed = (self.elapsed if self.elapsed is not None else timer() - self.start) or 1e-9
+        offset = self.offset()
+        bytes_per_second = offset / elapsed
+        eta = None
+        if self.total_bytes and bytes_per_second:
+            eta = max(0.0, (self.total_bytes - offset) / bytes_per_second)
+        return {
+            'elapsed': elapsed,
+            'bytes': offset,
+            'total_bytes': self.total_bytes,
+            'bytes_per_second': bytes_per_second,
+            'elements_per_second': self.elements_out / elapsed,
+            'eta': eta
+        }
+
+    def report_progress(self):
+        self.last_report = timer()
+        progress = self.progress()
+        line = "{0:.1f} MB".format(progress['bytes'] / 1e6)
+        if progress['total_bytes']:
+            line += " of {0:.1f} MB ({1:.1%})".format(progress['total_bytes'] / 1e6,
+                                                     float(progress['bytes']) / progress['total_bytes'])
+        line += ", {0:.2f} MB/s, {1:.0f} elements/s".format(progress['bytes_per_second'] / 1e6,
+                                                            progress['elements_per_second'])
+        if progress['eta'] is not None:
+            line += ", ETA {0:.0f}s".format(progress['eta'])
+        self.out.write(line + "\n")
+
+    def parse_error(self, error):
+        self.error = {'message': str(error), 'line': error.position[0], 'column': error.position[1]}
+
+    # Raw counters, as needed by merge, e.g. to add up the metrics of the
+    # worker processes in parallel mode
+    def counters(self):
+        return {
+            'times': dict(self.times),
+            'calls': dict(self.calls),
+            'dropped': dict(self.dropped),
+            'elements_out': self.elements_out
+        }
+
+    def merge(self, counters):
+        for stage, seconds in counters['times'].items():
+            self.times[stage] += seconds
+        for stage, calls in counters['calls'].items():
+            self.calls[stage] += calls
+        for reason, count in counters['dropped'].items():
+            self.dropped[reason] += count
+        self.elements_out += counters['elements_out']
+
+    def summary(self):
+        summary = {
+            'input': self.input,
+            'elements_in': self.elements_out + sum(self.dropped.values()),
+            'elements_out': self.elements_out,
+            'dropped': dict(self.dropped),
+            'times': dict(self.times),
+            'calls': dict(self.calls),
+            'keys': self.keys,
+            'error': self.error
+        }
+        summary.update(self.progress())
+        return summary
+
+    # Stops the clock and writes the summary to path, or to the path given
+    # to the constructor
+    def finish(self, path=None):
+        self.elapsed = timer() - self.start
+        path = self.path or path
+        if path:
+            with open(path, 'w') as fo:
+                json.dump(self.summary(), fo, indent=2, sort_keys=True)
+        if self.report_interval is not None:
+            self.report_progress()
+
+    def report(self):
+        summary = self.summary()
+        print "{0[elements_in]} elements in, {0[elements_out]} out, {0[elapsed]:.2f}s".format(summary)
+        for reason, count in sorted(summary['dropped'].items()):
+            print "  dropped ({0}): {1}".format(reason, count)
+        for stage, seconds in sorted(summary['times'].items()):
+            print "  {0}: {1:.3f}s".format(stage, seconds)
@@ -0,0 +1,215 @@
+"""
+Compact node coordinate store used to give ways their geometry.
+
+Ways only reference their nodes by id. NodeStore keeps the id and position of
+every node in three flat arrays instead of a dict per node: ids as 64 bit
+integers (an osmio.INT64 array) and latitude/longitude as 32 bit fixed point
+integers in units of 1e-7 degrees, the precision OSM stores coordinates with.
+That makes 16 bytes per node. The arrays are sorted by id, so a node is found
+by binary search, or by numpy.searchsorted for all nodes of a way at once if
+numpy is installed.
+
+Nodes usually come sorted by id already. If they don't, finish sorts them with
+numpy.argsort, which needs 8 more bytes per node for the order. Without numpy
+the order is a list of Python ints instead, about 32 bytes per node, so
+sorting a large unsorted file needs numpy to stay compact.
+"""
+from array import array
+from bisect import bisect_left
+import xml.parsers.expat as expat
+import osmio
+import pbf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Fixed point scale of the stored coordinates
+SCALE = 10000000
+
+
+# Copy of an array in the given order (a numpy array of positions)
+def reorder(values, order):
+    copy = array(values.typecode)
+    copy.fromstring(numpy.frombuffer(values, dtype=numpy.dtype(values.typecode))[order].tostring())
+    return copy
+
+
+class NodeStore(object):
+    def __init__(self):
+        self.ids = array(osmio.INT64)
+        self.lats = array('i')
+        self.lons = array('i')
+        self.is_sorted = True
+        self.index = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if self.ids and node_id <= self.ids[-1]:
+            self.is_sorted = False
+        self.ids.append(node_id)
+        self.lats.append(int(round(float(lat) * SCALE)))
+        self.lons.append(int(round(float(lon) * SCALE)))
+
+    # Has to be called once all nodes are added
+    def finish(self):
+        if not self.is_sorted:
+            if numpy is not None:
+                order = numpy.argsort(numpy.frombuffer(self.ids, dtype=numpy.dtype(osmio.INT64)), kind='mergesort')
+                self.ids, self.lats, self.lons = (reorder(values, order) for values in (self.ids, self.lats, self.lons))
+            else:
+                order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+                self.ids = array(osmio.INT64, (self.ids[i] for i in order))
+                self.lats = array('i', (self.lats[i] for i in order))
+                self.lons = array('i', (self.lons[i] for i in order))
+            self.is_sorted = True
+        if numpy is not None:
+            # views on the same memory, no copy
+            self.index = (numpy.frombuffer(self.ids, dtype=numpy.dtype(osmio.INT64)),
+                          numpy.frombuffer(self.lats, dtype=numpy.int32),
+                          numpy.frombuffer(self.lons, dtype=numpy.int32))
+        return self
+
+    # Returns [lat, lon] of a node, or None for an unknown node
+    def get(self, node_id):
+        node_id = int(node_id)
+        i = bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return [self.lats[i] / float(SCALE), self.lons[i] / float(SCALE)]
+        return None
+
+    # Returns the [lat, lon] pairs of all known nodes among refs, in order
+    def coordinates(self, refs):
+        if self.index is None or not len(self.ids):
+            return [pos for pos in (self.get(ref) for ref in refs) if pos]
+        ids, lats, lons = self.index
+        wanted = numpy.array([int(ref) for ref in refs], dtype=numpy.dtype(osmio.INT64))
+        found = numpy.searchsorted(ids, wanted)
+        found[found == len(ids)] = 0
+        found = found[ids[found] == wanted]
+        return zip((lats[found] / float(SCALE)).tolist(), (lons[found] / float(SCALE)).tolist())
+
+    def save(self, path):
+        with open(path, 'wb') as fo:
+            osmio.write_int64(fo, array(osmio.INT64, [len(self.ids)]))
+            osmio.write_int64(fo, self.ids)
+            self.lats.tofile(fo)
+            self.lons.tofile(fo)
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        with open(path, 'rb') as fi:
+            count = int(osmio.read_int64(fi, 1)[0])
+            store.ids = osmio.read_int64(fi, count)
+            store.lats.fromfile(fi, count)
+            store.lons.fromfile(fi, count)
+        return store.finish()
+
+
+# Collects the coordinates of all nodes of an OSM file. Only node start tags
+# are looked at, so this is a lot cheaper than shaping the file.
+def build(osm_file):
+    store = NodeStore()
+    if pbf.is_pbf(osm_file):
+        for tag, attrib, tags, refs in pbf.iter_primitives(osm_file):
+            if tag == 'node':
+                store.add(attrib['id'], attrib['lat'], attrib['lon'])
+        return store.finish()
+
+    def start(name, attrib):
+        if name == 'node' and 'lat' in attrib and 'lon' in attrib:
+            store.add(attrib['id'], attrib['lat'], attrib['lon'])
+
+    parser = expat.ParserCreate()
+    parser.returns_unicode = False
+    parser.StartElementHandler = start
+    reader = osmio.open_input(osm_file)
+    try:
+        parser.ParseFile(reader)
+    finally:
+        if reader is not osm_file:
+            reader.close()
+    return store.finish()
+
+
+# Adds the coordinates of its nodes and their bounding box
+# ([min lat, min lon, max lat, max lon]) to a shaped way
+def add_geometry(way, store):
+    refs = way.get('node_refs')
+    if not refs:
+        return way
+    geometry = [list(pos) for pos in store.coordinates(refs)]
+    if geometry:
+        lats = [pos[0] for pos in geometry]
+        lons = [pos[1] for pos in geometry]
+        way['geometry'] = geometry
+        way['bbox'] = [min(lats), min(lons), max(lats), max(lons)]
+    return way
+
+
+def test():
+    store = NodeStore()
+    store.add('5', '52.5200066', '13.4049540')
+    store.add('2', '-33.8688197', '151.2092955')
+    store.add('9', '0.0000001', '-0.0000001')
+    store.finish()
+    assert store.get('2') == [float('-33.8688197'), float('151.2092955')]
+    assert store.get('5') == [float('52.5200066'), float('13.4049540')]
+    assert store.get('3') is None
+    assert store.get('10') is None
+    assert [list(pos) for pos in store.coordinates(['9', '3', '5'])] == [[1e-07, -1e-07], [52.5200066, 13.404954]]
+
+    way = add_geometry({'type': 'way', 'node_refs': ['2', '5', '7']}, store)
+    assert way['geometry'] == [[-33.8688197, 151.2092955], [52.5200066, 13.404954]]
+    assert way['bbox'] == [-33.8688197, 13.404954, 52.5200066, 151.2092955]
+
+    # unsorted nodes, sorted with and without numpy
+    global numpy
+    installed = numpy
+    try:
+        for numpy in set([installed, None]):
+            store = NodeStore()
+            for node_id in (7, 3, 4294967299, 1, 3):
+                store.add(node_id, node_id % 90, -node_id % 180)
+            store.finish()
+            assert list(store.ids) == [1, 3, 3, 7, 4294967299]
+            assert list(store.lats) == [node_id % 90 * SCALE for node_id in store.ids]
+            assert list(store.lons) == [-node_id % 180 * SCALE for node_id in store.ids]
+            assert store.ids.typecode == osmio.INT64 and store.lats.typecode == 'i'
+    finally:
+        numpy = installed
+
+    # ids beyond 32 bits, also where they are kept as doubles, and a round
+    # trip through a file
+    import os
+    import tempfile
+    typecode = osmio.INT64
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        for osmio.INT64 in (typecode, 'd'):
+            store = NodeStore()
+            store.add('12345678901', '52.5', '13.4')
+            store.add('4294967297', '-33.8', '151.2')
+            store.add('1', '0.0', '0.0')
+            store.finish()
+            store.save(path)
+            for found in (store, NodeStore.load(path)):
+                assert found.ids.typecode == osmio.INT64
+                assert found.get('12345678901') == [52.5, 13.4]
+                assert found.get('1') == [0.0, 0.0]
+                assert found.get('4294967296') is None and found.get('12345678902') is None
+                assert [list(pos) for pos in found.coordinates(['4294967297', '1'])] == [[-33.8, 151.2], [0.0, 0.0]]
+        assert os.path.getsize(path) == 8 + 3 * 16
+    finally:
+        osmio.INT64 = typecode
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
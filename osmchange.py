@@ -0,0 +1,323 @@
+"""
+Applies OSM change files (.osc) to the output of data.process_map, so a daily
+diff doesn't mean shaping the whole extract again.
+
+The output has to be written with process_map(..., index=True), which stores
+the byte offset and length of the line of every element in a dbm file next to
+it. The elements of the change file are shaped with data.shape_element like
+any other element. Unchanged lines are never touched: the line of a modified
+or deleted element is blanked out in place (overwritten with spaces, so all
+other offsets stay valid) and new versions are appended to the end of the
+file. compact() drops the blanked lines again once they pile up.
+
+sinks.iter_keyed, and with it the column, address and tile copies made from
+the file, and housenumbers.from_json skip the blanked lines. Anything else
+reading the file line by line, mongoimport included, needs compact() first.
+
+apply_changes has to shape the elements the way process_map did: pass the
+same tag_filter and geofence, and if it ran with geometry=True, a
+nodestore.NodeStore of the input it was given as nodes. Created and modified
+nodes of the change file take precedence over the store. Ways that are not in
+the change file keep their geometry, even if some of their nodes moved.
+"""
+from collections import defaultdict
+import json
+import os
+import shutil
+import tempfile
+import xml.etree.cElementTree as ET
+import audit
+import data
+import geofence as fences
+import nodestore
+import osmio
+
+ACTIONS = ('create', 'modify', 'delete')
+
+
+# Yields (action, element) for every node, way and relation of a change file
+def iter_changes(osc_file):
+    osm_file = osmio.open_input(osc_file)
+    try:
+        context = ET.iterparse(osm_file, events=("start", "end"))
+        event, root = next(context)
+        action = None
+        block = None
+        for event, elem in context:
+            if event == "start":
+                if elem.tag in ACTIONS:
+                    action = elem.tag
+                    block = elem
+                continue
+            if elem.tag in osmio.TOP_LEVEL:
+                yield action, elem
+                elem.clear()
+                if block is not None:
+                    del block[:]
+            elif elem.tag in ACTIONS:
+                action = block = None
+                root.clear()
+    finally:
+        if osm_file is not osc_file:
+            osm_file.close()
+
+
+# Overwrites a line with spaces, keeping its newline
+def blank_line(fo, location):
+    offset, length = location
+    fo.seek(offset)
+    fo.write(" " * (length - 1))
+
+
+class ChangedNodes(object):
+    """
+    Positions of the nodes of a change file in front of the node store of
+    the original input, for the geometry of the ways of the change file.
+    Deleted nodes have none.
+    """
+    def __init__(self, nodes, osc_file):
+        self.nodes = nodes
+        self.changed = {}
+        for action, elem in iter_changes(osc_file):
+            if elem.tag != 'node':
+                continue
+            attrib = elem.attrib
+            if action == 'delete' or 'lat' not in attrib or 'lon' not in attrib:
+                self.changed[int(attrib['id'])] = None
+            else:
+                # rounded the way the store keeps them
+                self.changed[int(attrib['id'])] = [int(round(float(attrib[name]) * nodestore.SCALE)) /
+                                                   float(nodestore.SCALE) for name in ('lat', 'lon')]
+
+    def get(self, node_id):
+        node_id = int(node_id)
+        if node_id in self.changed:
+            return self.changed[node_id]
+        return self.nodes.get(node_id)
+
+    def coordinates(self, refs):
+        if not any(int(ref) in self.changed for ref in refs):
+            return self.nodes.coordinates(refs)
+        return [pos for pos in (self.get(ref) for ref in refs) if pos]
+
+
+# Applies the changes in osc_file to file_out and its index. Returns how many
+# lines were blanked out and written. nodes, geofence and tag_filter are the
+# options process_map shaped file_out with, see above.
+def apply_changes(osc_file, file_out, normalizers=audit, nodes=None, geofence=None, tag_filter=True):
+    if isinstance(geofence, basestring):
+        geofence = fences.load(geofence)
+    if nodes is not None:
+        nodes = ChangedNodes(nodes, osc_file)
+    exclude = data.is_excluded if tag_filter else None
+    index = osmio.OffsetIndex(file_out + ".idx", 'w')
+    counts = defaultdict(int)
+    try:
+        with open(file_out, "r+b") as fo:
+            fo.seek(0, os.SEEK_END)
+            end = fo.tell()
+            for action, elem in iter_changes(osc_file):
+                key = data.element_key(elem.tag, elem.attrib.get('id'))
+                counts[action] += 1
+                old = index.get(key)
+                if old is not None:
+                    blank_line(fo, old)
+                    del index[key]
+                    counts['blanked'] += 1
+                if action == 'delete':
+                    continue
+                el = data.shape_element(elem, normalizers, exclude)
+                if el and nodes is not None and elem.tag == 'way':
+                    nodestore.add_geometry(el, nodes)
+                if el and geofence is not None and not list(geofence.filter_batch([(key, el)])):
+                    el = None
+                if el:
+                    line = json.dumps(el) + "\n"
+                    fo.seek(end)
+                    fo.write(line)
+                    index[key] = (end, len(line))
+                    end += len(line)
+                    counts['written'] += 1
+    finally:
+        index.close()
+    return counts
+
+
+# Rewrites file_out without the blanked out lines and rebuilds its index
+def compact(file_out):
+    index = osmio.OffsetIndex(file_out + ".idx", 'w')
+    keys = dict((index[key][0], key) for key in index.db.keys())
+    index.close()
+    index = osmio.OffsetIndex(file_out + ".idx", 'n')
+    compacted = file_out + ".compact"
+    try:
+        with open(file_out, "rb") as fi:
+            with open(compacted, "wb") as fo:
+                offset = 0
+                for line in fi:
+                    if line.strip():
+                        fo.write(line)
+                        index.add(keys[offset], fo.tell() - len(line), len(line))
+                    offset += len(line)
+        os.rename(compacted, file_out)
+    finally:
+        index.close()
+
+
+BEFORE = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.5" lon="13.4">
+    <tag k="addr:street" v="Heerstr."/>
+    <tag k="addr:housenumber" v="4-6"/>
+  </node>
+  <node id="2" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.6" lon="13.5">
+    <tag k="addr:street" v="Potsdamer Chausee"/>
+  </node>
+  <node id="3" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.7" lon="13.6"/>
+  <way id="10" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1">
+    <nd ref="1"/>
+    <nd ref="2"/>
+  </way>
+</osm>
+"""
+
+CHANGES = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <modify>
+    <node id="2" version="2" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.6" lon="13.5">
+      <tag k="addr:street" v="Potsdamer Chausee"/>
+      <tag k="phone" v="030 123456"/>
+    </node>
+  </modify>
+  <delete>
+    <node id="3" version="2" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2"/>
+  </delete>
+  <create>
+    <node id="4" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="13.7">
+      <tag k="addr:postcode" v="10115"/>
+    </node>
+    <node id="5" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="13.7">
+      <tag k="addr:country" v="PL"/>
+    </node>
+  </create>
+</osmChange>
+"""
+
+# BEFORE with CHANGES applied
+AFTER = BEFORE.replace('''    <tag k="addr:street" v="Potsdamer Chausee"/>
+  </node>
+  <node id="3" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.7" lon="13.6"/>''', '''    <tag k="addr:street" v="Potsdamer Chausee"/>
+    <tag k="phone" v="030 123456"/>
+  </node>
+  <node id="4" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="13.7">
+    <tag k="addr:postcode" v="10115"/>
+  </node>''').replace('<node id="2" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1"',
+                      '<node id="2" version="2" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2"')
+
+
+# Moves node 1, adds node 4 to way 10, creates node 5 outside the geofence and
+# node 6 in Poland
+CHANGES_OPTIONS = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <create>
+    <node id="4" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="13.7"/>
+    <node id="5" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="14.7"/>
+    <node id="6" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="13.7">
+      <tag k="addr:country" v="PL"/>
+    </node>
+  </create>
+  <modify>
+    <node id="1" version="2" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.55" lon="13.4">
+      <tag k="addr:street" v="Heerstr."/>
+      <tag k="addr:housenumber" v="4-6"/>
+    </node>
+    <way id="10" version="2" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2">
+      <nd ref="1"/>
+      <nd ref="2"/>
+      <nd ref="4"/>
+    </way>
+  </modify>
+</osmChange>
+"""
+
+# BEFORE with CHANGES_OPTIONS applied
+AFTER_OPTIONS = BEFORE.replace('''<node id="1" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1" lat="52.5"''',
+                               '''<node id="1" version="2" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.55"''').replace(
+    '''  <way id="10" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="u" uid="1">
+    <nd ref="1"/>
+    <nd ref="2"/>''', '''  <node id="4" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="13.7"/>
+  <node id="5" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="14.7"/>
+  <node id="6" version="1" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2" lat="52.8" lon="13.7">
+    <tag k="addr:country" v="PL"/>
+  </node>
+  <way id="10" version="2" changeset="2" timestamp="2014-02-01T00:00:00Z" user="v" uid="2">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="4"/>''')
+
+
+def read_lines(file_out):
+    with open(file_out) as fi:
+        return [line for line in fi if line.strip()]
+
+
+def test():
+    import housenumbers
+    import sinks
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        before = os.path.join(tmpdir, "before.osm")
+        after = os.path.join(tmpdir, "after.osm")
+        changes = os.path.join(tmpdir, "changes.osc")
+        for path, content in ((before, BEFORE), (after, AFTER), (changes, CHANGES)):
+            with open(path, "w") as fo:
+                fo.write(content)
+        data.process_map(before, index=True)
+        data.process_map(after)
+
+        with open(before + ".json") as fi:
+            first_line = fi.readline()
+        counts = apply_changes(changes, before + ".json")
+        assert dict(counts) == {'modify': 1, 'delete': 1, 'create': 2, 'blanked': 2, 'written': 2}
+        with open(before + ".json") as fi:
+            assert fi.readline() == first_line
+        assert sorted(read_lines(before + ".json")) == sorted(read_lines(after + ".json"))
+        # the readers of the output skip the blanked lines
+        assert sorted(key for key, doc in sinks.iter_keyed(before + ".json")) == [
+            "node/1", "node/2", "node/4", "way/10"]
+        assert housenumbers.from_json(before + ".json").lookup("Heerstr.", 5) == ["1"]
+
+        compact(before + ".json")
+        index = osmio.OffsetIndex(before + ".json.idx", 'r')
+        with open(before + ".json") as fi:
+            offset, length = index["node/2"]
+            fi.seek(offset)
+            assert json.loads(fi.read(length))['created']['version'] == "2"
+        assert "node/3" not in index
+        index.close()
+        assert sorted(read_lines(before + ".json")) == sorted(read_lines(after + ".json"))
+
+        # the options of process_map: ways get their geometry from the store
+        # and the changed nodes, the geofence and tag filter apply to what is
+        # written
+        for path, content in ((before, BEFORE), (after, AFTER_OPTIONS), (changes, CHANGES_OPTIONS)):
+            with open(path, "w") as fo:
+                fo.write(content)
+        boundary = os.path.join(tmpdir, "boundary.poly")
+        with open(boundary, "w") as fo:
+            fo.write("square\n1\n 13.0 52.0\n 14.0 52.0\n 14.0 53.0\n 13.0 53.0\nEND\nEND\n")
+        options = {'geofence': boundary, 'tag_filter': False}
+        data.process_map(before, index=True, geometry=True, **options)
+        data.process_map(after, geometry=True, **options)
+        counts = apply_changes(changes, before + ".json", nodes=nodestore.build(before), **options)
+        assert dict(counts) == {'modify': 2, 'create': 3, 'blanked': 2, 'written': 4}
+        assert sorted(read_lines(before + ".json")) == sorted(read_lines(after + ".json"))
+        way = [json.loads(line) for line in read_lines(before + ".json") if '"way"' in line][0]
+        assert way['geometry'] == [[52.55, 13.4], [52.6, 13.5], [52.8, 13.7]]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
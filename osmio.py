@@ -0,0 +1,371 @@
+"""
+Streaming access to OSM XML files shared by audit.py and data.py.
+
+Files ending in .gz, .bz2 or .zst are decompressed on the fly when read and
+compressed when written, see open_input and open_output.
+
+ET.iterparse keeps every parsed element attached to the document root, so a
+plain loop over a large extract grows in memory with the size of the file.
+iter_elements hands out one complete top level element at a time and drops it
+from the tree as soon as the caller moves on to the next one.
+"""
+from array import array
+import anydbm
+import bz2
+import gzip
+import os
+import re
+import struct
+import xml.etree.cElementTree as ET
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Elements that can appear directly below <osm>
+TOP_LEVEL = ("node", "way", "relation")
+
+# Extensions of the supported compression formats
+COMPRESSED = ('.gz', '.bz2', '.zst')
+
+# Size of the blocks written to compressed outputs
+BLOCK_SIZE = 1 << 20
+
+# Typecode of the arrays holding 64 bit integers such as element ids. The
+# array module of Python 2 has no 'q' and 'l' is 32 bit on Windows, where they
+# are kept as doubles, which hold every integer up to 2**53 exactly.
+INT64 = 'l' if array('l').itemsize == 8 else 'd'
+
+
+non_ascii = re.compile(r'[\x80-\xff]')
+
+# cElementTree hands out plain strings for ASCII text and unicode for anything
+# else. Parsers that see raw UTF-8 bytes (the expat engine, the PBF reader) do
+# the same, so all of them produce identical dicts.
+def decode_text(value):
+    if non_ascii.search(value):
+        return value.decode('utf-8')
+    return value
+
+
+def compression(path):
+    ext = os.path.splitext(path)[1].lower()
+    return ext if ext in COMPRESSED else None
+
+# Strips the compression extension, "berlin.osm.bz2" -> "berlin.osm"
+def strip_compression(path):
+    if compression(path):
+        return os.path.splitext(path)[0]
+    return path
+
+def check_zstandard(path):
+    if zstandard is None:
+        raise ImportError("{0}: reading and writing .zst files needs the zstandard package".format(path))
+
+
+# Opens a file for reading, decompressing it on the fly if its extension
+# says so. File objects are passed through as they are.
+def open_input(path):
+    if not isinstance(path, basestring):
+        return path
+    ext = compression(path)
+    if ext == '.gz':
+        return gzip.open(path, 'rb')
+    if ext == '.bz2':
+        return bz2.BZ2File(path, 'rb', BLOCK_SIZE)
+    if ext == '.zst':
+        check_zstandard(path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+class BlockWriter(object):
+    """
+    Collects small writes (one JSON line per element) into large blocks
+    before passing them on, compressors do a lot better on big blocks.
+    """
+    def __init__(self, fo, block_size=BLOCK_SIZE):
+        self.fo = fo
+        self.block_size = block_size
+        self.pending = []
+        self.size = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.fo.write(''.join(self.pending))
+            self.pending = []
+            self.size = 0
+
+    # Writes everything out to disk and returns the size of the file, for
+    # uncompressed outputs
+    def sync(self):
+        self.flush()
+        self.fo.flush()
+        os.fsync(self.fo.fileno())
+        return self.fo.tell()
+
+    def close(self):
+        self.flush()
+        self.fo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Opens a file for writing in large blocks, compressed according to its
+# extension
+def open_output(path):
+    ext = compression(path)
+    if ext == '.gz':
+        fo = gzip.open(path, 'wb', 6)
+    elif ext == '.bz2':
+        fo = bz2.BZ2File(path, 'wb', BLOCK_SIZE)
+    elif ext == '.zst':
+        check_zstandard(path)
+        fo = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    else:
+        fo = open(path, 'wb', BLOCK_SIZE)
+    return BlockWriter(fo)
+
+
+# Opens an uncompressed output file to go on writing after its first size
+# bytes, whatever comes after them is cut off
+def reopen_output(path, size):
+    fo = open(path, 'r+b', BLOCK_SIZE)
+    fo.truncate(size)
+    fo.seek(size)
+    return BlockWriter(fo)
+
+
+# PBF files are decoded by pbf.iter_elements, on workers processes
+def iter_elements(osmfile, tags=("node", "way"), workers=1):
+    if isinstance(osmfile, basestring) and osmfile.lower().endswith('.pbf'):
+        import pbf
+        for elem in pbf.iter_elements(osmfile, tags, workers):
+            yield elem
+        return
+    osm_file = open_input(osmfile)
+    try:
+        # The first event is always the start of the document root. Keeping a
+        # handle on it lets us drop finished siblings, elem.clear() alone would
+        # still leave an empty element per node/way attached to the root.
+        context = ET.iterparse(osm_file, events=("start", "end"))
+        event, root = next(context)
+        for event, elem in context:
+            if event != "end" or elem.tag not in TOP_LEVEL:
+                continue
+            if elem.tag in tags:
+                yield elem
+            elem.clear()
+            root.clear()
+    finally:
+        if osm_file is not osmfile:
+            osm_file.close()
+
+
+####################################################################
+# Byte range shards
+#
+# Top level elements in an OSM file never nest and '<' is always escaped
+# inside attribute values, so every '<node', '<way' or '<relation' in the raw
+# bytes starts a new element. That allows splitting a file into byte ranges
+# that can be parsed independently of each other.
+
+element_start = re.compile(r'<(?:node|way|relation)[\s/>]')
+xml_declaration = re.compile(r'<\?xml[^>]*\?>')
+
+# Number of bytes read at a time while looking for element boundaries
+SCAN_SIZE = 1 << 16
+
+
+# Returns the offset of the first element starting at or after offset
+def next_element_start(osm_file, offset, end):
+    osm_file.seek(offset)
+    buf = ''
+    while offset + len(buf) < end:
+        chunk = osm_file.read(SCAN_SIZE)
+        if not chunk:
+            break
+        # keep a few bytes of the previous chunk in case a tag is split up
+        buf = buf[-16:] + chunk
+        offset = osm_file.tell() - len(buf)
+        m = element_start.search(buf)
+        if m:
+            return min(offset + m.start(), end)
+    return end
+
+
+# Returns the offset of the closing </osm> tag
+def document_end(osm_file):
+    osm_file.seek(0, os.SEEK_END)
+    size = osm_file.tell()
+    osm_file.seek(max(0, size - SCAN_SIZE))
+    tail = osm_file.read()
+    pos = tail.rfind('</osm>')
+    if pos < 0:
+        return size
+    return size - len(tail) + pos
+
+
+# Splits the file into at most count byte ranges, each of them starting at a
+# top level element. The header in front of the first element and the closing
+# </osm> tag are left out.
+def shard_offsets(osmfile, count):
+    with open(osmfile, 'rb') as osm_file:
+        end = document_end(osm_file)
+        first = next_element_start(osm_file, 0, end)
+        if first >= end:
+            return []
+        bounds = [first]
+        step = max(1, (end - first) // count)
+        for i in xrange(1, count):
+            offset = next_element_start(osm_file, first + i * step, end)
+            if offset > bounds[-1] and offset < end:
+                bounds.append(offset)
+        bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+
+# Returns the XML declaration of the file, so shards keep its encoding
+def declaration(osmfile):
+    with open(osmfile, 'rb') as osm_file:
+        m = xml_declaration.match(osm_file.read(256))
+    return m.group() if m else ''
+
+
+# Turns the (line, column) of a parse error in ShardReader(osmfile, start,
+# end) into the position in osmfile itself
+def shard_position(osmfile, start, position):
+    prefix = declaration(osmfile) + '<osm>'
+    line, column = position
+    line -= prefix.count('\n')
+    if line < 1:
+        return position
+    lines = 0
+    line_start = 0
+    with open(osmfile, 'rb') as osm_file:
+        offset = 0
+        while offset < start:
+            chunk = osm_file.read(min(BLOCK_SIZE, start - offset))
+            if not chunk:
+                break
+            lines += chunk.count('\n')
+            if '\n' in chunk:
+                line_start = offset + chunk.rindex('\n') + 1
+            offset += len(chunk)
+    if line == 1:
+        # the first line of the shard starts with the prefix, in place of the
+        # part of the line before start
+        column += start - line_start - (len(prefix) - prefix.rfind('\n') - 1)
+    return lines + line, column
+
+
+class ShardReader(object):
+    """
+    File-like object presenting the byte range [start, end) of an OSM file as
+    a document of its own, so it can be handed to ET.iterparse or
+    iter_elements.
+    """
+    def __init__(self, osmfile, start, end):
+        self.osm_file = open(osmfile, 'rb')
+        self.osm_file.seek(start)
+        self.remaining = end - start
+        self.pending = [declaration(osmfile) + '<osm>']
+        self.closed = False
+
+    def read(self, size=SCAN_SIZE):
+        if self.pending:
+            return self.pending.pop()
+        if self.remaining > 0:
+            chunk = self.osm_file.read(min(size, self.remaining))
+            self.remaining -= len(chunk)
+            if chunk:
+                return chunk
+            self.remaining = 0
+        if not self.closed:
+            self.closed = True
+            self.osm_file.close()
+            return '</osm>'
+        return ''
+
+
+# Element type and id of a key like "node/123", see data.element_key. Sinks
+# take them from there, a tag named "type" or "id" can overwrite the fields
+# of the same name in the shaped document.
+def split_key(key):
+    element_type, element_id = key.split('/', 1)
+    return element_type, element_id
+
+# Writes an INT64 array to fo as 64 bit integers in native byte order,
+# whatever the array holds them in
+def write_int64(fo, values):
+    if values.itemsize == 8 and values.typecode == 'l':
+        values.tofile(fo)
+    else:
+        fo.write(struct.pack('={0}q'.format(len(values)), *[int(value) for value in values]))
+
+# Reads count integers written by write_int64 into an INT64 array
+def read_int64(fi, count):
+    values = array(INT64)
+    if values.itemsize == 8 and values.typecode == 'l':
+        values.fromfile(fi, count)
+    else:
+        data = fi.read(8 * count)
+        if len(data) < 8 * count:
+            raise EOFError("not enough items in file")
+        values.extend(struct.unpack('={0}q'.format(count), data))
+    return values
+
+
+class OffsetIndex(object):
+    """
+    Persistent map from element key ("node/123") to the byte offset and length
+    of its line in a JSON lines output file, kept in a dbm file next to it.
+    """
+    def __init__(self, path, flag='c'):
+        if flag == 'n':
+            # dumbdbm, what anydbm falls back to, ignores 'n' and keeps the
+            # keys of the old file
+            for suffix in ('', '.db', '.dir', '.dat', '.bak', '.pag'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            flag = 'c'
+        self.db = anydbm.open(path, flag)
+
+    def __setitem__(self, key, location):
+        self.db[key] = "{0} {1}".format(*location)
+
+    def __getitem__(self, key):
+        offset, length = self.db[key].split()
+        return int(offset), int(length)
+
+    def __delitem__(self, key):
+        del self.db[key]
+
+    def __contains__(self, key):
+        return self.db.has_key(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def add(self, key, offset, length):
+        self[key] = (offset, length)
+
+    def sync(self):
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,679 @@
+# -*- coding: utf-8 -*-
+"""
+Reader for the OSM PBF format, using only the standard library.
+
+A PBF file is a sequence of blobs, each preceded by a 4 byte big endian length
+and a BlobHeader. Apart from the leading OSMHeader blob every blob holds a
+zlib compressed PrimitiveBlock: a string table plus groups of nodes (plain or
+"dense", with delta coded ids, coordinates and metadata), ways and relations.
+See https://wiki.openstreetmap.org/wiki/PBF_Format for the details.
+
+The blocks don't depend on each other, so iter_primitives decodes them on a
+pool of worker processes. Every element comes out as a primitive
+(tag, attrib, tags, refs) with the attributes formatted exactly like in an OSM
+XML file, which lets data.py shape them with the same code as XML elements and
+iter_elements turn them into ElementTree elements for the audits. The refs
+of a relation are its members, as (type, ref, role).
+
+write_pbf writes primitives back out as a PBF file (dense nodes, ways and
+relations), which is mainly used to test the reader. The test also reads
+REFERENCE_PBF, written by osmium, so the reader isn't only checked against
+its own writer.
+"""
+import calendar
+from collections import deque
+import multiprocessing
+import struct
+import time
+import xml.etree.cElementTree as ET
+import zlib
+import osmio
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Features of the files we can read
+SUPPORTED_FEATURES = ("OsmSchema-V0.6", "DenseNodes", "HistoricalInformation")
+
+# Elements per block written by write_pbf, the format allows up to 8000
+BLOCK_ELEMENTS = 8000
+
+# Blocks per worker process decoded ahead of the one being consumed
+BLOCKS_IN_FLIGHT = 2
+
+
+def is_pbf(path):
+    return isinstance(path, basestring) and path.lower().endswith('.pbf')
+
+# Formats a coordinate the way OSM XML files do: 7 decimals, trailing zeros
+# dropped
+def format_coordinate(value):
+    return ('%.7f' % value).rstrip('0').rstrip('.')
+
+
+####################################################################
+# Protocol buffer wire format
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+# Yields (field number, value) for all fields of a message. Varints are
+# returned as (unsigned) numbers, length delimited fields as strings.
+def iter_fields(buf):
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type {0}".format(wire_type))
+        yield key >> 3, value
+
+def packed_varints(buf):
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values
+
+# sint32/sint64 fields
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+# int32/int64 fields with negative values come out as 64 bit two's complement
+def signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+# Undoes the delta coding of packed sint64 fields
+def deltas(buf):
+    values = []
+    last = 0
+    for value in packed_varints(buf):
+        last += zigzag(value)
+        values.append(last)
+    return values
+
+
+####################################################################
+# Reading
+
+# Yields (blob type, offset, size) for every blob of the file
+def iter_blobs(path):
+    with open(path, 'rb') as fi:
+        while True:
+            head = fi.read(4)
+            if len(head) < 4:
+                return
+            header_size = struct.unpack('!I', head)[0]
+            blob_type = None
+            size = 0
+            for field, value in iter_fields(fi.read(header_size)):
+                if field == 1:
+                    blob_type = value
+                elif field == 3:
+                    size = value
+            offset = fi.tell()
+            yield blob_type, offset, size
+            fi.seek(offset + size)
+
+def read_blob(path, offset, size):
+    with open(path, 'rb') as fi:
+        fi.seek(offset)
+        buf = fi.read(size)
+    raw = None
+    for field, value in iter_fields(buf):
+        if field == 1:
+            raw = value
+        elif field == 3:
+            raw = zlib.decompress(value)
+        elif field in (4, 5, 6, 7):
+            raise ValueError("{0}: blob compression {1} is not supported, only zlib".format(path, field))
+    return raw
+
+def check_header(path, offset, size):
+    for field, value in iter_fields(read_blob(path, offset, size)):
+        if field == 4 and value not in SUPPORTED_FEATURES:
+            raise ValueError("{0}: unsupported required feature {1}".format(path, value))
+
+
+class BlockContext(object):
+    """String table and coordinate/date scaling of a PrimitiveBlock."""
+    def __init__(self):
+        self.strings = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+
+    def coordinate(self, offset, value):
+        return (offset + self.granularity * value) / 1e9
+
+    def timestamp(self, value):
+        return time.strftime(TIMESTAMP_FORMAT, time.gmtime(value * self.date_granularity // 1000))
+
+    def info(self, attrib, version, timestamp, changeset, uid, user_sid, visible):
+        if visible is not None:
+            attrib['visible'] = 'true' if visible else 'false'
+        if version is not None:
+            attrib['version'] = str(version)
+        if changeset is not None:
+            attrib['changeset'] = str(changeset)
+        if timestamp is not None:
+            attrib['timestamp'] = self.timestamp(timestamp)
+        if user_sid is not None:
+            attrib['user'] = self.strings[user_sid]
+        if uid is not None:
+            attrib['uid'] = str(uid)
+
+    def tags(self, keys, values):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, values)]
+
+
+def decode_info(context, attrib, buf):
+    values = {}
+    for field, value in iter_fields(buf):
+        values[field] = value
+    context.info(attrib, values.get(1), values.get(2), values.get(3),
+                 signed(values[4]) if 4 in values else None, values.get(5), values.get(6))
+
+def decode_node(context, buf):
+    attrib = {}
+    keys = values = ()
+    lat = lon = 0
+    info = None
+    for field, value in iter_fields(buf):
+        if field == 1:
+            attrib['id'] = str(zigzag(value))
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            values = packed_varints(value)
+        elif field == 4:
+            info = value
+        elif field == 8:
+            lat = zigzag(value)
+        elif field == 9:
+            lon = zigzag(value)
+    if info is not None:
+        decode_info(context, attrib, info)
+    attrib['lat'] = format_coordinate(context.coordinate(context.lat_offset, lat))
+    attrib['lon'] = format_coordinate(context.coordinate(context.lon_offset, lon))
+    return ('node', attrib, context.tags(keys, values), [])
+
+def decode_dense(context, buf):
+    ids = lats = lons = keys_vals = ()
+    info = {}
+    for field, value in iter_fields(buf):
+        if field == 1:
+            ids = deltas(value)
+        elif field == 5:
+            info = dict(iter_fields(value))
+        elif field == 8:
+            lats = deltas(value)
+        elif field == 9:
+            lons = deltas(value)
+        elif field == 10:
+            keys_vals = packed_varints(value)
+
+    versions = packed_varints(info[1]) if 1 in info else None
+    timestamps = deltas(info[2]) if 2 in info else None
+    changesets = deltas(info[3]) if 3 in info else None
+    uids = deltas(info[4]) if 4 in info else None
+    user_sids = deltas(info[5]) if 5 in info else None
+    visibles = packed_varints(info[6]) if 6 in info else None
+
+    strings = context.strings
+    nodes = []
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {'id': str(node_id)}
+        context.info(attrib,
+                     versions[i] if versions else None,
+                     timestamps[i] if timestamps else None,
+                     changesets[i] if changesets else None,
+                     uids[i] if uids else None,
+                     user_sids[i] if user_sids else None,
+                     visibles[i] if visibles else None)
+        attrib['lat'] = format_coordinate(context.coordinate(context.lat_offset, lats[i]))
+        attrib['lon'] = format_coordinate(context.coordinate(context.lon_offset, lons[i]))
+        tags = []
+        # keys_vals holds the key/value string ids of all nodes, each node's
+        # list ends with a 0
+        if keys_vals:
+            while keys_vals[kv]:
+                tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                kv += 2
+            kv += 1
+        nodes.append(('node', attrib, tags, []))
+    return nodes
+
+def decode_way(context, buf):
+    attrib = {}
+    keys = values = ()
+    refs = []
+    info = None
+    for field, value in iter_fields(buf):
+        if field == 1:
+            attrib['id'] = str(signed(value))
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            values = packed_varints(value)
+        elif field == 4:
+            info = value
+        elif field == 8:
+            refs = [str(ref) for ref in deltas(value)]
+    if info is not None:
+        decode_info(context, attrib, info)
+    return ('way', attrib, context.tags(keys, values), refs)
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+def decode_relation(context, buf):
+    attrib = {}
+    keys = values = roles = types = ()
+    ids = []
+    info = None
+    for field, value in iter_fields(buf):
+        if field == 1:
+            attrib['id'] = str(signed(value))
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            values = packed_varints(value)
+        elif field == 4:
+            info = value
+        elif field == 8:
+            roles = packed_varints(value)
+        elif field == 9:
+            ids = deltas(value)
+        elif field == 10:
+            types = packed_varints(value)
+    if info is not None:
+        decode_info(context, attrib, info)
+    members = [(MEMBER_TYPES[member_type], str(member_id), context.strings[role])
+               for member_type, member_id, role in zip(types, ids, roles)]
+    return ('relation', attrib, context.tags(keys, values), members)
+
+# Decodes a PrimitiveBlock into a list of (tag, attrib, tags, refs).
+# Changesets are skipped, nothing downstream uses them.
+def decode_block(buf):
+    context = BlockContext()
+    groups = []
+    for field, value in iter_fields(buf):
+        if field == 1:
+            context.strings = [osmio.decode_text(s) for _, s in iter_fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            context.granularity = value
+        elif field == 18:
+            context.date_granularity = value
+        elif field == 19:
+            context.lat_offset = signed(value)
+        elif field == 20:
+            context.lon_offset = signed(value)
+
+    primitives = []
+    for group in groups:
+        for field, value in iter_fields(group):
+            if field == 1:
+                primitives.append(decode_node(context, value))
+            elif field == 2:
+                primitives.extend(decode_dense(context, value))
+            elif field == 3:
+                primitives.append(decode_way(context, value))
+            elif field == 4:
+                primitives.append(decode_relation(context, value))
+    return primitives
+
+# Worker for iter_primitives
+def decode_blob(args):
+    return decode_block(read_blob(*args))
+
+# (path, offset, size) of the data blobs of a PBF file, after checking its
+# header
+def data_blobs(path):
+    blocks = []
+    for blob_type, offset, size in iter_blobs(path):
+        if blob_type == 'OSMHeader':
+            check_header(path, offset, size)
+        elif blob_type == 'OSMData':
+            blocks.append((path, offset, size))
+    return blocks
+
+# Like pool.imap, but with at most window tasks handed out and not consumed
+# yet. pool.imap sends all of them at once, and with a consumer slower than
+# the workers their results pile up in memory.
+def imap_bounded(pool, func, items, window):
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# Yields (tag, attrib, tags, refs) for all nodes, ways and relations of a PBF
+# file, in file order. With workers > 1 the blocks are decoded on a process pool, at
+# most BLOCKS_IN_FLIGHT per worker ahead of the one being consumed.
+def iter_primitives(path, workers=1):
+    blocks = data_blobs(path)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for primitives in imap_bounded(pool, decode_blob, blocks, workers * BLOCKS_IN_FLIGHT):
+                for primitive in primitives:
+                    yield primitive
+            pool.close()
+        finally:
+            pool.terminate()
+    else:
+        for block in blocks:
+            for primitive in decode_blob(block):
+                yield primitive
+
+# Same as osmio.iter_elements for a PBF file: yields ElementTree elements with
+# their <tag> and <nd> or <member> children
+def iter_elements(path, tags=("node", "way"), workers=1):
+    for tag, attrib, kvs, refs in iter_primitives(path, workers):
+        if tag not in tags:
+            continue
+        elem = ET.Element(tag, attrib)
+        for k, v in kvs:
+            ET.SubElement(elem, 'tag', {'k': k, 'v': v})
+        if tag == 'relation':
+            for member_type, ref, role in refs:
+                ET.SubElement(elem, 'member', {'type': member_type, 'ref': ref, 'role': role})
+        else:
+            for ref in refs:
+                ET.SubElement(elem, 'nd', {'ref': ref})
+        yield elem
+
+
+####################################################################
+# Writing
+
+def varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = []
+    while value > 0x7f:
+        out.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+def to_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+def field_bytes(number, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+def field_packed(number, values):
+    return field_bytes(number, ''.join(varint(value) for value in values))
+
+def field_deltas(number, values):
+    last = 0
+    coded = []
+    for value in values:
+        coded.append(to_zigzag(value - last))
+        last = value
+    return field_packed(number, coded)
+
+def write_blob(fo, blob_type, data):
+    blob = field_varint(2, len(data)) + field_bytes(3, zlib.compress(data))
+    header = field_bytes(1, blob_type) + field_varint(3, len(blob))
+    fo.write(struct.pack('!I', len(header)))
+    fo.write(header)
+    fo.write(blob)
+
+def parse_timestamp(value):
+    return calendar.timegm(time.strptime(value, TIMESTAMP_FORMAT))
+
+def nanodegrees(value):
+    return int(round(float(value) * 1e7))
+
+# Info message of a way or relation
+def element_info(attrib, sid):
+    return (field_varint(1, int(attrib.get('version', 0))) +
+            field_varint(2, parse_timestamp(attrib['timestamp']) if 'timestamp' in attrib else 0) +
+            field_varint(3, int(attrib.get('changeset', 0))) +
+            field_varint(4, int(attrib.get('uid', 0))) +
+            field_varint(5, sid(attrib.get('user', ''))))
+
+def encode_block(primitives):
+    strings = {'': 0}
+    def sid(value):
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    nodes = [p for p in primitives if p[0] == 'node']
+    ways = [p for p in primitives if p[0] == 'way']
+    relations = [p for p in primitives if p[0] == 'relation']
+    groups = []
+    if nodes:
+        keys_vals = []
+        for _, attrib, tags, _ in nodes:
+            for k, v in tags:
+                keys_vals.extend((sid(k), sid(v)))
+            keys_vals.append(0)
+        info = (field_packed(1, [int(a.get('version', 0)) for _, a, _, _ in nodes]) +
+                field_deltas(2, [parse_timestamp(a['timestamp']) if 'timestamp' in a else 0 for _, a, _, _ in nodes]) +
+                field_deltas(3, [int(a.get('changeset', 0)) for _, a, _, _ in nodes]) +
+                field_deltas(4, [int(a.get('uid', 0)) for _, a, _, _ in nodes]) +
+                field_deltas(5, [sid(a.get('user', '')) for _, a, _, _ in nodes]))
+        dense = (field_deltas(1, [int(a['id']) for _, a, _, _ in nodes]) +
+                 field_bytes(5, info) +
+                 field_deltas(8, [nanodegrees(a['lat']) for _, a, _, _ in nodes]) +
+                 field_deltas(9, [nanodegrees(a['lon']) for _, a, _, _ in nodes]) +
+                 field_packed(10, keys_vals))
+        groups.append(field_bytes(2, field_bytes(2, dense)))
+    if ways:
+        group = []
+        for _, attrib, tags, refs in ways:
+            way = (field_varint(1, int(attrib['id'])) +
+                   field_packed(2, [sid(k) for k, v in tags]) +
+                   field_packed(3, [sid(v) for k, v in tags]) +
+                   field_bytes(4, element_info(attrib, sid)) +
+                   field_deltas(8, [int(ref) for ref in refs]))
+            group.append(field_bytes(3, way))
+        groups.append(field_bytes(2, ''.join(group)))
+    if relations:
+        group = []
+        for _, attrib, tags, members in relations:
+            relation = (field_varint(1, int(attrib['id'])) +
+                        field_packed(2, [sid(k) for k, v in tags]) +
+                        field_packed(3, [sid(v) for k, v in tags]) +
+                        field_bytes(4, element_info(attrib, sid)) +
+                        field_packed(8, [sid(role) for _, _, role in members]) +
+                        field_deltas(9, [int(ref) for _, ref, _ in members]) +
+                        field_packed(10, [MEMBER_TYPES.index(member_type) for member_type, _, _ in members]))
+            group.append(field_bytes(4, relation))
+        groups.append(field_bytes(2, ''.join(group)))
+
+    table = sorted(strings, key=strings.get)
+    return (field_bytes(1, ''.join(field_bytes(1, s) for s in table)) +
+            ''.join(groups) +
+            field_varint(17, 100) +
+            field_varint(18, 1000))
+
+# Writes (tag, attrib, tags, refs) primitives, e.g. the ones of primitives_from_xml,
+# to a PBF file. Every element needs id, version, changeset, timestamp, user
+# and uid, nodes also lat and lon.
+def write_pbf(path, primitives):
+    with open(path, 'wb') as fo:
+        header = field_bytes(4, "OsmSchema-V0.6") + field_bytes(4, "DenseNodes") + field_bytes(16, "nano")
+        write_blob(fo, "OSMHeader", header)
+        block = []
+        for primitive in primitives:
+            block.append(primitive)
+            if len(block) == BLOCK_ELEMENTS:
+                write_blob(fo, "OSMData", encode_block(block))
+                block = []
+        if block:
+            write_blob(fo, "OSMData", encode_block(block))
+
+# Yields the nodes, ways and relations of an OSM XML file as primitives
+def primitives_from_xml(osmfile):
+    for elem in osmio.iter_elements(osmfile, osmio.TOP_LEVEL):
+        tags = [(tag.attrib['k'], tag.attrib['v']) for tag in elem.findall('tag')]
+        if elem.tag == 'relation':
+            refs = [(member.attrib['type'], member.attrib['ref'], member.attrib['role'])
+                    for member in elem.findall('member')]
+        else:
+            refs = [nd.attrib['ref'] for nd in elem.findall('nd')]
+        yield (elem.tag, dict(elem.attrib), tags, refs)
+
+
+XML = u"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" version="2" changeset="11" timestamp="2014-01-01T10:00:00Z" user="u" uid="7" lat="52.5200066" lon="13.404954">
+    <tag k="addr:street" v="Potsdamer Chausee"/>
+    <tag k="addr:housenumber" v="4-6"/>
+    <tag k="phone" v="030 123456"/>
+  </node>
+  <node id="2" version="1" changeset="12" timestamp="2014-01-02T10:00:00Z" user="Müller" uid="8" lat="-33.8688197" lon="151.2092955"/>
+  <node id="5" version="1" changeset="12" timestamp="2014-01-02T10:00:00Z" user="Müller" uid="8" lat="52.6" lon="13.5">
+    <tag k="addr:postcode" v="16000"/>
+  </node>
+  <node id="6" version="3" changeset="9" timestamp="2013-12-31T23:59:59Z" user="u" uid="7" lat="0.0000001" lon="-0.0000001">
+    <tag k="name" v="Straßenbahn"/>
+  </node>
+  <node id="4294967301" version="1" changeset="4000000000" timestamp="2020-06-30T12:34:56Z" user="big" uid="2000000000" lat="-89.9999999" lon="-179.9999999"/>
+  <way id="10" version="1" changeset="13" timestamp="2014-01-03T10:00:00Z" user="u" uid="7">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="6"/>
+    <tag k="addr:street" v="Heerstr."/>
+    <tag k="highway" v="residential"/>
+  </way>
+  <way id="4294967310" version="2" changeset="14" timestamp="2014-01-04T10:00:00Z" user="u" uid="7">
+    <nd ref="6"/>
+    <nd ref="4294967301"/>
+    <nd ref="1"/>
+  </way>
+  <relation id="20" version="1" changeset="15" timestamp="2014-01-05T10:00:00Z" user="u" uid="7">
+    <member type="way" ref="10" role="outer"/>
+    <member type="node" ref="5" role=""/>
+    <member type="relation" ref="21" role="subarea"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+</osm>
+"""
+
+# XML written as a PBF file by osmium (libosmium 2.19, through pyosmium 3.6):
+# one block per element type, and the ids, changeset and coordinates of node
+# 4294967301 don't fit into 32 bits.
+REFERENCE_PBF = """
+AAAADQoJT1NNSGVhZGVyGDsQLxo3eJxT4vMvzg1OzkjNTdQNM9AzU+JySc0rTvXLT0ktbmIUyMlM
+yi/OzSzN1TfSM7TUMwAAX3QOlwAAAAwKB09TTURhdGEYpgIQmgIaoAJ4nONqZ+Ri4GIs5eJOTEkp
+siouKUpNLeESDMgvKU5JzE0tUnDOSCwtTk3lEgDLZ+QDOXmluUmpRVzMJrpmXKwFGfl5qVxcBsYG
+CoZGxiamZlzsvof35OQAFfCCtRTkF5ck56ekcrEamhkYGHCx5AHN5eIJLilKPDw/NS8pMSOPizkp
+M12ol1Goi5GLk4mJjenf////5bXMuViZGBmZGYUED8yZv4ar4RgXw8EffI9u7zvMKMUpxsTA+m7+
+zWeySpx8TAyMn86v+cynxcrEx8Ar4STZsvr9F+bevvfb2boeXtjB9vfvha/M/xcvv8XmJdGx53X9
+uhmzFnFtnbpsIVfj/vsNjL+Pn9vCG8TPxMzCysbOwMDJxcDNw8AAAIKVX64AAAAMCgdPU01EYXRh
+GIEBEHwafXic4zLiYuDiTkxJKbIqLilKTS3hYs/ITM8oT6zk4vBITS0CCupxcRelFmempOaVZCbm
+cDGWCrlJyXNwCTExMkkxMbMo8XEwCiyYMmsaqwSvArsGqxMzExOHlDJHX0NDgwBQkklgwfb5QEk+
+sCQ3z7/////LtwMlFQDB5yC7AAAACwoHT1NNRGF0YRhjEFgaX3ic49LmYuBiKaksSOXiyS3NKcks
+yM+pTM/P42Is5WLNLy1JLQLKsxeXJiUWpSYKaSqpc4gIMTJKMTIp8XEwCiy4tWQaqwS/ArsGsxMz
+CyubF7MIp0IQMyMDEwDJXRKX
+"""
+
+def test():
+    import json
+    import os
+    import shutil
+    import tempfile
+    import audit
+    import data
+    import metrics
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        xml = os.path.join(tmpdir, "test.osm")
+        with open(xml, "w") as fo:
+            fo.write(XML.encode('utf-8'))
+        path = os.path.join(tmpdir, "test.osm.pbf")
+        write_pbf(path, primitives_from_xml(xml))
+
+        # same elements, attributes and tags
+        assert list(iter_primitives(path)) == list(primitives_from_xml(xml))
+        assert list(iter_primitives(path, workers=2)) == list(primitives_from_xml(xml))
+
+        # a file from another writer reads the same
+        reference = os.path.join(tmpdir, "reference.osm.pbf")
+        with open(reference, "wb") as fo:
+            fo.write(REFERENCE_PBF.decode('base64'))
+        assert list(iter_primitives(reference)) == list(primitives_from_xml(xml))
+        children = lambda elem: sorted((child.tag, child.attrib) for child in elem)
+        assert [(elem.tag, elem.attrib, children(elem)) for elem in iter_elements(reference, osmio.TOP_LEVEL)] == \
+            [(elem.tag, elem.attrib, children(elem)) for elem in osmio.iter_elements(xml, osmio.TOP_LEVEL)]
+
+        # relations count as dropped, like in the XML engines
+        counted = []
+        for osm_file, engine in ((xml, 'etree'), (xml, 'expat'), (path, 'etree'), (reference, 'etree')):
+            run_metrics = metrics.Metrics(report_interval=None)
+            data.process_map(osm_file, engine=engine, metrics=run_metrics)
+            summary = run_metrics.summary()
+            counted.append((summary['elements_in'], summary['elements_out'], summary['dropped']))
+        assert counted == [counted[0]] * 4 and counted[0][2][data.NOT_NODE_OR_WAY] == 1
+
+        # same shaped documents and audit results
+        for workers in (1, 2):
+            data.process_map(xml)
+            data.process_map(path, workers=workers)
+            with open(xml + ".json") as fi:
+                expected = [json.loads(line) for line in fi]
+            with open(os.path.join(tmpdir, "test.osm.pbf.json")) as fi:
+                assert [json.loads(line) for line in fi] == expected
+        assert audit.audit_all(path) == audit.audit_all(xml)
+
+        # shaped on the workers, with a cache and metrics
+        caches, summaries = [], []
+        for workers in (1, 2):
+            cache = audit.CachedNormalizers()
+            classifier = data.KeyClassifier()
+            run_metrics = metrics.Metrics(report_interval=None)
+            data.process_map(path, workers=workers, cache=cache, metrics=run_metrics, classifier=classifier)
+            with open(os.path.join(tmpdir, "test.osm.pbf.json")) as fi:
+                assert [json.loads(line) for line in fi] == expected
+            caches.append(dict((name, (stats['hits'], stats['misses'])) for name, stats in cache.stats().items()))
+            summaries.append((run_metrics.elements_out, dict(run_metrics.dropped), dict(run_metrics.calls),
+                              classifier.stats()))
+        assert caches[0] == caches[1] and summaries[0] == summaries[1]
+        assert summaries[0][3]['lookups'] > 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,323 @@
+"""
+Output sinks for process_map.
+
+By default the shaped documents are written as JSON lines, to be loaded with
+mongoimport afterwards. MongoSink inserts them into a collection directly
+instead, so the data is never serialized to disk and read back.
+
+A sink has add(key, doc), called for every shaped element in file order, and
+close(). All sinks can be used as context managers.
+"""
+import json
+import threading
+import time
+import Queue
+from timeit import default_timer as timer
+import osmio
+
+try:
+    import pymongo
+    from pymongo.errors import AutoReconnect, BulkWriteError
+except ImportError:
+    pymongo = None
+
+    # Never raised, they only keep the except clauses of MongoSink working for
+    # collections that are not from pymongo
+    class AutoReconnect(Exception):
+        pass
+
+    class BulkWriteError(Exception):
+        pass
+
+# Server error code of a duplicate _id
+DUPLICATE_KEY = 11000
+
+# One client per server address, pymongo keeps a pool of connections in it
+# that all sinks writing to the same server share
+clients = {}
+
+
+# Returns the collection "db.collection" on the server at uri
+def connect(uri='mongodb://localhost:27017', db='osm', collection='map', pool_size=10):
+    if pymongo is None:
+        raise ImportError("writing to MongoDB needs the pymongo package")
+    if uri not in clients:
+        clients[uri] = pymongo.MongoClient(uri, maxPoolSize=pool_size)
+    return clients[uri][db][collection]
+
+
+# Yields (element key, document) for the lines of a JSON lines output of
+# process_map. keys is a file with the key of every line, one per line, as
+# process_map keeps it for its copies in parallel mode. Without it the keys
+# are made from the type and id fields, which tags of the same name may have
+# overwritten. Lines of blanks, as osmchange.apply_changes leaves them, are
+# skipped.
+def iter_keyed(file_json, keys=None):
+    lines = osmio.open_input(file_json)
+    try:
+        if keys is None:
+            for line in lines:
+                if line.isspace():
+                    continue
+                doc = json.loads(line)
+                yield "{0}/{1}".format(doc.get('type'), doc.get('id')), doc
+        else:
+            with open(keys) as fi:
+                for line in lines:
+                    key = next(fi).rstrip("\n")
+                    if not line.isspace():
+                        yield key, json.loads(line)
+    finally:
+        lines.close()
+
+
+class JsonSink(object):
+    """
+    Writes documents as JSON lines to a path or an open file. index is called
+    with the key, offset and length of every line written, offset is where
+    the first line goes in the file.
+    """
+    def __init__(self, fo, index=None, offset=0):
+        self.owned = isinstance(fo, basestring)
+        self.fo = osmio.open_output(fo) if self.owned else fo
+        self.index = index
+        self.offset = offset
+
+    def add(self, key, doc):
+        line = json.dumps(doc) + "\n"
+        self.fo.write(line)
+        if self.index is not None:
+            self.index(key, self.offset, len(line))
+            self.offset += len(line)
+
+    def close(self):
+        if self.owned:
+            self.fo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Tee(object):
+    """
+    Hands every document to each of the given sinks, in order.
+    """
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def add(self, key, doc):
+        for sink in self.sinks:
+            sink.add(key, doc)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MongoSink(object):
+    """
+    Inserts documents into a MongoDB collection in unordered batches of
+    batch_size. Full batches go through a queue of at most queue_size batches
+    to a thread doing the inserts, so parsing goes on while the server works
+    and waits for it only when the queue is full.
+
+    A batch that fails with a connection error is sent again up to retries
+    times. insert_many gives every document its _id before sending it, so
+    documents that made it to the server the first time come back as
+    duplicate key errors and are skipped.
+    """
+    def __init__(self, collection, batch_size=1000, queue_size=4, retries=3, retry_wait=0.5):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.batch = []
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.count = 0
+        self.batches = 0
+        self.retried = 0
+        self.start = timer()
+        self.elapsed = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # insert_many gives the documents their _id on the insert thread, so it
+    # gets a copy. The caller may still hand doc to other sinks.
+    def add(self, key, doc):
+        self.batch.append(dict(doc))
+        if len(self.batch) >= self.batch_size:
+            self.send()
+
+    def send(self):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(self.batch)
+        self.batch = []
+
+    # Runs on the insert thread. After an error the remaining batches are
+    # still taken from the queue so add() never blocks on a full one.
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.insert(batch)
+            except Exception as e:
+                self.error = e
+
+    def insert(self, batch):
+        size = len(batch)
+        for attempt in xrange(self.retries + 1):
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                break
+            except BulkWriteError as e:
+                failed = [error for error in e.details.get('writeErrors', [])
+                          if error.get('code') != DUPLICATE_KEY]
+                if not failed:
+                    break
+                if attempt == self.retries:
+                    raise
+                batch = [batch[error['index']] for error in failed]
+            except AutoReconnect:
+                if attempt == self.retries:
+                    raise
+            self.retried += 1
+            time.sleep(self.retry_wait * 2 ** attempt)
+        self.count += size
+        self.batches += 1
+
+    # Sends the last batch and waits for all inserts to finish
+    def close(self):
+        if self.thread.is_alive():
+            if self.batch and self.error is None:
+                self.queue.put(self.batch)
+            self.batch = []
+            self.queue.put(None)
+            self.thread.join()
+            self.elapsed = timer() - self.start
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def docs_per_second(self):
+        elapsed = self.elapsed if self.elapsed is not None else timer() - self.start
+        return self.count / elapsed if elapsed else 0.0
+
+    def report(self):
+        print "MongoSink: {0} documents in {1} batches, {2} retries, {3:.0f} documents/s".format(
+            self.count, self.batches, self.retried, self.docs_per_second())
+
+
+def test():
+    import os
+    import shutil
+    import tempfile
+    import data
+
+    # any object with insert_many will do, errors of its own come out of
+    # close() as they are
+    class Failing(object):
+        def insert_many(self, docs, ordered=True):
+            raise ValueError("no space left")
+    try:
+        with MongoSink(Failing(), batch_size=1) as sink:
+            sink.add("node/1", {'id': '1'})
+    except ValueError:
+        pass
+    else:
+        assert False, "the insert error was swallowed"
+
+    try:
+        import mongomock
+    except ImportError:
+        print "mongomock is not installed, skipping the MongoSink tests"
+        return
+
+    # Fails the first try of every batch with a connection error, after half
+    # of the documents made it in
+    class Flaky(object):
+        def __init__(self, collection):
+            self.collection = collection
+            self.calls = 0
+
+        def insert_many(self, docs, ordered=True):
+            self.calls += 1
+            if self.calls % 2:
+                self.collection.insert_many(docs[:len(docs) // 2], ordered=ordered)
+                raise AutoReconnect("connection reset")
+            return self.collection.insert_many(docs, ordered=ordered)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        data.write_synthetic_osm(file_in, 2500)
+        data.process_map(file_in)
+        with open(file_in + ".json") as fi:
+            expected = [json.loads(line) for line in fi]
+
+        collection = mongomock.MongoClient().db.osm
+        with MongoSink(collection, batch_size=100) as sink:
+            data.process_map(file_in, sink=sink)
+        assert sink.count == 2500 and sink.batches == 25 and sink.retried == 0
+        assert list(collection.find({}, {'_id': False})) == expected
+        sink.report()
+
+        collection = mongomock.MongoClient().db.osm
+        with MongoSink(Flaky(collection), batch_size=300, retry_wait=0) as sink:
+            data.process_map(file_in, sink=sink)
+        assert sink.count == 2500 and sink.retried == 9
+        assert collection.count_documents({}) == 2500
+        assert sorted(collection.distinct('id')) == sorted(doc['id'] for doc in expected)
+
+        # errors on the insert thread come out of close()
+        class Broken(object):
+            def insert_many(self, docs, ordered=True):
+                raise AutoReconnect("server down")
+        try:
+            with MongoSink(Broken(), batch_size=10, retries=1, retry_wait=0) as sink:
+                data.process_map(file_in, sink=sink)
+        except AutoReconnect:
+            pass
+        else:
+            assert False, "the insert error was swallowed"
+
+        # the documents handed to the sink are left as they are, so they can
+        # go on to the copies of process_map
+        collection = mongomock.MongoClient().db.osm
+        with MongoSink(collection, batch_size=1) as sink:
+            data.process_map(file_in, sink=sink, tiles=os.path.join(tmpdir, "tiles"))
+        assert collection.count_documents({}) == 2500
+        with open(os.path.join(tmpdir, "tiles", "manifest.json")) as fi:
+            assert json.load(fi)['count'] == 2500
+
+        # JsonSink gives the same file as the default writer
+        with JsonSink(os.path.join(tmpdir, "sink.json")) as sink:
+            data.process_map(file_in, sink=sink)
+        with open(os.path.join(tmpdir, "sink.json")) as fi:
+            assert [json.loads(line) for line in fi] == expected
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Street name rules used by audit.py, loaded from street_rules.json.
+
+    suffixes      endings of names that are fine as they are ("...straße")
+    prefixes      beginnings of names that are fine as they are ("Am ...")
+    expected      street types (the last word of a name) that are fine
+    misspellings  fixes applied by audit.update_name: every occurrence of
+                  "wrong" becomes "right", with word_end only where a word
+                  ends right after it
+
+Suffixes and prefixes are compiled into tries and matched without regard to
+ASCII case, like the re.IGNORECASE regexes they replace. The misspellings go
+into an Aho-Corasick automaton that finds all of them in one pass over the
+name. Classifying a name or fixing it therefore takes time in the length of
+the name, however many rules there are.
+"""
+from collections import deque
+import json
+import os
+
+# Default rules file, next to this module
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'street_rules.json')
+
+# Key of the rule stored at the node of a trie where the rule ends
+END = None
+
+# re.IGNORECASE without re.UNICODE in Python 2 only folds ASCII letters
+ASCII_LOWER = dict((unichr(c), unichr(c + 32)) for c in xrange(ord('A'), ord('Z') + 1))
+
+def ascii_lower(text):
+    return ''.join(ASCII_LOWER.get(c, c) for c in text)
+
+def is_word_char(c):
+    return c <= '\x7f' and c.isalnum() or c == '_'
+
+# The rules file is read as unicode, ASCII values are kept as plain strings
+# like everywhere else, so fixing a str gives a str
+def plain(text):
+    try:
+        return text.encode('ascii')
+    except UnicodeEncodeError:
+        return text
+
+# Names that are plain strings with non-ASCII bytes are matched the way the
+# regexes did, byte by byte as Latin-1
+def as_text(name):
+    if isinstance(name, str):
+        return name.decode('latin-1')
+    return name
+
+
+class Trie(object):
+    """
+    Character trie over words folded to lower case ASCII. With reverse=True
+    the words are stored back to front, for matching endings.
+    """
+    def __init__(self, words=(), reverse=False):
+        self.root = {}
+        self.reverse = reverse
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        node = self.root
+        for c in ascii_lower(word[::-1] if self.reverse else word):
+            node = node.setdefault(c, {})
+        node[END] = word
+
+    # Length of the longest word that text starts with (ends with, for a
+    # reversed trie), 0 if there is none. With shortest=True the walk stops at
+    # the first word found.
+    def match(self, text, shortest=False):
+        node = self.root
+        found = 0
+        depth = 0
+        chars = reversed(text) if self.reverse else text
+        for c in chars:
+            node = node.get(ASCII_LOWER.get(c, c))
+            if node is None:
+                break
+            depth += 1
+            if END in node:
+                found = depth
+                if shortest:
+                    break
+        return found
+
+
+class Automaton(object):
+    """
+    Aho-Corasick automaton over the misspellings. find() reports the same
+    matches as a regex alternation of them in rule order would: the leftmost
+    one, on a tie the earliest rule, then on after its end.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for index, rule in enumerate(rules):
+            state = 0
+            for c in rule['wrong']:
+                if c not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][c] = len(self.goto) - 1
+                state = self.goto[state][c]
+            self.out[state].append(index)
+        # breadth first, the failure link of a state points to the longest
+        # proper suffix of its path that is also a path from the root. The
+        # transitions of a state are its own plus those of its failure link,
+        # so matching takes one step per character.
+        self.delta = [dict(self.goto[0])] + [None] * (len(self.goto) - 1)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            if state:
+                self.delta[state] = dict(self.delta[self.fail[state]])
+                self.delta[state].update(self.goto[state])
+            for c, target in self.goto[state].items():
+                queue.append(target)
+                self.fail[target] = self.delta[self.fail[state]].get(c, 0) if state else 0
+                self.out[target] = self.out[target] + self.out[self.fail[target]]
+        self.out = [tuple((index, len(rules[index]['wrong']), bool(rules[index].get('word_end')))
+                          for index in out) for out in self.out]
+        # a name without any of these can't contain a misspelling
+        self.first_chars = tuple(set(rule['wrong'][0] for rule in rules))
+
+    # Returns the (start, end, rule) of the matches in text, in order
+    def find(self, text):
+        begin = size = len(text)
+        for c in self.first_chars:
+            start = text.find(c, 0, begin)
+            if start >= 0:
+                begin = start
+        if begin == size:
+            return []
+        delta, out = self.delta, self.out
+        candidates = []
+        state = 0
+        for end, c in enumerate(text[begin:], begin + 1):
+            state = delta[state].get(c, 0)
+            if out[state]:
+                for index, length, word_end in out[state]:
+                    # like "($|\b)" after it in a regex
+                    if word_end and end < size and is_word_char(c) == is_word_char(text[end]):
+                        continue
+                    candidates.append((end - length, index, end))
+        rules = self.rules
+        if len(candidates) == 1:
+            start, index, end = candidates[0]
+            return [(start, end, rules[index])]
+        matches = []
+        last_end = 0
+        for start, index, end in sorted(candidates):
+            if start >= last_end:
+                matches.append((start, end, rules[index]))
+                last_end = end
+        return matches
+
+
+class StreetRules(object):
+    def __init__(self, rules):
+        self.suffixes = Trie(rules['suffixes'], reverse=True)
+        self.prefixes = Trie(rules['prefixes'])
+        self.expected = frozenset(plain(word) for word in rules['expected'])
+        misspellings = []
+        for rule in rules['misspellings']:
+            rule = dict(rule, wrong=plain(rule['wrong']), right=plain(rule['right']))
+            misspellings.append(rule)
+        self.misspellings = Automaton(misspellings)
+        # with ASCII misspellings the bytes of a plain string can be matched
+        # as they are
+        self.ascii = all(isinstance(rule['wrong'], str) for rule in misspellings)
+
+    # The ending of name that is one of the suffixes, or None
+    def suffix(self, name):
+        found = self.suffixes.match(as_text(name))
+        return name[len(name) - found:] if found else None
+
+    # The beginning of name that is one of the prefixes, or None
+    def prefix(self, name):
+        found = self.prefixes.match(as_text(name), shortest=True)
+        return name[:found] if found else None
+
+    # Text of the first misspelling in name, or None
+    def misspelling(self, name):
+        matches = self.misspellings.find(name if self.ascii else as_text(name))
+        if not matches:
+            return None
+        start, end, rule = matches[0]
+        return name[start:end]
+
+    # name with all misspellings fixed
+    def fix(self, name):
+        matches = self.misspellings.find(name if self.ascii else as_text(name))
+        if not matches:
+            return name
+        parts = []
+        last_end = 0
+        for start, end, rule in matches:
+            parts.append(name[last_end:start])
+            parts.append(rule['right'])
+            last_end = end
+        parts.append(name[last_end:])
+        return ''.join(parts)
+
+
+def load(path=RULES_FILE):
+    with open(path) as fi:
+        return StreetRules(json.load(fi))
+
+
+def test():
+    import random
+    import re
+
+    rules = load()
+    with open(RULES_FILE) as fi:
+        raw = json.load(fi)
+
+    # same answers as regexes built from the same rules
+    def alternation(words):
+        return '|'.join(re.escape(word) for word in words)
+    part_of = re.compile(u'({0})$'.format(alternation(raw['suffixes'])), re.IGNORECASE)
+    prefix = re.compile(u'^({0})'.format(alternation(raw['prefixes'])), re.IGNORECASE)
+    wrong_spelling = re.compile(u'|'.join(re.escape(rule['wrong']) + (r'($|\b)' if rule.get('word_end') else '')
+                                          for rule in raw['misspellings']))
+    names = [u'Hauptstraße', u'HAUPTSTRAßE', u'Seeweg', u'Am Park', u'AM PARK', u'Amsterdamer Str.', u'Alt-Moabit',
+             u'Unter den Linden', u'Potsdamer Chausee', u'Berliner Chausse', u'Chauseestraße', u'Chaussee',
+             u'Chausse_1', u'Chausse-Ost', u'Chausse', u'ChauseeChausse', u'Lindenbrücke', u'BRÜCKE', u'Hinterheck',
+             u'Weg am See', u'see', u'', u'Straße des 17. Juni', u'Chauss', u'ChaChausee', u'Chausseß']
+    rand = random.Random(3)
+    pieces = [u'Chaus', u'see', u'se', u'e', u' ', u'-', u'weg', u'WEG', u'Am', u'straße', u'ß', u'_', u'a', u'Eck']
+    names += [u''.join(rand.choice(pieces) for _ in xrange(rand.randint(1, 6))) for _ in xrange(5000)]
+    for name in names:
+        m = part_of.search(name)
+        assert rules.suffix(name) == (m.group() if m else None), name
+        m = prefix.match(name)
+        assert bool(rules.prefix(name)) == bool(m), name
+        m = wrong_spelling.search(name)
+        assert rules.misspelling(name) == (m.group() if m else None), name
+        assert rules.fix(name) == wrong_spelling.sub('Chaussee', name), name
+
+    # plain strings stay plain strings
+    assert rules.suffix('seestra\xdfe') == 'stra\xdfe'
+    assert type(rules.fix('Xyz Chausee')) is str
+    assert u'Gärten' in rules.expected and 'Weg' in rules.expected
+
+    # more rules don't make a walk any longer
+    trie = Trie([u'x{0}weg'.format(i) for i in xrange(10000)], reverse=True)
+    assert trie.match(u'Am x9999Weg') == 8 and trie.match(u'Am Weg') == 0
+
+
+if __name__ == '__main__':
+    test()
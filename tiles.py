@@ -0,0 +1,278 @@
+"""
+Output partitioned by geohash tile.
+
+TileSink writes the shaped documents into one file per geohash of the given
+precision, "<geohash>.json" in a directory, a line "<element key> <JSON>" per
+document. Nodes go by their pos, ways by the middle of their bbox when they
+got a geometry. Ways without one have no position and go to "_.json". The
+element type comes from the key, a "type" tag can overwrite the type field.
+
+Only max_open tile files are kept open at a time, the least recently used one
+is closed when another one is needed. When the sink is closed it writes
+manifest.json with the number of documents in every tile and their extent,
+the bounding box of their positions and way bboxes. A way can reach out of
+its tile, so TileSet.query(bbox) picks the tiles to read by their extent, not
+by the area of the geohash.
+"""
+from collections import OrderedDict
+import json
+import os
+import osmio
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Geohash length of the tiles, 4 gives cells of about 39 x 20 km
+PRECISION = 4
+
+# Tile files kept open at a time
+MAX_OPEN = 64
+
+# Buffer size of each open tile file
+BUFFER_SIZE = 1 << 16
+
+# Tile of the documents without a position
+NO_POSITION = '_'
+
+
+def geohash(lat, lon, precision=PRECISION):
+    bits = precision * 5
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    x = min(int((lon + 180.0) / 360.0 * (1 << lon_bits)), (1 << lon_bits) - 1)
+    y = min(int((lat + 90.0) / 180.0 * (1 << lat_bits)), (1 << lat_bits) - 1)
+    # bits alternate between longitude and latitude, longitude first
+    code = 0
+    for i in xrange(bits):
+        if i % 2 == 0:
+            lon_bits -= 1
+            code = code << 1 | (x >> lon_bits) & 1
+        else:
+            lat_bits -= 1
+            code = code << 1 | (y >> lat_bits) & 1
+    return ''.join(BASE32[code >> shift & 31] for shift in xrange(bits - 5, -1, -5))
+
+# [south, west, north, east] of a geohash
+def geohash_bbox(code):
+    south, west, north, east = -90.0, -180.0, 90.0, 180.0
+    even = True
+    for c in code:
+        value = BASE32.index(c)
+        for shift in xrange(4, -1, -1):
+            bit = value >> shift & 1
+            if even:
+                middle = (west + east) / 2
+                if bit:
+                    west = middle
+                else:
+                    east = middle
+            else:
+                middle = (south + north) / 2
+                if bit:
+                    south = middle
+                else:
+                    north = middle
+            even = not even
+    return [south, west, north, east]
+
+# Bounding box [south, west, north, east] of a shaped document of
+# element_type, None if it has no position
+def doc_bbox(doc, element_type):
+    if element_type == 'node' and doc.get('pos'):
+        lat, lon = doc['pos']
+        return [lat, lon, lat, lon]
+    return doc.get('bbox')
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def extend(extent, bbox):
+    if extent is None:
+        return list(bbox)
+    return [min(extent[0], bbox[0]), min(extent[1], bbox[1]), max(extent[2], bbox[2]), max(extent[3], bbox[3])]
+
+
+class TileSink(object):
+    """
+    Sink for process_map writing the documents into the tile files described
+    above, in the directory path.
+    """
+    def __init__(self, path, precision=PRECISION, max_open=MAX_OPEN):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.precision = precision
+        self.max_open = max_open
+        self.open_files = OrderedDict()
+        self.tiles = {}
+        self.opened = 0
+
+    def writer(self, tile):
+        fo = self.open_files.pop(tile, None)
+        if fo is None:
+            if len(self.open_files) >= self.max_open:
+                self.open_files.popitem(last=False)[1].close()
+            # the first time a tile is opened its file from an earlier run is
+            # replaced
+            mode = 'ab' if tile in self.tiles else 'wb'
+            fo = open(os.path.join(self.path, tile + '.json'), mode, BUFFER_SIZE)
+            self.opened += 1
+        # re-inserting moves the file to the most recently used end
+        self.open_files[tile] = fo
+        return fo
+
+    def add(self, key, doc):
+        bbox = doc_bbox(doc, osmio.split_key(key)[0])
+        if bbox:
+            tile = geohash((bbox[0] + bbox[2]) / 2.0, (bbox[1] + bbox[3]) / 2.0, self.precision)
+        else:
+            tile = NO_POSITION
+        self.writer(tile).write("{0} {1}\n".format(key, json.dumps(doc)))
+        entry = self.tiles.get(tile)
+        if entry is None:
+            entry = self.tiles[tile] = {'count': 0, 'extent': None}
+        entry['count'] += 1
+        if bbox:
+            entry['extent'] = extend(entry['extent'], bbox)
+
+    def close(self):
+        if self.open_files is None:
+            return
+        for fo in self.open_files.values():
+            fo.close()
+        self.open_files = None
+        manifest = {
+            'precision': self.precision,
+            'count': sum(entry['count'] for entry in self.tiles.values()),
+            'tiles': self.tiles
+        }
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as fo:
+            json.dump(manifest, fo, indent=2, sort_keys=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Partitions a JSON lines output of process_map
+def from_json(file_json, path, precision=PRECISION, max_open=MAX_OPEN, keys=None):
+    import sinks
+    with TileSink(path, precision, max_open) as sink:
+        for key, doc in sinks.iter_keyed(file_json, keys):
+            sink.add(key, doc)
+
+
+class TileSet(object):
+    """
+    The tiles written by TileSink, read through their manifest.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as fi:
+            manifest = json.load(fi)
+        self.precision = manifest['precision']
+        self.count = manifest['count']
+        self.tiles = manifest['tiles']
+
+    # Tiles with documents in bbox [south, west, north, east]
+    def tiles_in(self, bbox):
+        return sorted(tile for tile, entry in self.tiles.items()
+                      if entry['extent'] is not None and intersects(entry['extent'], bbox))
+
+    # (element key, document) for the documents of a tile
+    def read_keyed(self, tile):
+        with open(os.path.join(self.path, tile + '.json')) as fi:
+            for line in fi:
+                key, doc = line.split(' ', 1)
+                yield key, json.loads(doc)
+
+    def read(self, tile):
+        for _, doc in self.read_keyed(tile):
+            yield doc
+
+    # Documents whose position or bbox intersects bbox, read from the tiles
+    # in bbox only
+    def query(self, bbox):
+        for tile in self.tiles_in(bbox):
+            for key, doc in self.read_keyed(tile):
+                found = doc_bbox(doc, osmio.split_key(key)[0])
+                if found and intersects(found, bbox):
+                    yield doc
+
+
+def test():
+    import random
+    import shutil
+    import tempfile
+    import data
+
+    assert geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+    assert geohash(52.5200066, 13.404954, 6) == 'u33dc0'
+    south, west, north, east = geohash_bbox('u33dc0')
+    assert south <= 52.5200066 <= north and west <= 13.404954 <= east
+    rand = random.Random(4)
+    for _ in xrange(1000):
+        lat, lon = rand.uniform(-90, 90), rand.uniform(-180, 180)
+        code = geohash(lat, lon, rand.randint(1, 8))
+        south, west, north, east = geohash_bbox(code)
+        assert south <= lat <= north and west <= lon <= east, (lat, lon, code)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_in = os.path.join(tmpdir, "synthetic.osm")
+        data.write_synthetic_osm(file_in, 3000)
+        data.process_map(file_in)
+        with open(file_in + ".json") as fi:
+            expected = [json.loads(line) for line in fi]
+        # fine tiles, few open files and the documents out of order, so files
+        # get closed and reopened
+        path = os.path.join(tmpdir, "tiles")
+        shuffled = list(expected)
+        rand.shuffle(shuffled)
+        with TileSink(path, precision=7, max_open=4) as sink:
+            for doc in shuffled:
+                sink.add("{0}/{1}".format(doc['type'], doc['id']), doc)
+        assert sink.opened > len(sink.tiles) > 4
+        tileset = TileSet(path)
+        assert tileset.count == 3000
+        tiles = dict((tile, list(tileset.read(tile))) for tile in tileset.tiles)
+        assert sorted(doc['id'] for docs in tiles.values() for doc in docs) == sorted(doc['id'] for doc in expected)
+        for tile, docs in tiles.items():
+            assert len(docs) == tileset.tiles[tile]['count']
+            assert all(geohash(doc['pos'][0], doc['pos'][1], 7) == tile for doc in docs)
+        bbox = [52.502, 13.401, 52.505, 13.404]
+        found = list(tileset.query(bbox))
+        assert sorted(doc['id'] for doc in found) == sorted(doc['id'] for doc in expected
+                                                           if intersects(doc_bbox(doc, doc['type']), bbox))
+        assert 0 < len(tileset.tiles_in(bbox)) < len(tileset.tiles)
+
+        # ways are put in the tile of their bbox, the ones without a geometry
+        # in the tile without a position
+        xml = os.path.join(tmpdir, "ways.osm")
+        with open(xml, "w") as fo:
+            fo.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n'
+                     '  <node id="1" lat="52.50" lon="13.40"/>\n'
+                     '  <node id="2" lat="52.60" lon="13.60"/>\n'
+                     '  <way id="3"><nd ref="1"/><nd ref="2"/></way>\n'
+                     '  <way id="4"><nd ref="5"/></way>\n'
+                     '  <node id="6" lat="53.50" lon="11.00"><tag k="type" v="multipolygon"/></node>\n'
+                     '</osm>\n')
+        for workers in (1, 2):
+            path = os.path.join(tmpdir, "ways{0}".format(workers))
+            data.process_map(xml, workers=workers, geometry=True, tiles=path)
+        tileset = TileSet(path)
+        assert tileset.tiles == TileSet(os.path.join(tmpdir, "ways1")).tiles
+        assert [doc['id'] for doc in tileset.read(NO_POSITION)] == ['4']
+        assert '3' in [doc['id'] for doc in tileset.read(geohash(52.55, 13.5))]
+        assert [doc['id'] for doc in tileset.query([52.58, 13.58, 52.59, 13.59])] == ['3']
+        assert sorted(doc['id'] for doc in tileset.query([52.49, 13.39, 52.51, 13.41])) == ['1', '3']
+        # a node with a type tag still goes by its position
+        assert [doc['id'] for doc in tileset.read(geohash(53.50, 11.00))] == ['6']
+        assert [doc['id'] for doc in tileset.query([53.49, 10.99, 53.51, 11.01])] == ['6']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()